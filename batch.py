@@ -0,0 +1,111 @@
+from utils.batch import *
+import argparse
+
+program_defaults = {
+    # Variables to configure the ES client:
+    "elasticsearch_host": "https://localhost:9200",
+    "elasticsearch_ca_path": "/home/c/.elastic-package/profiles/default/certs/elasticsearch/ca-cert.pem",
+    "elasticsearch_user": "elastic",
+    "elasticsearch_pwd": "changeme",
+
+    # If you are running on cloud, you should set these two. If they are not empty, then the client will connect
+    # to the cloud using these variables, instead of the ones above.
+    "cloud_pwd": "",
+    "cloud_id": "",
+
+    # Names or wildcard patterns of the data streams to test.
+    "data_streams": ["metrics-*"],
+
+    # Same as in main.py. -1 indicates the default (first index for the documents, last index for the
+    # settings/mappings, all documents).
+    "docs_index": -1,
+    "settings_mappings_index": -1,
+    "max_docs": -1,
+
+    # Maximum number of data streams being tested at the same time. The client connection pool has the same size.
+    "concurrency": 4,
+
+    # Keep the TSDB index of each data stream (named tsdb-index-enabled-<unique suffix of its test>) after the test.
+    # The report has the name of the TSDB index of each data stream.
+    "keep_tsdb_indices": False,
+
+    # Path to the JSON report, with the data streams ranked by overwrite rate.
+    "report": "tsdb-migration-report.json"
+}
+
+
+def get_cmd_arguments():
+    parser = argparse.ArgumentParser(description='Test the TSDB migration of many data streams.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    # ES variables
+    parser.add_argument('--elasticsearch_host', action="store", dest='elasticsearch_host',
+                        default=program_defaults["elasticsearch_host"],
+                        help="Elasticsearch host.\nDefault: " + program_defaults["elasticsearch_host"])
+    parser.add_argument('--elasticsearch_ca_path', action="store", dest='elasticsearch_ca_path',
+                        default=program_defaults["elasticsearch_ca_path"],
+                        help="Location of the Elasticsearch certificate.\nDefault: "
+                             + program_defaults["elasticsearch_ca_path"])
+    parser.add_argument('--elasticsearch_user', action="store", dest='elasticsearch_user',
+                        default=program_defaults["elasticsearch_user"],
+                        help="Name of the Elasticsearch user.\nDefault: " + program_defaults["elasticsearch_user"])
+    parser.add_argument('--elasticsearch_pwd', action="store", dest='elasticsearch_pwd',
+                        default=program_defaults["elasticsearch_pwd"],
+                        help="Elasticsearch password.\nDefault: " + program_defaults["elasticsearch_pwd"])
+
+    # Cloud variables
+    parser.add_argument('--cloud_id', action="store", dest='cloud_id', default=program_defaults["cloud_id"],
+                        help="The ID for Elastic Cloud. If set, it will overwrite every elasticsearch_* argument."
+                             "\nDefault: " + program_defaults["cloud_id"])
+    parser.add_argument('--cloud_pwd', action="store", dest='cloud_pwd', default=program_defaults["cloud_pwd"],
+                        help="The password for Elastic Cloud. If set, it will overwrite every elasticsearch_* argument."
+                             "\nDefault: " + program_defaults["cloud_pwd"])
+
+    # Data streams
+    parser.add_argument('--data_streams', action="store", dest='data_streams', nargs="+",
+                        default=program_defaults["data_streams"],
+                        help="Names or wildcard patterns of the data streams to test.\nDefault: "
+                             + " ".join(program_defaults["data_streams"]))
+
+    # Reindex variables
+    parser.add_argument('--docs_index', action="store", dest='docs_index', default=program_defaults["docs_index"],
+                        help="The data stream index number to be used to retrieve the documents."
+                             "\nDefault: First index of the data stream")
+    parser.add_argument('--settings_mappings_index', action="store", dest='settings_mappings_index',
+                        default=program_defaults["settings_mappings_index"],
+                        help="The data stream index number to be used to retrieve the mappings and settings."
+                             "\nDefault: Last index of the data stream")
+    parser.add_argument('--max_docs', action="store", dest='max_docs', default=program_defaults["max_docs"],
+                        help="The number of documents to retrieve from each data stream and reindex to its TSDB index."
+                             "\nDefault: All documents")
+
+    # Batch variables
+    parser.add_argument('--concurrency', action="store", dest='concurrency', default=program_defaults["concurrency"],
+                        help="Maximum number of data streams being tested at the same time."
+                             "\nDefault: " + str(program_defaults["concurrency"]))
+    parser.add_argument('--keep_tsdb_indices', action="store_true", dest='keep_tsdb_indices',
+                        default=program_defaults["keep_tsdb_indices"],
+                        help="Keep the TSDB index of each data stream after the test."
+                             "\nDefault: " + str(program_defaults["keep_tsdb_indices"]))
+    parser.add_argument('--report', action="store", dest='report', default=program_defaults["report"],
+                        help="Path to the JSON report.\nDefault: " + program_defaults["report"])
+
+    args, unknown = parser.parse_known_args()
+    if len(unknown) > 0:
+        parser.print_help()
+        print("\nUser provided unknown flags:", unknown)
+        print("Program will end.")
+        exit(0)
+    return args
+
+
+if __name__ == '__main__':
+    args = get_cmd_arguments()
+
+    # Create the client instance, with one connection per thread
+    client = get_client(args.elasticsearch_host, args.elasticsearch_ca_path, args.elasticsearch_user,
+                        args.elasticsearch_pwd, args.cloud_id, args.cloud_pwd, int(args.concurrency))
+    print("You're testing with version {}.\n".format(client.info()["version"]["number"]))
+
+    run_batch(client, args.data_streams, int(args.docs_index), int(args.settings_mappings_index), int(args.max_docs),
+              int(args.concurrency), args.keep_tsdb_indices, args.report)
@@ -0,0 +1,455 @@
+"""
+In-process stand-in for the Elasticsearch APIs used by this tool, to benchmark it without a cluster.
+The fake replaces the HTTP node of the client, so the client, the helpers and the serialization run as usual.
+It only implements what the tool needs:
+- Indices: exists, create, delete, refresh, get mapping, get settings, get data stream.
+- Documents: index, bulk (create and index), count, search and msearch (match_all, term, exists and range queries).
+- Reindex (blocking only), with TSDB overwrites and ingest pipelines with drop processors on ctx._version.
+Anything else fails with a 400 error.
+"""
+
+from collections import Counter
+from elastic_transport import ApiResponseMeta, BaseNode, HttpHeaders
+from elastic_transport._node import NodeApiResponse
+from elasticsearch import Elasticsearch
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+
+from utils.tsdb import *
+from utils.es import compile_field_extractor
+
+fake_version = "8.19.0-fake"
+
+
+class FakeError(Exception):
+    def __init__(self, status: int, error_type: str, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.error_type = error_type
+        self.reason = reason
+
+
+class FakeCluster:
+    """
+    State of the fake cluster: indices, data streams and pipelines. It is thread safe.
+    Requests are counted per endpoint in @requests.
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self.data_streams = {}
+        self.pipelines = {}
+        self.requests = Counter()
+        self.lock = threading.RLock()
+        self.next_id = 0
+
+    def create_data_stream(self, name: str, mappings: {} = {}, settings: {} = {}):
+        """
+        Create a data stream with one backing index, as if it matched an index template.
+        :param name: name of the data stream.
+        :param mappings: mappings of the index template.
+        :param settings: settings of the index template.
+        :return: name of the backing index.
+        """
+        mappings = json.loads(json.dumps(mappings))
+        mappings.setdefault("properties", {})["@timestamp"] = {"type": "date"}
+        backing_index = ".ds-{}-2099.01.01-000001".format(name)
+        self.add_index(backing_index, mappings, settings)
+        self.data_streams[name] = [backing_index]
+        return backing_index
+
+    def add_index(self, name: str, mappings: {}, settings: {}):
+        index_settings = {
+            "number_of_shards": "1",
+            "number_of_replicas": "1",
+            "provided_name": name,
+            "uuid": hashlib.sha1(name.encode()).hexdigest()[:22],
+            "creation_date": str(int(time.time() * 1000)),
+            "version": {"created": "8190099"}
+        }
+        index_settings |= settings.get("index", settings)
+        dimensions = []
+        if index_settings.get("mode") == "time_series":
+            dimensions = [field for field, mapping in flatten_mappings(mappings).items()
+                          if mapping.get("time_series_dimension")]
+        self.indices[name] = {
+            "mappings": mappings,
+            "settings": {"index": index_settings},
+            "dimensions": dimensions,
+            "extract": compile_field_extractor(dimensions),
+            "docs": {},
+            # Documents of each value of a field, built when a term query needs them
+            "terms": {}
+        }
+
+    def resolve(self, name: str):
+        """
+        Get the indices behind a name: an index, a data stream or a comma separated list of them.
+        """
+        names = []
+        for part in name.split(","):
+            if part in self.data_streams:
+                names += self.data_streams[part]
+            elif part in self.indices:
+                names.append(part)
+            else:
+                raise FakeError(404, "index_not_found_exception", "no such index [{}]".format(part))
+        return names
+
+    def write_index(self, name: str):
+        if name in self.data_streams:
+            return self.data_streams[name][-1]
+        if name not in self.indices:
+            raise FakeError(404, "index_not_found_exception", "no such index [{}]".format(name))
+        return name
+
+    def put_doc(self, index_name: str, source: {}, doc_id: str = None, op_type: str = "index",
+                version: int = None):
+        """
+        Place a document. In a TSDB index, the _id comes from the dimensions and @timestamp, so a document with
+        the same ones overwrites the previous document.
+        :return: _id of the document, and result of the operation: created or updated.
+        """
+        index = self.indices[self.write_index(index_name)]
+        if len(index["dimensions"]) > 0:
+            key = json.dumps([index["extract"](source), source.get("@timestamp")], default=str)
+            doc_id = hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+        elif doc_id is None:
+            self.next_id += 1
+            doc_id = "doc-{}".format(self.next_id)
+
+        old = index["docs"].get(doc_id)
+        if old is not None and op_type == "create" and len(index["dimensions"]) == 0:
+            raise FakeError(409, "version_conflict_engine_exception", "document already exists")
+        if version is None:
+            version = old["_version"] + 1 if old is not None else 1
+        elif old is not None and old["_version"] >= version:
+            raise FakeError(409, "version_conflict_engine_exception", "version conflict")
+        index["docs"][doc_id] = {"_id": doc_id, "_version": version, "_source": source}
+        index["terms"].clear()
+        return doc_id, "created" if old is None else "updated"
+
+    def run_pipeline(self, pipeline_name: str, doc: {}):
+        """
+        Run an ingest pipeline over a document.
+        :return: False if the document is dropped.
+        """
+        if pipeline_name not in self.pipelines:
+            raise FakeError(400, "illegal_argument_exception", "pipeline [{}] does not exist".format(pipeline_name))
+        for processor in self.pipelines[pipeline_name].get("processors", []):
+            if "drop" not in processor:
+                raise FakeError(400, "illegal_argument_exception", "only drop processors are supported")
+            condition = processor["drop"].get("if")
+            if condition is None:
+                return False
+            match = re.fullmatch(r"\s*ctx\._version\s*==\s*(\d+)\s*", condition)
+            if match is None:
+                raise FakeError(400, "illegal_argument_exception", "unsupported condition [{}]".format(condition))
+            if doc["_version"] == int(match.group(1)):
+                return False
+        return True
+
+    def search_docs(self, index_name: str, body: {}):
+        """
+        Get the hits of a search request.
+        """
+        query = body.get("query", {"match_all": {}})
+        term = get_term(query)
+        docs = []
+        for name in self.resolve(index_name):
+            index = self.indices[name]
+            if term is None:
+                candidates = index["docs"].values()
+            else:
+                field, value = term
+                if field not in index["terms"]:
+                    terms = {}
+                    for doc in index["docs"].values():
+                        terms.setdefault(json.dumps(get_value(doc["_source"], field), default=str), []).append(doc)
+                    index["terms"][field] = terms
+                candidates = index["terms"][field].get(json.dumps(value, default=str), [])
+            docs += [(name, doc) for doc in candidates if matches(query, doc["_source"])]
+
+        sort = body.get("sort", [])
+        for field in reversed(sort if isinstance(sort, list) else [sort]):
+            if isinstance(field, str):
+                field = {field: "asc"}
+            for name, order in field.items():
+                if isinstance(order, dict):
+                    order = order.get("order", "asc")
+                if name in ["_doc", "_shard_doc"]:
+                    continue
+                docs.sort(key=lambda doc: str(get_value(doc[1]["_source"], name)), reverse=order == "desc")
+
+        start = int(body.get("from", 0))
+        size = int(body.get("size", 10))
+        hits = [{"_index": name, "_id": doc["_id"], "_score": 1.0, "_source": doc["_source"]}
+                for name, doc in docs[start:start + size]]
+        return {
+            "took": 1,
+            "timed_out": False,
+            "hits": {"total": {"value": len(docs), "relation": "eq"}, "max_score": 1.0, "hits": hits}
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_extractor(field: str):
+    return compile_field_extractor([field])
+
+
+def get_value(source: {}, field: str):
+    return get_extractor(field)(source)[0]
+
+
+def get_term(query: {}):
+    """
+    Get a term that every document matching the query has, to only check the documents with it.
+    :return: field and value of the term, or None if the query has no such term.
+    """
+    (query_type, clause), = query.items()
+    if query_type == "term":
+        (field, value), = clause.items()
+        return field, value["value"] if isinstance(value, dict) else value
+    if query_type == "bool":
+        for must in clause.get("must", []) if isinstance(clause.get("must", []), list) else [clause["must"]]:
+            term = get_term(must)
+            if term is not None:
+                return term
+    return None
+
+
+def matches(query: {}, source: {}):
+    """
+    Check if a document matches a query. Only match_all, term, exists, range and bool are supported.
+    """
+    (query_type, clause), = query.items()
+    if query_type == "match_all":
+        return True
+    if query_type == "term":
+        (field, value), = clause.items()
+        if isinstance(value, dict):
+            value = value["value"]
+        return get_value(source, field) == value
+    if query_type == "exists":
+        return get_value(source, clause["field"]) != missing_value
+    if query_type == "range":
+        (field, bounds), = clause.items()
+        value = get_value(source, field)
+        if value == missing_value:
+            return False
+        if field == "@timestamp" and bounds.get("format") == "epoch_millis":
+            value = to_epoch_millis(value)
+        for op, bound in bounds.items():
+            if op == "gte" and not value >= bound or op == "gt" and not value > bound or \
+                    op == "lte" and not value <= bound or op == "lt" and not value < bound:
+                return False
+        return True
+    if query_type == "bool":
+        def as_list(clauses):
+            return clauses if isinstance(clauses, list) else [clauses]
+        return all(matches(q, source) for q in as_list(clause.get("must", [])) + as_list(clause.get("filter", []))) \
+            and not any(matches(q, source) for q in as_list(clause.get("must_not", [])))
+    raise FakeError(400, "parsing_exception", "unsupported query [{}]".format(query_type))
+
+
+def to_epoch_millis(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    from datetime import datetime, timezone
+    date = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def read_ndjson(body: bytes):
+    return [json.loads(line) for line in body.decode().splitlines() if line.strip() != ""]
+
+
+class FakeNode(BaseNode):
+    """
+    Node of the client that answers the requests with the fake cluster, instead of sending them over HTTP.
+    """
+    cluster: FakeCluster = None
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        start = time.perf_counter()
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.strip("/").split("/") if part != ""]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            with self.cluster.lock:
+                endpoint, status, resp = route(self.cluster, method, path, params, body)
+        except FakeError as e:
+            endpoint = "error"
+            status = e.status
+            resp = {"error": {"type": e.error_type, "reason": e.reason}, "status": e.status}
+        self.cluster.requests[endpoint] += 1
+
+        meta = ApiResponseMeta(
+            status=status,
+            http_version="1.1",
+            headers=HttpHeaders({"content-type": "application/json", "x-elastic-product": "Elasticsearch"}),
+            duration=time.perf_counter() - start,
+            node=self.config
+        )
+        if method == "HEAD":
+            return NodeApiResponse(meta, b"")
+        return NodeApiResponse(meta, json.dumps(resp).encode())
+
+
+def route(cluster: FakeCluster, method: str, path: [], params: {}, body: bytes):
+    """
+    Answer a request.
+    :return: name of the endpoint, HTTP status and response.
+    """
+    if len(path) == 0:
+        return "info", 200, {"name": "fake", "cluster_name": "fake", "version": {"number": fake_version}}
+
+    if path[0] == "_data_stream" and method == "GET":
+        names = [name for name in path[1].split(",") if name in cluster.data_streams]
+        if len(names) == 0:
+            raise FakeError(404, "index_not_found_exception", "no such index [{}]".format(path[1]))
+        data_streams = [{"name": name, "indices": [{"index_name": index} for index in cluster.data_streams[name]]}
+                        for name in names]
+        return "get_data_stream", 200, {"data_streams": data_streams}
+
+    if path[0] == "_ingest" and path[1] == "pipeline" and method == "PUT":
+        cluster.pipelines[path[2]] = json.loads(body)
+        return "put_pipeline", 200, {"acknowledged": True}
+    if path[0] == "_ingest" and path[1] == "pipeline" and method == "DELETE":
+        if cluster.pipelines.pop(path[2], None) is None:
+            raise FakeError(404, "resource_not_found_exception", "pipeline [{}] is missing".format(path[2]))
+        return "delete_pipeline", 200, {"acknowledged": True}
+
+    if path[0] == "_bulk" or len(path) == 2 and path[1] == "_bulk":
+        return "bulk", 200, bulk(cluster, read_ndjson(body), path[0] if path[0] != "_bulk" else None)
+
+    if path[0] == "_msearch" or len(path) == 2 and path[1] == "_msearch":
+        lines = read_ndjson(body)
+        responses = []
+        for header, search in zip(lines[::2], lines[1::2]):
+            try:
+                responses.append(cluster.search_docs(header.get("index", path[0]), search) | {"status": 200})
+            except FakeError as e:
+                responses.append({"error": {"type": e.error_type, "reason": e.reason}, "status": e.status})
+        return "msearch", 200, {"took": 1, "responses": responses}
+
+    if path[0] == "_reindex":
+        if params.get("wait_for_completion") == "false":
+            raise FakeError(400, "illegal_argument_exception", "background reindex is not supported")
+        return "reindex", 200, reindex(cluster, json.loads(body))
+
+    if path[0].startswith("_"):
+        raise FakeError(400, "illegal_argument_exception", "unsupported endpoint [{} /{}]".format(method,
+                                                                                                "/".join(path)))
+
+    name = path[0]
+    if len(path) == 1:
+        if method == "HEAD":
+            exists = all(part in cluster.indices or part in cluster.data_streams for part in name.split(","))
+            return "exists", 200 if exists else 404, {}
+        if method == "PUT":
+            if name in cluster.indices:
+                raise FakeError(400, "resource_already_exists_exception", "index [{}] already exists".format(name))
+            request = json.loads(body) if body else {}
+            cluster.add_index(name, request.get("mappings", {}), request.get("settings", {}))
+            return "create_index", 200, {"acknowledged": True, "shards_acknowledged": True, "index": name}
+        if method == "DELETE":
+            for index in cluster.resolve(name):
+                del cluster.indices[index]
+            return "delete_index", 200, {"acknowledged": True}
+
+    action = path[1]
+    if action == "_mapping":
+        return "get_mapping", 200, {index: {"mappings": cluster.indices[index]["mappings"]}
+                                    for index in cluster.resolve(name)}
+    if action == "_settings":
+        return "get_settings", 200, {index: {"settings": cluster.indices[index]["settings"]}
+                                     for index in cluster.resolve(name)}
+    if action == "_refresh":
+        cluster.resolve(name)
+        return "refresh", 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+    if action == "_count":
+        request = json.loads(body) if body else {}
+        return "count", 200, {"count": cluster.search_docs(name, request | {"size": 0})["hits"]["total"]["value"]}
+    if action == "_search":
+        request = json.loads(body) if body else {}
+        for key in ["size", "from", "sort"]:
+            if key in params:
+                request[key] = params[key].split(",") if key == "sort" else params[key]
+        return "search", 200, cluster.search_docs(name, request)
+    if action in ["_doc", "_create"]:
+        doc_id, result = cluster.put_doc(name, json.loads(body), path[2] if len(path) > 2 else None,
+                                         "create" if action == "_create" else params.get("op_type", "index"))
+        return "index", 201 if result == "created" else 200, {"_index": cluster.write_index(name), "_id": doc_id,
+                                                               "result": result}
+
+    raise FakeError(400, "illegal_argument_exception", "unsupported endpoint [{} /{}]".format(method, "/".join(path)))
+
+
+def bulk(cluster: FakeCluster, lines: [], default_index: str = None):
+    items = []
+    errors = False
+    n = 0
+    while n < len(lines):
+        (op_type, meta), = lines[n].items()
+        if op_type == "delete":
+            raise FakeError(400, "illegal_argument_exception", "bulk delete is not supported")
+        source = lines[n + 1]
+        n += 2
+        index_name = meta.get("_index", default_index)
+        try:
+            doc_id, result = cluster.put_doc(index_name, source, meta.get("_id"), op_type)
+            items.append({op_type: {"_index": cluster.write_index(index_name), "_id": doc_id, "result": result,
+                                    "status": 201 if result == "created" else 200}})
+        except FakeError as e:
+            errors = True
+            items.append({op_type: {"_index": index_name, "status": e.status,
+                                    "error": {"type": e.error_type, "reason": e.reason}}})
+    return {"took": 1, "errors": errors, "items": items}
+
+
+def reindex(cluster: FakeCluster, request: {}):
+    start = time.perf_counter()
+    source = request["source"]
+    dest = request["dest"]
+    docs = []
+    for name in cluster.resolve(source["index"]):
+        docs += [doc for doc in cluster.indices[name]["docs"].values()
+                 if matches(source.get("query", {"match_all": {}}), doc["_source"])]
+    if "max_docs" in request:
+        docs = docs[:int(request["max_docs"])]
+
+    resp = {"total": len(docs), "created": 0, "updated": 0, "deleted": 0, "batches": 1, "noops": 0,
+            "version_conflicts": 0, "failures": []}
+    external = dest.get("version_type") == "external"
+    for doc in docs:
+        if "pipeline" in dest and not cluster.run_pipeline(dest["pipeline"], doc):
+            resp["noops"] += 1
+            continue
+        try:
+            _, result = cluster.put_doc(dest["index"], doc["_source"], doc["_id"],
+                                        version=doc["_version"] if external else None)
+            resp[result] += 1
+        except FakeError as e:
+            resp["version_conflicts"] += 1
+            resp["failures"].append({"id": doc["_id"], "cause": {"type": e.error_type, "reason": e.reason}})
+    resp["took"] = int((time.perf_counter() - start) * 1000)
+    return resp
+
+
+def get_fake_client(cluster: FakeCluster):
+    """
+    Create an ES client that sends its requests to the fake cluster.
+    :param cluster: fake cluster.
+    :return: ES client.
+    """
+    node_class = type("FakeNode", (FakeNode,), {"cluster": cluster})
+    return Elasticsearch(hosts="http://fake-elasticsearch:9200", node_class=node_class)
@@ -0,0 +1,265 @@
+"""
+Benchmark of each stage of the migration test, against the fake cluster of benchmark/fake_es.py.
+Run it from the root of the repository:
+
+    python -m benchmark.main --docs 100000 --cardinality 1000 --collision_rate 0.05
+
+The documents are generated from the index template, and the time and requests of each stage are displayed
+(and the memory, with --trace_memory). With --output, the results are also written to a JSON file, to compare
+them between versions.
+"""
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+
+import argparse
+import random
+import shutil
+import tempfile
+import tracemalloc
+
+from benchmark.fake_es import *
+from utils.es import *
+
+program_defaults = {
+    # Index template used to generate the documents. Its dimensions and metrics are filled with random values.
+    "template_path": "sample/templates/index-template.json",
+
+    # Number of documents to generate.
+    "docs": 10000,
+    # Number of distinct values of each keyword dimension.
+    "cardinality": 100,
+    # Fraction of the documents that have the same dimensions and @timestamp as a previous document.
+    "collision_rate": 0.05,
+    # Size of the extra text field of each document, in bytes. 0 generates no extra field.
+    "doc_bytes": 0,
+    # Number of overwritten documents displayed and placed in a directory by get_missing_docs_info.
+    "display_docs": 100,
+    "seed": 1,
+
+    # Measure the peak memory of each stage. Tracing the memory makes every stage several times slower, so only
+    # compare the times of runs with the same value.
+    "trace_memory": False,
+
+    # Path to the JSON file with the results. Empty to only display them.
+    "output": "",
+    # Display the output of each stage.
+    "verbose": False
+}
+
+data_stream_name = "benchmark-tsdb-default"
+
+
+def generate_docs(template: {}, n_docs: int, cardinality: int, collision_rate: float, doc_bytes: int, seed: int):
+    """
+    Generate documents for the mappings of an index template.
+    Keyword dimensions get one of @cardinality values, metrics get random numbers and every document gets its own
+    @timestamp, except for the collisions, that copy the dimensions and @timestamp of a previous document.
+    :param template: index template.
+    :param n_docs: number of documents.
+    :param cardinality: number of distinct values of each keyword dimension.
+    :param collision_rate: fraction of the documents that collide with a previous document.
+    :param doc_bytes: size of the extra text field, in bytes.
+    :param seed: seed of the random values.
+    :return: generator of documents.
+    """
+    rng = random.Random(seed)
+    fields = flatten_mappings(template["template"]["mappings"])
+    dimensions = [field for field, mapping in fields.items() if mapping.get("time_series_dimension")]
+    others = [field for field in fields if field not in dimensions]
+    start = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    padding = "x" * doc_bytes
+
+    def set_value(doc: {}, field: str, value):
+        keys = field.split(".")
+        for key in keys[:-1]:
+            doc = doc.setdefault(key, {})
+        doc[keys[-1]] = value
+
+    def random_value(field: str):
+        field_type = fields[field].get("type")
+        if field_type in ["integer", "long", "short", "byte"]:
+            return rng.randint(0, 1000)
+        if field_type in ["double", "float", "half_float", "scaled_float"]:
+            return rng.random() * 1000
+        if field_type == "boolean":
+            return rng.random() < 0.5
+        return "{}-{}".format(field.split(".")[-1], rng.randrange(cardinality))
+
+    previous = []
+    for n in range(n_docs):
+        doc = {}
+        if len(previous) > 0 and rng.random() < collision_rate:
+            for field, value in rng.choice(previous).items():
+                set_value(doc, field, value)
+        else:
+            key = {"@timestamp": (start + timedelta(seconds=n)).strftime("%Y-%m-%dT%H:%M:%S.000Z")}
+            key |= {field: random_value(field) for field in dimensions}
+            for field, value in key.items():
+                set_value(doc, field, value)
+            previous.append(key)
+        for field in others:
+            set_value(doc, field, random_value(field))
+        if doc_bytes > 0:
+            doc["message"] = padding
+        yield doc
+
+
+def run_stage(results: [], cluster: FakeCluster, name: str, verbose: bool, function, *args, **kwargs):
+    """
+    Run a stage, measuring its time and requests, and its peak memory if it is being traced.
+    Memory is the peak of the Python allocations during the stage, which includes the fake cluster.
+    :return: result of the stage.
+    """
+    cluster.requests.clear()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    if verbose:
+        result = function(*args, **kwargs)
+    else:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - memory if tracemalloc.is_tracing() else None
+    results.append({
+        "stage": name,
+        "seconds": seconds,
+        "peak_memory_bytes": peak,
+        "requests": sum(cluster.requests.values()),
+        "requests_per_endpoint": dict(cluster.requests)
+    })
+    return result
+
+
+def run_benchmark(template_path: str, n_docs: int, cardinality: int, collision_rate: float, doc_bytes: int,
+                  display_docs: int, seed: int, trace_memory: bool, verbose: bool):
+    """
+    Generate the documents and run every stage of the migration test against a new fake cluster.
+    :return: results of each stage.
+    """
+    with open(template_path) as file:
+        template = json.load(file)
+    cluster = FakeCluster()
+    cluster.create_data_stream(data_stream_name, template["template"].get("mappings", {}),
+                               template["template"].get("settings", {}))
+    client = get_fake_client(cluster)
+
+    work_dir = tempfile.mkdtemp(prefix="tsdb-benchmark-")
+    docs_path = os.path.join(work_dir, "docs.ndjson")
+    with open(docs_path, 'w') as file:
+        for doc in generate_docs(template, n_docs, cardinality, collision_rate, doc_bytes, seed):
+            file.write(json.dumps(doc) + "\n")
+
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        run_stage(results, cluster, "place_documents", verbose, place_documents, client, data_stream_name, docs_path,
+                  bulk=True)
+        source_index, mappings, settings, time_series_fields = run_stage(
+            results, cluster, "get_tsdb_config", verbose, get_tsdb_config, client, data_stream_name, -1, -1)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            create_index(client, tsdb_index, mappings, settings)
+        all_placed = run_stage(results, cluster, "copy_docs_from_to", verbose, copy_docs_from_to, client,
+                               source_index, tsdb_index, -1)
+        if not all_placed:
+            run_stage(results, cluster, "create_index_missing_for_docs", verbose, create_index_missing_for_docs,
+                      client)
+            run_stage(results, cluster, "get_missing_docs_info", verbose, get_missing_docs_info, client,
+                      data_stream_name, time_series_fields["dimension"], display_docs,
+                      os.path.join(work_dir, "overwritten-docs"), True, 2)
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(work_dir)
+
+    overwritten = len(cluster.indices[source_index]["docs"]) - len(cluster.indices[tsdb_index]["docs"])
+    print("Generated {} documents ({} overwritten in the TSDB index).\n".format(n_docs, overwritten))
+    return results
+
+
+def display_results(results: []):
+    """
+    Display the time, memory and requests of each stage.
+    :param results: results of each stage.
+    """
+    print("{:<32}{:>12}{:>16}{:>12}".format("Stage", "Time (s)", "Memory (MiB)", "Requests"))
+    for result in results:
+        memory = "-"
+        if result["peak_memory_bytes"] is not None:
+            memory = "{:.2f}".format(result["peak_memory_bytes"] / 1024 / 1024)
+        print("{:<32}{:>12.3f}{:>16}{:>12}".format(result["stage"], result["seconds"], memory, result["requests"]))
+        for endpoint, count in sorted(result["requests_per_endpoint"].items()):
+            print("\t- {}: {}".format(endpoint, count))
+
+
+def get_cmd_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the migration test against a fake cluster.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--template_path', action="store", dest='template_path',
+                        default=program_defaults["template_path"],
+                        help="Index template to generate the documents.\nDefault: "
+                             + program_defaults["template_path"])
+    parser.add_argument('--docs', action="store", dest='docs', default=program_defaults["docs"],
+                        help="Number of documents to generate.\nDefault: " + str(program_defaults["docs"]))
+    parser.add_argument('--cardinality', action="store", dest='cardinality', default=program_defaults["cardinality"],
+                        help="Number of distinct values of each keyword dimension.\nDefault: "
+                             + str(program_defaults["cardinality"]))
+    parser.add_argument('--collision_rate', action="store", dest='collision_rate',
+                        default=program_defaults["collision_rate"],
+                        help="Fraction of the documents with the same dimensions and @timestamp as a previous one."
+                             "\nDefault: " + str(program_defaults["collision_rate"]))
+    parser.add_argument('--doc_bytes', action="store", dest='doc_bytes', default=program_defaults["doc_bytes"],
+                        help="Size of the extra text field of each document, in bytes.\nDefault: "
+                             + str(program_defaults["doc_bytes"]))
+    parser.add_argument('--display_docs', action="store", dest='display_docs',
+                        default=program_defaults["display_docs"],
+                        help="Number of overwritten documents displayed and placed in a directory.\nDefault: "
+                             + str(program_defaults["display_docs"]))
+    parser.add_argument('--seed', action="store", dest='seed', default=program_defaults["seed"],
+                        help="Seed of the generated documents.\nDefault: " + str(program_defaults["seed"]))
+    parser.add_argument('--trace_memory', action="store_true", dest='trace_memory',
+                        default=program_defaults["trace_memory"],
+                        help="Measure the peak memory of each stage. It makes every stage several times slower."
+                             "\nDefault: " + str(program_defaults["trace_memory"]))
+    parser.add_argument('--output', action="store", dest='output', default=program_defaults["output"],
+                        help="Path to the JSON file with the results.\nDefault: " + program_defaults["output"])
+    parser.add_argument('--verbose', action="store_true", dest='verbose', default=program_defaults["verbose"],
+                        help="Display the output of each stage.\nDefault: " + str(program_defaults["verbose"]))
+
+    args, unknown = parser.parse_known_args()
+    if len(unknown) > 0:
+        parser.print_help()
+        print("\nUser provided unknown flags:", unknown)
+        print("Program will end.")
+        exit(0)
+    return args
+
+
+if __name__ == '__main__':
+    args = get_cmd_arguments()
+
+    results = run_benchmark(args.template_path, int(args.docs), int(args.cardinality), float(args.collision_rate),
+                            int(args.doc_bytes), int(args.display_docs), int(args.seed), args.trace_memory,
+                            args.verbose)
+    display_results(results)
+
+    if args.output != "":
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "parameters": {
+                "template_path": args.template_path,
+                "docs": int(args.docs),
+                "cardinality": int(args.cardinality),
+                "collision_rate": float(args.collision_rate),
+                "doc_bytes": int(args.doc_bytes),
+                "display_docs": int(args.display_docs),
+                "seed": int(args.seed),
+                "trace_memory": args.trace_memory
+            },
+            "stages": results
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+        print("\nResults written to {}.".format(args.output))
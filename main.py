@@ -1,5 +1,14 @@
-from utils.es import *
+from utils.recommend import *
+from utils.routing import *
+from utils.storage import *
+from utils.latency import *
+from utils.preflight import *
+from utils.conflicts import *
+from utils.sampling import *
+from utils.checkpoint import *
+from utils.es_async import *
 import argparse
+import atexit
 
 program_defaults = {
     # Variables to configure the ES client:
@@ -30,7 +39,100 @@ program_defaults = {
 
     # Maximum documents to be reindexed to the new TSDB index. -1 indicates that we should reindex all documents.
     # Tip: Is reindexing too slow or encountering a timeout? Set this value.
-    "max_docs": -1
+    "max_docs": -1,
+
+    # How to find the overwritten documents:
+    # - reindex: reindex the documents to a TSDB index and check which ones were updated.
+    # - client: read the @timestamp and dimensions of the documents and look for duplicates. No index is written.
+    # - aggregation: run a composite aggregation over the dimensions and @timestamp, and keep the buckets with more
+    #   than one document. No index is written, and max_docs is ignored.
+    # - sample: check only sample_windows random windows of sample_window_seconds, and estimate the overwrite rate of
+    #   the index with a sample_confidence confidence interval. No index is written, and max_docs is ignored.
+    # - sketch: like client, but estimate the number of overwritten documents with a Bloom filter of sketch_memory_mb
+    #   MB and a HyperLogLog, so the memory used does not grow with the index. The documents are not displayed.
+    # - spill: like client, but write the @timestamp and dimensions hash of each document to partitions in spill_dir
+    #   (the temporary directory of the system if empty), and count them exactly one partition at a time.
+    "detection_mode": "reindex",
+    "sample_windows": 20,
+    "sample_window_seconds": 600,
+    "sample_confidence": 0.95,
+    "sketch_memory_mb": sketch_memory_mb,
+    "spill_dir": "",
+
+    # Run the reindex as a background task with automatic slicing, and display its progress.
+    # Tip: Use this for big indices. You can press Ctrl-C to cancel the reindex in Elasticsearch.
+    "sliced_reindex": False,
+
+    # Adapt the speed of the reindex to the load of the cluster, so it does not hurt the ingest of a cluster that is
+    # serving traffic. The reindex runs as a background task, and its requests_per_second goes down when the write or
+    # search thread pools reject requests, queue them or indexing gets slower, and goes up otherwise.
+    "adaptive_throttle": False,
+
+    # Copy the documents in checkpoint_ranges @timestamp ranges, saving the progress to checkpoint_file after each one.
+    # If the run is interrupted, run the program again with resume set to True to continue from the last range.
+    # 0 copies all documents with a single reindex.
+    "checkpoint_ranges": 0,
+    "checkpoint_file": "tsdb-migration-state.json",
+    "resume": False,
+
+    # Test every backing index of the data stream, each one in its own TSDB index. When set, docs_index is ignored.
+    # max_workers: maximum number of backing indices being reindexed at the same time.
+    # keep_tsdb_indices: keep the TSDB indices after the test. Otherwise, they are deleted at the end.
+    # Note: It is only available with the reindex detection_mode.
+    "all_backing_indices": False,
+    "max_workers": 4,
+    "keep_tsdb_indices": False,
+
+    # Keep the result of testing each rolled over backing index in a local cache, and reuse it in the next runs, as
+    # long as the index, its number of documents, the mappings and settings of the TSDB index and max_docs have not
+    # changed. The write index of the data stream is always tested.
+    # Note: It is not used with checkpoint_ranges, storage_report, latency_benchmark or use_async, nor by the sample
+    # and sketch detection_mode.
+    "result_cache": False,
+
+    # Display how the documents would be spread across the shards of the TSDB index, with its routing_path and number
+    # of shards, with each of routing_shard_counts shards, and with the routing_path without each of its fields.
+    # No index is created.
+    "analyze_routing": False,
+    "routing_shard_counts": routing_shard_counts,
+
+    # Before reindexing, look for the documents that the TSDB index would reject: dimension values that are too long,
+    # arrays or objects as dimensions, documents without routing_path values, and @timestamp outside of the time
+    # series window. If any is found, the program ends before reindexing.
+    # preflight_max_docs_per_shard: maximum number of documents checked per shard. -1 checks all documents.
+    "preflight": False,
+    "preflight_max_docs_per_shard": preflight_max_docs_per_shard,
+
+    # Run the reindex flow with the async client: independent requests are sent at the same time.
+    # Note: It requires elasticsearch[async]. It only supports the reindex detection_mode, and it cannot be combined
+    # with the options to run the reindex (like sliced_reindex or checkpoint_ranges), the reports, the profile or
+    # the result cache.
+    "use_async": False,
+
+    # Record the wall time, requests, bytes sent and received, and time spent by Elasticsearch of each stage. They
+    # are written to profile_json and, in the Prometheus textfile format, to profile_prometheus.
+    # Note: It cannot be combined with use_async.
+    "profile": False,
+    "profile_json": "tsdb-migration-profile.json",
+    "profile_prometheus": "tsdb-migration-profile.prom",
+
+    # After the documents are copied, compare the storage of the source index and the TSDB index: size per document,
+    # compression ratio, and size of the dimensions, metrics, _source and biggest fields.
+    # storage_force_merge: force merge both indices to storage_max_num_segments segments first, so their sizes are
+    # comparable. Merging is expensive, and it rewrites the segments of the source backing index. The write index of
+    # the data stream is never merged.
+    # Note: It is only available with the reindex detection_mode, and it cannot be combined with use_async.
+    "storage_report": False,
+    "storage_force_merge": False,
+    "storage_max_num_segments": storage_max_num_segments,
+
+    # After the documents are copied, compare the latency of dashboard-like queries (date histograms of the gauges,
+    # split by dimension, rate of the counters, top terms) on the source index and the TSDB index. Each query runs
+    # latency_warmup times on each index before measuring, and then latency_repetitions times.
+    # Note: It is only available with the reindex detection_mode, and it cannot be combined with use_async.
+    "latency_benchmark": False,
+    "latency_warmup": latency_warmup,
+    "latency_repetitions": latency_repetitions
 
 }
 
@@ -41,12 +143,23 @@ program_defaults |= {
     # Do you want to get in your @directory_overlapping_files the files that are overlapping?
     # Set this to True and delete the directory named directory_overlapping_files if it already exists!
     "get_overlapping_files": True,
+    # How to export the overwritten documents: "files" places one directory per set of dimensions, with one JSON
+    # file per document; "ndjson" writes a single gzip compressed NDJSON stream, @directory_overlapping_files.ndjson.gz,
+    # and an index of the sets of dimensions, @directory_overlapping_files.index.json.
+    "export_format": "files",
 
     # How many sets of dimensions do you want to print that are causing loss of data?
     # This value also indicates how many directories will be created in case get_overlapping_files is set to True.
     "display_docs": 10,
     # How many documents you want to retrieve per set of dimensions causing a loss of data?
-    "copy_docs_per_dimension": 2
+    "copy_docs_per_dimension": 2,
+
+    # Do you want to get the keyword fields that, set as dimensions, would avoid the loss of data?
+    "recommend_dimensions": False,
+
+    # Do you want to know how many overwritten documents are duplicates with the same counters and gauges, and how
+    # many have different values and lose data? All the documents are read, sorted by @timestamp.
+    "diff_metrics": False
 }
 
 
@@ -111,6 +224,131 @@ def get_cmd_arguments():
                         help="The number of documents to retrieve from the index and reindex to the TSDB one."
                              "\nDefault: " + default)
 
+    parser.add_argument('--detection_mode', action="store", dest='detection_mode',
+                        default=program_defaults["detection_mode"],
+                        choices=["reindex", "client", "aggregation", "sample", "sketch", "spill"],
+                        help="How to find the overwritten documents: 'reindex' places the documents in a TSDB index, "
+                             "'client' looks for documents with the same dimensions and timestamp without writing "
+                             "any index, 'aggregation' runs a composite aggregation over the dimensions and timestamp, "
+                             "'sample' checks random time windows and estimates the overwrite rate, 'sketch' "
+                             "estimates the overwritten documents with bounded memory, 'spill' counts them exactly "
+                             "with bounded memory, using local disk.\nDefault: " + program_defaults["detection_mode"])
+    parser.add_argument('--sample_windows', action="store", dest='sample_windows',
+                        default=program_defaults["sample_windows"],
+                        help="Number of random time windows to check with detection_mode sample."
+                             "\nDefault: " + str(program_defaults["sample_windows"]))
+    parser.add_argument('--sample_window_seconds', action="store", dest='sample_window_seconds',
+                        default=program_defaults["sample_window_seconds"],
+                        help="Size of each time window, in seconds, with detection_mode sample."
+                             "\nDefault: " + str(program_defaults["sample_window_seconds"]))
+    parser.add_argument('--sample_confidence', action="store", dest='sample_confidence',
+                        default=program_defaults["sample_confidence"],
+                        help="Confidence level of the estimated overwrite rate with detection_mode sample."
+                             "\nDefault: " + str(program_defaults["sample_confidence"]))
+    parser.add_argument('--sketch_memory_mb', action="store", dest='sketch_memory_mb',
+                        default=program_defaults["sketch_memory_mb"],
+                        help="Size of the Bloom filter, in MB, with detection_mode sketch."
+                             "\nDefault: " + str(program_defaults["sketch_memory_mb"]))
+    parser.add_argument('--spill_dir', action="store", dest='spill_dir', default=program_defaults["spill_dir"],
+                        help="Directory of the partitions with detection_mode spill. If empty, the temporary "
+                             "directory of the system is used.\nDefault: " + program_defaults["spill_dir"])
+
+    parser.add_argument('--sliced_reindex', action="store_true", dest='sliced_reindex',
+                        default=program_defaults["sliced_reindex"],
+                        help="Run the reindex as a background task with automatic slicing, display its progress and "
+                             "cancel it on Ctrl-C.\nDefault: " + str(program_defaults["sliced_reindex"]))
+
+    parser.add_argument('--adaptive_throttle', action="store_true", dest='adaptive_throttle',
+                        default=program_defaults["adaptive_throttle"],
+                        help="Run the reindex as a background task and adapt its requests per second to the load of "
+                             "the cluster.\nDefault: " + str(program_defaults["adaptive_throttle"]))
+
+    parser.add_argument('--checkpoint_ranges', action="store", dest='checkpoint_ranges',
+                        default=program_defaults["checkpoint_ranges"],
+                        help="Number of @timestamp ranges to copy the documents in, saving the progress after each "
+                             "one. 0 copies all documents with a single reindex."
+                             "\nDefault: " + str(program_defaults["checkpoint_ranges"]))
+    parser.add_argument('--checkpoint_file', action="store", dest='checkpoint_file',
+                        default=program_defaults["checkpoint_file"],
+                        help="Path to the file with the progress of the run.\nDefault: "
+                             + program_defaults["checkpoint_file"])
+    parser.add_argument('--resume', action="store_true", dest='resume', default=program_defaults["resume"],
+                        help="Continue an interrupted run from the checkpoint file, instead of starting again."
+                             "\nDefault: " + str(program_defaults["resume"]))
+    parser.add_argument('--all_backing_indices', action="store_true", dest='all_backing_indices',
+                        default=program_defaults["all_backing_indices"],
+                        help="Test every backing index of the data stream concurrently, each one in its own TSDB index,"
+                             " and display an overwrite report per index. docs_index is ignored."
+                             "\nDefault: " + str(program_defaults["all_backing_indices"]))
+    parser.add_argument('--max_workers', action="store", dest='max_workers', default=program_defaults["max_workers"],
+                        help="Maximum number of backing indices being reindexed at the same time."
+                             "\nDefault: " + str(program_defaults["max_workers"]))
+    parser.add_argument('--keep_tsdb_indices', action="store_true", dest='keep_tsdb_indices',
+                        default=program_defaults["keep_tsdb_indices"],
+                        help="Keep the TSDB indices created by all_backing_indices after the test."
+                             "\nDefault: " + str(program_defaults["keep_tsdb_indices"]))
+    parser.add_argument('--result_cache', action="store_true", dest='result_cache',
+                        default=program_defaults["result_cache"],
+                        help="Reuse the results of previous runs for the rolled over backing indices."
+                             "\nDefault: " + str(program_defaults["result_cache"]))
+    parser.add_argument('--analyze_routing', action="store_true", dest='analyze_routing',
+                        default=program_defaults["analyze_routing"],
+                        help="Display how the documents would be spread across the shards of the TSDB index, for other "
+                             "numbers of shards and routing paths as well. No index is created."
+                             "\nDefault: " + str(program_defaults["analyze_routing"]))
+    parser.add_argument('--routing_shard_counts', action="store", dest='routing_shard_counts', nargs="+",
+                        default=program_defaults["routing_shard_counts"],
+                        help="Numbers of shards to compare when analyzing the routing.\nDefault: "
+                             + " ".join(str(count) for count in program_defaults["routing_shard_counts"]))
+    parser.add_argument('--preflight', action="store_true", dest='preflight', default=program_defaults["preflight"],
+                        help="Look for the documents that the TSDB index would reject before reindexing, and end the "
+                             "program if there is any.\nDefault: " + str(program_defaults["preflight"]))
+    parser.add_argument('--preflight_max_docs_per_shard', action="store", dest='preflight_max_docs_per_shard',
+                        default=program_defaults["preflight_max_docs_per_shard"],
+                        help="Maximum number of documents checked per shard by the preflight checks. -1 checks all "
+                             "documents.\nDefault: " + str(program_defaults["preflight_max_docs_per_shard"]))
+
+    parser.add_argument('--use_async', action="store_true", dest='use_async', default=program_defaults["use_async"],
+                        help="Run the reindex flow with the async client, sending independent requests at the same "
+                             "time.\nDefault: " + str(program_defaults["use_async"]))
+
+    parser.add_argument('--profile', action="store_true", dest='profile', default=program_defaults["profile"],
+                        help="Record the time, requests, bytes and Elasticsearch time of each stage."
+                             "\nDefault: " + str(program_defaults["profile"]))
+    parser.add_argument('--profile_json', action="store", dest='profile_json',
+                        default=program_defaults["profile_json"],
+                        help="Path to the JSON file with the profile.\nDefault: " + program_defaults["profile_json"])
+    parser.add_argument('--profile_prometheus', action="store", dest='profile_prometheus',
+                        default=program_defaults["profile_prometheus"],
+                        help="Path to the Prometheus textfile with the profile.\nDefault: "
+                             + program_defaults["profile_prometheus"])
+
+    parser.add_argument('--storage_report', action="store_true", dest='storage_report',
+                        default=program_defaults["storage_report"],
+                        help="Compare the storage of the source index and the TSDB index after copying the documents."
+                             "\nDefault: " + str(program_defaults["storage_report"]))
+    parser.add_argument('--storage_force_merge', action="store_true", dest='storage_force_merge',
+                        default=program_defaults["storage_force_merge"],
+                        help="Force merge both indices before comparing their storage. It rewrites the segments of "
+                             "the source backing index.\nDefault: " + str(program_defaults["storage_force_merge"]))
+    parser.add_argument('--storage_max_num_segments', action="store", dest='storage_max_num_segments',
+                        default=program_defaults["storage_max_num_segments"],
+                        help="Number of segments of each index after the force merge.\nDefault: "
+                             + str(program_defaults["storage_max_num_segments"]))
+
+    parser.add_argument('--latency_benchmark', action="store_true", dest='latency_benchmark',
+                        default=program_defaults["latency_benchmark"],
+                        help="Compare the latency of dashboard-like queries on the source index and the TSDB index "
+                             "after copying the documents.\nDefault: " + str(program_defaults["latency_benchmark"]))
+    parser.add_argument('--latency_warmup', action="store", dest='latency_warmup',
+                        default=program_defaults["latency_warmup"],
+                        help="Number of runs of each query on each index before measuring.\nDefault: "
+                             + str(program_defaults["latency_warmup"]))
+    parser.add_argument('--latency_repetitions', action="store", dest='latency_repetitions',
+                        default=program_defaults["latency_repetitions"],
+                        help="Number of measured runs of each query on each index.\nDefault: "
+                             + str(program_defaults["latency_repetitions"]))
+
     # Overlapping files configuration
     parser.add_argument('--get_overlapping_files', action="store", dest='get_overlapping_files',
                         default=program_defaults["get_overlapping_files"],
@@ -120,6 +358,10 @@ def get_cmd_arguments():
                         default=program_defaults["directory_overlapping_files"],
                         help="The directory path to place the overwritten documents.\nDefault: "
                              + program_defaults["directory_overlapping_files"])
+    parser.add_argument('--export_format', action="store", dest='export_format', choices=export_formats,
+                        default=program_defaults["export_format"],
+                        help="Format to export the overwritten documents: one file per document, or a single "
+                             "compressed NDJSON stream.\nDefault: " + program_defaults["export_format"])
     parser.add_argument('--display_docs', action="store", dest='display_docs',
                         default=program_defaults["display_docs"],
                         help="Number of documents overlapping used to display the dimensions."
@@ -129,6 +371,15 @@ def get_cmd_arguments():
                         help="Number of documents to retrieve per set of dimensions that caused loss of data."
                              "\nDefault: " + str(program_defaults["copy_docs_per_dimension"]))
 
+    parser.add_argument('--recommend_dimensions', action="store_true", dest='recommend_dimensions',
+                        default=program_defaults["recommend_dimensions"],
+                        help="Look for the smallest set of keyword fields that, set as dimensions, would avoid the "
+                             "loss of data.\nDefault: " + str(program_defaults["recommend_dimensions"]))
+    parser.add_argument('--diff_metrics', action="store_true", dest='diff_metrics',
+                        default=program_defaults["diff_metrics"],
+                        help="Compare the metrics of the documents that overwrite each other, to tell the duplicates "
+                             "apart from the loss of data.\nDefault: " + str(program_defaults["diff_metrics"]))
+
     args, unknown = parser.parse_known_args()
     if len(unknown) > 0:
         parser.print_help()
@@ -138,6 +389,145 @@ def get_cmd_arguments():
     return args
 
 
+def check_arguments(args):
+    """
+    Check that the command line arguments can be used together.
+    :param args: command line arguments.
+    """
+    if args.all_backing_indices and args.detection_mode != "reindex":
+        raise MigrationError("all_backing_indices is only available with the reindex detection_mode.")
+    if args.use_async:
+        # The async flow only creates the TSDB index, copies the documents and displays the overwritten ones
+        unsupported = [name for name in ["sliced_reindex", "adaptive_throttle", "resume", "all_backing_indices",
+                                         "keep_tsdb_indices", "result_cache", "analyze_routing", "preflight",
+                                         "profile", "storage_report", "latency_benchmark", "recommend_dimensions",
+                                         "diff_metrics"] if getattr(args, name)]
+        if args.detection_mode != "reindex":
+            unsupported.append("detection_mode")
+        if int(args.checkpoint_ranges) > 0:
+            unsupported.append("checkpoint_ranges")
+        if len(unsupported) > 0:
+            raise MigrationError("use_async cannot be combined with {}.".format(", ".join(unsupported)))
+
+
+def test_migration(args):
+    """
+    Run the migration test with the values of the command line arguments.
+    :param args: command line arguments.
+    """
+    check_arguments(args)
+
+    if args.use_async:
+        # Create TSDB index, place documents and get overwritten documents information with the async client
+        async_client = get_async_client(args.elasticsearch_host, args.elasticsearch_ca_path, args.elasticsearch_user,
+                                        args.elasticsearch_pwd, args.cloud_id, args.cloud_pwd)
+        asyncio.run(test_data_stream_async(async_client, args.data_stream, int(args.docs_index),
+                                           int(args.settings_mappings_index), int(args.max_docs),
+                                           int(args.display_docs), args.directory_overlapping_files,
+                                           bool(args.get_overlapping_files), int(args.copy_docs_per_dimension),
+                                           args.export_format))
+        return
+
+    # Create the client instance
+    client = get_client(args.elasticsearch_host, args.elasticsearch_ca_path, args.elasticsearch_user,
+                        args.elasticsearch_pwd, args.cloud_id, args.cloud_pwd)
+    info = client.info()
+    print("You're testing with version {}.\n".format(info["version"]["number"]))
+
+    if args.profile:
+        # The profile is written when the program ends, even if it ends early
+        start_profile(client)
+        atexit.register(write_profile, args.profile_json, args.profile_prometheus,
+                        {"cluster": info["cluster_name"], "data_stream": args.data_stream,
+                         "detection_mode": args.detection_mode})
+
+    if args.analyze_routing:
+        # Display the spread of the documents across the shards, without creating the TSDB index
+        analyze_routing(client, args.data_stream, int(args.docs_index), int(args.settings_mappings_index),
+                        [int(count) for count in args.routing_shard_counts])
+        return
+
+    if args.all_backing_indices:
+        # Create one TSDB index per backing index and display the overwrite report
+        with migration_session(client, args.keep_tsdb_indices) as session:
+            copy_all_backing_indices(client, args.data_stream, int(args.settings_mappings_index),
+                                     int(args.max_docs), int(args.max_workers), session, args.result_cache,
+                                     args.sliced_reindex, args.adaptive_throttle)
+        return
+
+    if args.detection_mode in ["client", "aggregation", "sample", "sketch", "spill"]:
+        # Find the overwritten documents without creating the TSDB index
+        if args.detection_mode == "sample":
+            overwritten_docs, time_series_fields = sample_data_stream(client, args.data_stream, int(args.docs_index),
+                                                                      int(args.settings_mappings_index),
+                                                                      int(args.sample_windows),
+                                                                      int(args.sample_window_seconds),
+                                                                      float(args.sample_confidence))
+        else:
+            overwritten_docs, time_series_fields = find_overwritten_docs(client, args.data_stream,
+                                                                         int(args.docs_index),
+                                                                         int(args.settings_mappings_index),
+                                                                         int(args.max_docs), args.detection_mode,
+                                                                         args.result_cache,
+                                                                         int(args.sketch_memory_mb),
+                                                                         args.spill_dir or None)
+        if len(overwritten_docs) > 0:
+            get_missing_docs_info(client, args.data_stream, time_series_fields["dimension"], int(args.display_docs),
+                                  args.directory_overlapping_files, bool(args.get_overlapping_files),
+                                  int(args.copy_docs_per_dimension), overwritten_docs, args.export_format)
+            if args.recommend_dimensions:
+                display_dimension_recommendations(client, args.data_stream, time_series_fields["dimension"],
+                                                  overwritten_docs)
+            if args.diff_metrics:
+                diff_collision_groups(client, args.data_stream, int(args.docs_index),
+                                      int(args.settings_mappings_index), int(args.max_docs))
+        return
+
+    if args.preflight:
+        if not preflight_check(client, args.data_stream, int(args.docs_index), int(args.settings_mappings_index),
+                               int(args.preflight_max_docs_per_shard)):
+            raise MigrationError("Some documents would be rejected by the TSDB index. Reindex will not start.")
+
+    # Create TSDB index and place documents
+    if int(args.checkpoint_ranges) > 0 or args.resume:
+        all_placed, time_series_fields, tsdb_indices = copy_from_data_stream_resumable(
+            client, args.data_stream, int(args.docs_index), int(args.settings_mappings_index), int(args.max_docs),
+            int(args.checkpoint_ranges), args.checkpoint_file, args.resume, args.sliced_reindex,
+            args.adaptive_throttle)
+    else:
+        tsdb_indices = None
+        all_placed, time_series_fields = copy_from_data_stream(client, args.data_stream, int(args.docs_index),
+                                                               int(args.settings_mappings_index), int(args.max_docs),
+                                                               args.sliced_reindex,
+                                                               adaptive_throttle=args.adaptive_throttle,
+                                                               # The reports need the TSDB index
+                                                               use_cache=args.result_cache and not (
+                                                                   args.storage_report or args.latency_benchmark))
+
+    # With checkpoint ranges, the documents are spread over several TSDB indices, and the reports measure all of them
+    dest_index = tsdb_index if tsdb_indices is None else ",".join(tsdb_indices)
+    if args.storage_report:
+        report_storage(client, args.data_stream, int(args.docs_index), dest_index, time_series_fields,
+                       args.storage_force_merge, int(args.storage_max_num_segments))
+    if args.latency_benchmark:
+        benchmark_query_latency(client, args.data_stream, int(args.docs_index), dest_index, time_series_fields,
+                                int(args.latency_warmup), int(args.latency_repetitions))
+
+    # Get overwritten documents information
+    if not all_placed:
+        print("Overwritten documents will be placed in new index.")
+        create_index_missing_for_docs(client, args.sliced_reindex, args.adaptive_throttle,
+                                      source_indices=tsdb_indices)
+        get_missing_docs_info(client, args.data_stream, time_series_fields["dimension"], int(args.display_docs),
+                              args.directory_overlapping_files, bool(args.get_overlapping_files),
+                              int(args.copy_docs_per_dimension), export_format=args.export_format)
+        if args.recommend_dimensions:
+            display_dimension_recommendations(client, args.data_stream, time_series_fields["dimension"])
+        if args.diff_metrics:
+            diff_collision_groups(client, args.data_stream, int(args.docs_index), int(args.settings_mappings_index),
+                                  int(args.max_docs))
+
+
 if __name__ == '__main__':
     args = get_cmd_arguments()
 
@@ -163,19 +553,7 @@ if __name__ == '__main__':
 
     print()
 
-    # Create the client instance
-    client = get_client(args.elasticsearch_host, args.elasticsearch_ca_path, args.elasticsearch_user,
-                        args.elasticsearch_pwd, args.cloud_id, args.cloud_pwd)
-    print("You're testing with version {}.\n".format(client.info()["version"]["number"]))
-
-    # Create TSDB index and place documents
-    all_placed = copy_from_data_stream(client, args.data_stream, int(args.docs_index), int(args.settings_mappings_index),
-                                       int(args.max_docs))
-
-    # Get overwritten documents information
-    if not all_placed:
-        print("Overwritten documents will be placed in new index.")
-        create_index_missing_for_docs(client)
-        get_missing_docs_info(client, args.data_stream, int(args.display_docs), args.directory_overlapping_files,
-                              bool(args.get_overlapping_files), int(args.copy_docs_per_dimension))
-
+    try:
+        test_migration(args)
+    except MigrationError as e:
+        print("ERROR: {} Program will end.".format(e))
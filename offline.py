@@ -0,0 +1,78 @@
+from utils.offline import *
+import argparse
+
+program_defaults = {
+    # NDJSON files (one document or search hit per line, optionally compressed with gzip), or folders with them.
+    # Usually, these are exports of the backing indices of a data stream.
+    "files": ["export"],
+
+    # JSON file with the mappings of the TSDB index: an index template, the response of the get mapping API or just
+    # the mappings. The dimensions are taken from it.
+    "mappings": "index-template.json",
+
+    # Number of processes reading the files. Defaults to the number of cores.
+    "processes": os.cpu_count() or 1,
+
+    # Same as in main.py.
+    "directory_overlapping_files": "overwritten-docs-offline",
+    "get_overlapping_files": True,
+    "export_format": "files",
+    "display_docs": 10,
+    "copy_docs_per_dimension": 2
+}
+
+
+def get_cmd_arguments():
+    parser = argparse.ArgumentParser(description='Find the documents that would be overwritten in a TSDB index, '
+                                                 'from exported files.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--files', action="store", dest='files', nargs="+", default=program_defaults["files"],
+                        help="NDJSON files (optionally compressed with gzip) or folders with them.\nDefault: "
+                             + " ".join(program_defaults["files"]))
+    parser.add_argument('--mappings', action="store", dest='mappings', default=program_defaults["mappings"],
+                        help="JSON file with the index template or the mappings of the TSDB index.\nDefault: "
+                             + program_defaults["mappings"])
+    parser.add_argument('--processes', action="store", dest='processes', default=program_defaults["processes"],
+                        help="Number of processes reading the files.\nDefault: " + str(program_defaults["processes"]))
+
+    # Overlapping files configuration
+    parser.add_argument('--get_overlapping_files', action="store", dest='get_overlapping_files',
+                        default=program_defaults["get_overlapping_files"],
+                        help="Flag to place the overwritten documents: documents will be placed if True, otherwise"
+                             " if False.\nDefault: " + str(program_defaults["get_overlapping_files"]))
+    parser.add_argument('--directory_overlapping_files', action="store", dest='directory_overlapping_files',
+                        default=program_defaults["directory_overlapping_files"],
+                        help="The directory path to place the overwritten documents.\nDefault: "
+                             + program_defaults["directory_overlapping_files"])
+    parser.add_argument('--export_format', action="store", dest='export_format', choices=export_formats,
+                        default=program_defaults["export_format"],
+                        help="Format to export the overwritten documents: one file per document, or a single "
+                             "compressed NDJSON stream.\nDefault: " + program_defaults["export_format"])
+    parser.add_argument('--display_docs', action="store", dest='display_docs',
+                        default=program_defaults["display_docs"],
+                        help="Number of documents overlapping used to display the dimensions."
+                             "\nDefault: " + str(program_defaults["display_docs"]))
+    parser.add_argument('--copy_docs_per_dimension', action="store", dest='copy_docs_per_dimension',
+                        default=program_defaults["copy_docs_per_dimension"],
+                        help="Number of documents to place per set of dimensions that caused loss of data."
+                             "\nDefault: " + str(program_defaults["copy_docs_per_dimension"]))
+
+    args, unknown = parser.parse_known_args()
+    if len(unknown) > 0:
+        parser.print_help()
+        print("\nUser provided unknown flags:", unknown)
+        print("Program will end.")
+        exit(0)
+    return args
+
+
+if __name__ == '__main__':
+    args = get_cmd_arguments()
+
+    try:
+        analyze_files(args.files, args.mappings, int(args.processes), int(args.display_docs),
+                      args.directory_overlapping_files, args.get_overlapping_files in [True, "True", "true"],
+                      int(args.copy_docs_per_dimension), args.export_format)
+    except MigrationError as e:
+        print("ERROR: {} Program will end.".format(e))
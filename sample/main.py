@@ -63,7 +63,10 @@ def prepare_set_up(client: Elasticsearch, data_stream_name: str, index_template_
     print("Ready to start.\n")
 
 
-if __name__ == '__main__':
+def run_sample():
+    """
+    Create the sample data stream, place the sample documents and test the migration of the data stream.
+    """
     # Create the client instance
     client = get_client(elasticsearch_host, elasticsearch_ca_path, elasticsearch_user, elasticsearch_pwd, "", "")
     print("You're testing with version {}.\n".format(client.info()["version"]["number"]))
@@ -76,9 +79,16 @@ if __name__ == '__main__':
     # Now we copy all documents from the folder @documents_path to the data_stream @data_stream_name
     place_documents(client, data_stream_name, documents_path)
 
-    all_placed = copy_from_data_stream(client, data_stream_name, -1, -1, -1)
+    all_placed, time_series_fields = copy_from_data_stream(client, data_stream_name, -1, -1, -1)
 
     if not all_placed:
         print("Overwritten documents will be placed in new index.")
         create_index_missing_for_docs(client)
-        get_missing_docs_info(client, data_stream_name, 10, "", False, 0)
+        get_missing_docs_info(client, data_stream_name, time_series_fields["dimension"], 10, "", False, 0)
+
+
+if __name__ == '__main__':
+    try:
+        run_sample()
+    except MigrationError as e:
+        print("ERROR: {} Program will end.".format(e))
@@ -0,0 +1,112 @@
+"""
+All functions to test many data streams in a single run are placed here.
+"""
+
+from datetime import datetime, timezone
+
+from elasticsearch import NotFoundError
+
+from utils.es import *
+
+
+def resolve_data_streams(client: Elasticsearch, patterns: []):
+    """
+    Get the names of all data streams matching the patterns.
+    A name that does not exist is recorded as a failed entry of the report, and does not stop the others.
+    :param client: ES client.
+    :param patterns: data stream names or wildcard patterns, like metrics-*.
+    :return: sorted list of data stream names, and the result for the report of each name that does not exist.
+    """
+    names = set()
+    failed = []
+    for pattern in patterns:
+        try:
+            data_streams = client.indices.get_data_stream(name=pattern, expand_wildcards="all")
+        except NotFoundError as e:
+            print("ERROR: Data stream {} could not be tested: {}".format(pattern, e))
+            failed.append({"data_stream": pattern, "status": "error", "error": str(e)})
+            continue
+        for data_stream in data_streams["data_streams"]:
+            names.add(data_stream["name"])
+    return sorted(names), failed
+
+
+def test_data_stream(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int,
+                     max_docs: int, keep_tsdb_index: bool):
+    """
+    Copy the documents of a data stream to its own TSDB index and count the overwritten documents.
+    Each test runs in its own session, so the TSDB index has a unique name.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be reindexed.
+    :param keep_tsdb_index: true to keep the TSDB index after the test, false to delete it.
+    :return: result of the test for the report.
+    """
+    source_index, mappings, settings, _ = get_tsdb_config(client, data_stream_name, docs_index,
+                                                          settings_mappings_index)
+    with migration_session(client, keep_tsdb_index) as session:
+        tsdb_index_name = session["tsdb_index"]
+        create_index(client, tsdb_index_name, mappings, settings, session)
+        resp = reindex(client, {"index": source_index}, {"index": tsdb_index_name}, max_docs)
+    print("{}: {} out of {} documents were overwritten.".format(data_stream_name, resp["updated"], resp["total"]))
+    return {
+        "data_stream": data_stream_name,
+        "status": "ok",
+        "source_index": source_index,
+        "tsdb_index": tsdb_index_name if keep_tsdb_index else None,
+        "total": resp["total"],
+        "overwritten": resp["updated"],
+        "overwrite_rate": resp["updated"] / resp["total"] if resp["total"] > 0 else 0.0
+    }
+
+
+def run_batch(client: Elasticsearch, patterns: [], docs_index: int, settings_mappings_index: int, max_docs: int,
+              concurrency: int, keep_tsdb_indices: bool, report_path: str):
+    """
+    Test every data stream matching the patterns and write a report ranking them by overwrite rate.
+    A failure in one data stream is recorded in the report, and does not stop the others.
+    :param client: ES client. It is shared by all the threads.
+    :param patterns: data stream names or wildcard patterns.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be reindexed per data stream.
+    :param concurrency: maximum number of data streams being tested at the same time.
+    :param keep_tsdb_indices: true to keep the TSDB indices after the test, false to delete them.
+    :param report_path: path to the JSON report.
+    :return: the report.
+    """
+    data_streams, results = resolve_data_streams(client, patterns)
+    print("Testing {} data streams ({} at a time).\n".format(len(data_streams), concurrency))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {data_stream: executor.submit(test_data_stream, client, data_stream, docs_index,
+                                                settings_mappings_index, max_docs, keep_tsdb_indices)
+                   for data_stream in data_streams}
+
+    for data_stream, future in futures.items():
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = str(e)
+            print("ERROR: Data stream {} could not be tested: {}".format(data_stream, error))
+            results.append({"data_stream": data_stream, "status": "error", "error": error})
+
+    # Highest overwrite rate first, and data streams that failed at the end
+    results.sort(key=lambda result: (result["status"] != "ok", -result.get("overwrite_rate", 0)))
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "patterns": patterns,
+        "max_docs": max_docs,
+        "data_streams": results
+    }
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    n_failed = len([result for result in results if result["status"] != "ok"])
+    n_overwritten = len([result for result in results if result.get("overwritten", 0) > 0])
+    print("\n{} data streams tested: {} with overwritten documents, {} failed.".format(len(results), n_overwritten,
+                                                                                      n_failed))
+    print("Report written to {}.".format(report_path))
+    return report
@@ -0,0 +1,81 @@
+"""
+All functions to reuse the results of previous runs are placed here.
+Once a backing index rolls over, its documents do not change, so testing it again gives the same result. The results
+are kept in cache_dir, keyed by the UUID and number of documents of the source index, the mappings and settings of the
+TSDB index, max_docs and the way the overwritten documents are found. The write index of a data stream is never
+cached, since it still gets new documents.
+"""
+
+from elasticsearch import Elasticsearch
+
+import json
+import os
+import threading
+
+from utils.tsdb import *
+
+
+def get_result_key(client: Elasticsearch, data_stream_name: str, source_index: str, mappings: {}, settings: {},
+                   max_docs: int, detection_mode: str):
+    """
+    Get the key of the result of testing an index.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param source_index: name of the index with the documents.
+    :param mappings: mappings of the TSDB index.
+    :param settings: settings of the TSDB index.
+    :param max_docs: maximum documents to be tested.
+    :param detection_mode: how the overwritten documents are found.
+    :return: key of the result, or None if the result cannot be cached because @source_index is the write index.
+    """
+    data_stream = client.indices.get_data_stream(name=data_stream_name)["data_streams"][0]
+    if source_index == data_stream["indices"][-1]["index_name"]:
+        return None
+    uuid = client.indices.get_settings(index=source_index)[source_index]["settings"]["index"]["uuid"]
+    n_docs = client.count(index=source_index)["count"]
+    return get_mappings_hash({
+        "uuid": uuid,
+        "docs": n_docs,
+        "mappings": mappings,
+        "settings": settings,
+        "max_docs": max_docs,
+        "detection_mode": detection_mode
+    })
+
+
+def get_result_path(key: str):
+    """
+    Get the path of the file with a cached result.
+    :param key: key of the result.
+    :return: path to the file.
+    """
+    return os.path.join(cache_dir, "result-" + key + ".json")
+
+
+def load_result(key: str):
+    """
+    Get a result of a previous run.
+    :param key: key of the result, as returned by get_result_key. Nothing is loaded if it is None.
+    :return: the result, or None if it is not cached.
+    """
+    if key is None or not os.path.isfile(get_result_path(key)):
+        return None
+    with open(get_result_path(key)) as file:
+        return json.load(file)
+
+
+def save_result(key: str, result: {}):
+    """
+    Keep a result for the next runs.
+    :param key: key of the result, as returned by get_result_key. Nothing is saved if it is None.
+    :param result: result of the test.
+    """
+    if key is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_result_path(key)
+    # Runs in other processes or threads could be writing the same file
+    tmp_path = path + "." + str(os.getpid()) + "-" + str(threading.get_ident()) + ".tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(result, file, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,227 @@
+"""
+All functions to run a resumable migration test are placed here.
+The documents are copied to the TSDB index in @timestamp ranges. After each range, the progress is saved to a
+local state file, so an interrupted run can continue from the last range that finished.
+A range that was interrupted is copied again to a new index of its own. Deleting its documents and copying them
+again to the same index would not work: documents created again after a delete get a higher _version, so they
+would be reported as overwritten.
+"""
+
+from elasticsearch import NotFoundError
+
+from utils.sampling import *
+
+
+def save_state(state: {}, state_path: str):
+    """
+    Save the state of the run. The file is replaced atomically, so it is never left half written.
+    :param state: state of the run.
+    :param state_path: path to the state file.
+    """
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=4)
+    os.replace(tmp_path, state_path)
+
+
+def load_state(state_path: str):
+    """
+    Load the state of a previous run.
+    :param state_path: path to the state file.
+    :return: state of the run.
+    """
+    if not os.path.isfile(state_path):
+        raise MigrationError("State file {} does not exist. Nothing to resume.".format(state_path))
+    with open(state_path) as file:
+        return json.load(file)
+
+
+def get_ranges(client: Elasticsearch, index_name: str, n_ranges: int):
+    """
+    Split the @timestamp span of an index in ranges of the same size.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param n_ranges: number of ranges.
+    :return: list of [start, end) ranges, in milliseconds.
+    """
+    first, last, n_docs = get_timestamp_range(client, index_name)
+    if n_docs == 0:
+        return []
+    size = max(1, (last - first + 1) // n_ranges + 1)
+    return [[start, min(start + size, last + 1)] for start in range(first, last + 1, size)]
+
+
+def get_range_query(timestamp_range: []):
+    """
+    Build query to retrieve the documents of a @timestamp range.
+    :param timestamp_range: [start, end) range, in milliseconds.
+    :return: query.
+    """
+    return {"range": {"@timestamp": {"gte": timestamp_range[0], "lt": timestamp_range[1], "format": "epoch_millis"}}}
+
+
+def cancel_interrupted_task(client: Elasticsearch, task_id: str):
+    """
+    Cancel the reindex task of an interrupted run and wait until it stops, so it does not place more documents
+    while its range is copied again. A sliced task is cancelled with all its slices.
+    :param client: ES client.
+    :param task_id: ID of the reindex task.
+    """
+    try:
+        client.tasks.cancel(task_id=task_id)
+        while not client.tasks.get(task_id=task_id)["completed"]:
+            time.sleep(task_poll_interval)
+    except NotFoundError:
+        # The task finished and its result was not kept
+        return
+    print("\tReindex task {} of the interrupted run was cancelled.".format(task_id))
+
+
+def get_range_index(dest_index: str, n: int):
+    """
+    Get the name of the index to copy again a range that was interrupted.
+    :param dest_index: name of the TSDB index.
+    :param n: number of the range.
+    :return: name of the index.
+    """
+    return "{}-range-{}".format(dest_index, n)
+
+
+@profile_stage("copy_docs_in_ranges")
+def copy_docs_in_ranges(client: Elasticsearch, state: {}, state_path: str, mappings: {}, settings: {},
+                        sliced_reindex: bool = False, adaptive_throttle: bool = False, session: {} = None):
+    """
+    Copy the documents of every range that did not finish yet, saving the progress after each one.
+    Each reindex runs as a background task, and its ID is saved, so a later run can cancel it if the program stops.
+    If a range was interrupted, the documents it placed are deleted, and it is copied again to a new index, so it is
+    counted only once, and the created and updated documents of the range come from that index only.
+    With max_docs, each range copies the documents left, so the documents copied are not the same ones that a single
+    reindex of max_docs documents would copy.
+    :param client: ES client.
+    :param state: state of the run.
+    :param state_path: path to the state file.
+    :param mappings: mappings of the TSDB index, for the indices of the interrupted ranges.
+    :param settings: settings of the TSDB index, for the indices of the interrupted ranges.
+    :param sliced_reindex: true to run each reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of each reindex to the load of the cluster, false otherwise.
+    :param session: state of the run, to delete the indices of the interrupted ranges when it is closed.
+    :return: True if the number of documents is the same in the new index as it was in the old index; and the
+    indices with the documents, the TSDB index first.
+    """
+    source_index = state["source_index"]
+    dest_index = state["dest_index"]
+    print("Copying documents from {} to {} in {} ranges ({} already finished)...".format(
+        source_index, dest_index, len(state["ranges"]), len(state["completed"])))
+
+    def save_task(task_id: str):
+        state["task"] = task_id
+        save_state(state, state_path)
+
+    for n, timestamp_range in enumerate(state["ranges"]):
+        if n in state["completed"]:
+            continue
+        query = get_range_query(timestamp_range)
+        range_index = dest_index
+        if state["in_progress"] == n:
+            range_index = get_range_index(dest_index, n)
+            print("\tRange {} was interrupted. Deleting its documents from {} and copying it to {}.".format(
+                n + 1, dest_index, range_index))
+            client.delete_by_query(index=dest_index, query=query, refresh=True, conflicts="proceed")
+            # The index of a range interrupted twice is created again
+            create_index(client, range_index, mappings, settings, session)
+            state["range_indices"][str(n)] = range_index
+
+        max_docs = -1
+        if state["max_docs"] != -1:
+            max_docs = state["max_docs"] - state["total"]
+            if max_docs <= 0:
+                break
+        state["in_progress"] = n
+        save_state(state, state_path)
+
+        resp = reindex(client, {"index": source_index, "query": query}, {"index": range_index}, max_docs,
+                       sliced_reindex, adaptive_throttle, save_task)
+        state["results"][str(n)] = {"index": range_index, "total": resp["total"], "created": resp["created"],
+                                    "updated": resp["updated"]}
+        state["total"] += resp["total"]
+        state["created"] += resp["created"]
+        state["updated"] += resp["updated"]
+        state["completed"].append(n)
+        state["in_progress"] = None
+        state["task"] = None
+        save_state(state, state_path)
+        print("\tRange {}/{} finished: {} documents, {} updated.".format(n + 1, len(state["ranges"]),
+                                                                          resp["total"], resp["updated"]))
+
+    all_placed = display_reindex_result(state, source_index, dest_index)
+    os.remove(state_path)
+    return all_placed, [dest_index] + sorted(set(state["range_indices"].values()))
+
+
+def copy_from_data_stream_resumable(client: Elasticsearch, data_stream_name: str, docs_index: int,
+                                    settings_mappings_index: int, max_docs: int, n_ranges: int, state_path: str,
+                                    resume: bool, sliced_reindex: bool = False, adaptive_throttle: bool = False,
+                                    session: {} = None):
+    """
+    Same as copy_from_data_stream, but the documents are copied in @timestamp ranges and the progress is saved to
+    a state file. If @resume is True, the TSDB index is not created again and the run continues from the state file.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be reindexed.
+    :param n_ranges: number of @timestamp ranges.
+    :param state_path: path to the state file.
+    :param resume: true to continue the run saved in the state file, false to start a new one.
+    :param sliced_reindex: true to run each reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of each reindex to the load of the cluster, false otherwise.
+    :param session: state of the run, with the name of the index with TSDB enabled. If not specified, the default
+    name is used. A resumed run keeps the index of the state file.
+    :return: True if the number of documents placed to the TSDB index remained the same, False otherwise; the
+    time series fields of the TSDB index; and the indices with the documents (the TSDB index, and one index per
+    range that was interrupted).
+    """
+    print("Testing data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+
+    if resume:
+        state = load_state(state_path)
+        if state["source_index"] != source_index or state["max_docs"] != max_docs:
+            raise MigrationError("State file {} is for index {} with max_docs {}. It cannot be resumed for index {} "
+                                 "with max_docs {}.".format(state_path, state["source_index"], state["max_docs"],
+                                                            source_index, max_docs))
+        if not client.indices.exists(index=state["dest_index"]):
+            raise MigrationError("Index {} does not exist. Run will not be resumed.".format(state["dest_index"]))
+        print("Resuming run from state file {}.".format(state_path))
+        if state["task"] is not None:
+            cancel_interrupted_task(client, state["task"])
+            state["task"] = None
+    else:
+        session = get_session(session)
+        create_index(client, session["tsdb_index"], mappings, settings, session)
+        state = {
+            "source_index": source_index,
+            "dest_index": session["tsdb_index"],
+            "max_docs": max_docs,
+            "ranges": get_ranges(client, source_index, n_ranges),
+            "completed": [],
+            "in_progress": None,
+            # Reindex task of the range in progress
+            "task": None,
+            # Index of each range copied again after an interruption, and result of each range
+            "range_indices": {},
+            "results": {},
+            "total": 0,
+            "created": 0,
+            "updated": 0
+        }
+        save_state(state, state_path)
+
+    all_placed, indices = copy_docs_in_ranges(client, state, state_path, mappings, settings, sliced_reindex,
+                                              adaptive_throttle, session)
+    return all_placed, time_series_fields, indices
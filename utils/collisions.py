@@ -0,0 +1,473 @@
+"""
+All functions to find the overwritten documents on the client side are placed here.
+Instead of reindexing the documents to a TSDB index, these functions read the documents and look for
+the ones that would end up with the same _id in a TSDB index (ie, same dimensions and same @timestamp).
+"""
+
+from array import array
+from datetime import datetime, timezone
+
+import hashlib
+import tempfile
+
+from utils.es import *
+from utils.sketch import *
+
+# Number of documents retrieved per search request when streaming an index.
+search_page_size = 10000
+# Number of buckets retrieved per composite aggregation request.
+composite_page_size = 1000
+# How long Elasticsearch should keep the point in time alive between two requests.
+pit_keep_alive = "5m"
+
+
+def get_doc_key(values: [], timestamp):
+    """
+    Get the hash of the (dimensions, @timestamp) tuple of a document. Documents with the same key would have
+    the same _id on a TSDB index.
+    :param values: values of the dimension fields of the document.
+    :param timestamp: @timestamp of the document, in milliseconds.
+    :return: 8 byte hash of the key, as an integer.
+    """
+    key = json.dumps([timestamp, values], default=str).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def stream_docs(client: Elasticsearch, index_name: str, fields: [], max_docs: int, query: {} = None,
+                by_timestamp: bool = False):
+    """
+    Get the documents of an index using a point in time and search_after.
+    Only the @timestamp and the @fields are retrieved from the _source.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param fields: fields to retrieve from the _source. If None, the whole _source is retrieved.
+    :param max_docs: maximum number of documents to retrieve. -1 retrieves all documents.
+    :param query: query to filter the documents. If not specified, all documents are retrieved.
+    :param by_timestamp: true to get the documents sorted by @timestamp, false to get them in the order they are
+    stored, which is faster.
+    :return: generator of (hit, @timestamp in milliseconds).
+    """
+    if query is None:
+        query = {"match_all": {}}
+    source = True if fields is None else ["@timestamp"] + fields
+    sort = [{"_shard_doc": "asc"}]
+    if by_timestamp:
+        sort = [{"@timestamp": "asc"}] + sort
+    pit_id = client.open_point_in_time(index=index_name, keep_alive=pit_keep_alive)["id"]
+    search_after = None
+    n_docs = 0
+    try:
+        while max_docs == -1 or n_docs < max_docs:
+            size = search_page_size
+            if max_docs != -1:
+                size = min(size, max_docs - n_docs)
+            res = client.search(pit={"id": pit_id, "keep_alive": pit_keep_alive}, query=query,
+                                source=source, docvalue_fields=[{"field": "@timestamp", "format": "epoch_millis"}],
+                                sort=sort, search_after=search_after, size=size,
+                                track_total_hits=False)
+            pit_id = res.get("pit_id", pit_id)
+            hits = res["hits"]["hits"]
+            if len(hits) == 0:
+                break
+            for hit in hits:
+                timestamp = hit.get("fields", {}).get("@timestamp", [None])[0]
+                yield hit, timestamp
+            n_docs += len(hits)
+            search_after = hits[-1]["sort"]
+    finally:
+        client.close_point_in_time(id=pit_id)
+
+
+def new_key_set():
+    """
+    Create an empty set of 8 byte keys. The keys are kept in sorted numpy arrays of increasing size, which are merged
+    when a new one is as big as the last one, so each key takes 8 bytes of memory.
+    :return: set of keys.
+    """
+    return []
+
+
+def contains_keys(key_set: [], keys: np.ndarray):
+    """
+    Check which keys are in the set.
+    :param key_set: set of keys, as returned by new_key_set.
+    :param keys: array of uint64 keys.
+    :return: boolean array, true for the keys in the set.
+    """
+    found = np.zeros(len(keys), dtype=bool)
+    for run in key_set:
+        positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+        found |= run[positions] == keys
+    return found
+
+
+def add_keys(key_set: [], keys: np.ndarray):
+    """
+    Add keys that are not in the set yet.
+    :param key_set: set of keys, as returned by new_key_set.
+    :param keys: sorted array of distinct uint64 keys, none of them in the set.
+    """
+    run = keys
+    while len(key_set) > 0 and len(key_set[-1]) <= len(run):
+        run = np.sort(np.concatenate((key_set.pop(), run)))
+    if len(run) > 0:
+        key_set.append(run)
+
+
+@profile_stage("get_overwritten_docs")
+def get_overwritten_docs(client: Elasticsearch, index_name: str, dimensions: [], max_docs: int, query: {} = None):
+    """
+    Find the documents that would be overwritten on a TSDB index, without writing any index.
+    Each (dimensions, @timestamp) tuple is hashed into an 8 byte key, and the keys are kept in a compact set (see
+    new_key_set). If the key was already there, the document would have overwritten a previous one. The documents
+    are checked in batches of search_page_size, all at once.
+    Two different tuples get the same key with a probability of about n^2 / 2^65 for n documents (0.03 for a
+    billion documents), so a false collision is unlikely but possible on the biggest indices.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param max_docs: maximum number of documents to check. -1 checks all documents.
+    :param query: query to filter the documents. If not specified, all documents are checked.
+    :return: number of documents checked, number of overwritten documents, and the collision groups. Each group
+    has the _source (@timestamp and dimensions) of one of its documents and the number of documents with that key.
+    """
+    key_set = new_key_set()
+    groups = {}
+    n_docs = 0
+    n_overwritten = 0
+    extract = compile_field_extractor(dimensions)
+    keys = array('Q')
+    sources = []
+
+    def check_batch():
+        nonlocal n_overwritten
+        batch_keys = np.frombuffer(keys, dtype=np.uint64)
+        unique_keys, first, counts = np.unique(batch_keys, return_index=True, return_counts=True)
+        seen = contains_keys(key_set, unique_keys)
+        repeated = seen | (counts > 1)
+        n_overwritten += int(counts[repeated].sum() - (~seen[repeated]).sum())
+        for key, position, count, key_seen in zip(unique_keys[repeated].tolist(), first[repeated].tolist(),
+                                                   counts[repeated].tolist(), seen[repeated].tolist()):
+            if key in groups:
+                groups[key]["doc_count"] += count
+            else:
+                groups[key] = {"source": sources[position], "doc_count": count + (1 if key_seen else 0)}
+        add_keys(key_set, unique_keys[~seen])
+
+    for hit, timestamp in stream_docs(client, index_name, dimensions, max_docs, query):
+        n_docs += 1
+        keys.append(get_doc_key(extract(hit["_source"]), timestamp))
+        sources.append(hit["_source"])
+        if len(keys) == search_page_size:
+            check_batch()
+            keys = array('Q')
+            sources = []
+    if len(keys) > 0:
+        check_batch()
+    return n_docs, n_overwritten, list(groups.values())
+
+
+def build_source(timestamp: str, dimensions_values: {}):
+    """
+    Build a _source with the @timestamp and the dimensions that exist.
+    :param timestamp: @timestamp of the document.
+    :param dimensions_values: value of each dimension field. None if the dimension is missing.
+    :return: _source, with an object for each level of the dimension fields.
+    """
+    source = {"@timestamp": timestamp}
+    for dimension, value in dimensions_values.items():
+        if value is None:
+            continue
+        el = source
+        keys = dimension.split(".")
+        for key in keys[:-1]:
+            el = el.setdefault(key, {})
+        el[keys[-1]] = value
+    return source
+
+
+@profile_stage("get_overwritten_docs_aggregation")
+def get_overwritten_docs_aggregation(client: Elasticsearch, index_name: str, dimensions: [], query: {} = None):
+    """
+    Find the documents that would be overwritten on a TSDB index, using a composite aggregation over the
+    dimensions and @timestamp. Every bucket with more than one document is a collision group.
+    The buckets use the doc values of the fields, not the _source, so the values of keyword dimensions with a
+    normalizer or longer than ignore_above are not compared like the client mode compares them. Documents with more
+    than one value for a dimension are counted in one bucket per value, and documents without @timestamp are not
+    counted: count_unsupported_docs counts both of them.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param query: query to filter the documents. If not specified, all documents are checked.
+    :return: number of documents with @timestamp, number of overwritten documents, and the collision groups. Each
+    group has the _source (@timestamp and dimensions) of the bucket and its number of documents.
+    """
+    if query is None:
+        query = {"match_all": {}}
+    query = {"bool": {"filter": [query, {"exists": {"field": "@timestamp"}}]}}
+    sources = [{dimension: {"terms": {"field": dimension, "missing_bucket": True}}} for dimension in dimensions]
+    sources.append({"@timestamp": {"terms": {"field": "@timestamp"}}})
+    composite = {"size": composite_page_size, "sources": sources}
+
+    groups = []
+    n_docs = None
+    n_overwritten = 0
+    while True:
+        res = client.search(index=index_name, size=0, query=query, aggs={"collisions": {"composite": composite}},
+                            track_total_hits=n_docs is None)
+        if n_docs is None:
+            n_docs = res["hits"]["total"]["value"]
+        agg = res["aggregations"]["collisions"]
+        for bucket in agg["buckets"]:
+            if bucket["doc_count"] < 2:
+                continue
+            n_overwritten += bucket["doc_count"] - 1
+            key = dict(bucket["key"])
+            timestamp = datetime.fromtimestamp(key.pop("@timestamp") / 1000, tz=timezone.utc)
+            timestamp = timestamp.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+            groups.append({"source": build_source(timestamp, key), "doc_count": bucket["doc_count"]})
+        if "after_key" not in agg or len(agg["buckets"]) == 0:
+            break
+        composite["after"] = agg["after_key"]
+    return n_docs, n_overwritten, groups
+
+
+def count_unsupported_docs(client: Elasticsearch, index_name: str, dimensions: [], query: {} = None):
+    """
+    Count the documents that the aggregation mode cannot count like the other modes: the ones without @timestamp,
+    which are not in any bucket, and the ones with more than one value for a dimension, which are in one bucket per
+    value.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param query: query to filter the documents. If not specified, all documents are counted.
+    :return: number of documents without @timestamp, and number of documents with a multi-valued dimension.
+    Dimensions that are not mapped in the index are skipped.
+    """
+    if query is None:
+        query = {"match_all": {}}
+    script = "doc.containsKey(params.field) && doc[params.field].size() > 1"
+    multi_valued = {"bool": {"minimum_should_match": 1, "should": [
+        {"script": {"script": {"source": script, "params": {"field": dimension}}}} for dimension in dimensions]}}
+    res = client.search(index=index_name, size=0, query=query, aggs={
+        "missing_timestamp": {"missing": {"field": "@timestamp"}},
+        "multi_valued": {"filter": multi_valued}
+    })
+    return res["aggregations"]["missing_timestamp"]["doc_count"], res["aggregations"]["multi_valued"]["doc_count"]
+
+
+def get_key_batches(client: Elasticsearch, index_name: str, dimensions: [], max_docs: int, query: {} = None):
+    """
+    Get the key (see get_doc_key) of the documents of an index, in batches of search_page_size documents.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param max_docs: maximum number of documents to read. -1 reads all documents.
+    :param query: query to filter the documents. If not specified, all documents are read.
+    :return: generator of (array of uint64 keys, _id of each document).
+    """
+    extract = compile_field_extractor(dimensions)
+    keys = array('Q')
+    ids = []
+    for hit, timestamp in stream_docs(client, index_name, dimensions, max_docs, query):
+        keys.append(get_doc_key(extract(hit["_source"]), timestamp))
+        ids.append(hit["_id"])
+        if len(keys) == search_page_size:
+            yield np.frombuffer(keys, dtype=np.uint64), ids
+            keys = array('Q')
+            ids = []
+    if len(keys) > 0:
+        yield np.frombuffer(keys, dtype=np.uint64), ids
+
+
+def get_expected_docs(client: Elasticsearch, index_name: str, max_docs: int, query: {} = None):
+    """
+    Get the number of documents that will be read from an index, to size the sketches and partitions.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param max_docs: maximum number of documents to read. -1 reads all documents.
+    :param query: query to filter the documents. If not specified, all documents are counted.
+    :return: number of documents.
+    """
+    if query is None:
+        query = {"match_all": {}}
+    n_docs = client.count(index=index_name, query=query)["count"]
+    return n_docs if max_docs == -1 else min(n_docs, max_docs)
+
+
+@profile_stage("estimate_overwritten_docs")
+def estimate_overwritten_docs(client: Elasticsearch, index_name: str, dimensions: [], max_docs: int,
+                              memory_mb: int = sketch_memory_mb, query: {} = None):
+    """
+    Estimate the number of documents that would be overwritten on a TSDB index with a Bloom filter of @memory_mb MB
+    and a HyperLogLog, without writing any index. The memory used does not grow with the number of documents.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param max_docs: maximum number of documents to check. -1 checks all documents.
+    :param memory_mb: size of the Bloom filter, in MB.
+    :param query: query to filter the documents. If not specified, all documents are checked.
+    :return: estimate of the overwritten documents, as returned by estimate_overwritten.
+    """
+    bloom = new_bloom_filter(memory_mb, get_expected_docs(client, index_name, max_docs, query))
+    hll = new_hyperloglog()
+    n_docs = 0
+    n_flagged = 0
+    for keys, _ in get_key_batches(client, index_name, dimensions, max_docs, query):
+        n_docs += len(keys)
+        n_flagged += add_keys_bloom_filter(bloom, keys)
+        add_keys_hyperloglog(hll, keys)
+    return estimate_overwritten(n_docs, n_flagged, bloom, hll)
+
+
+@profile_stage("get_overwritten_docs_spill")
+def get_overwritten_docs_spill(client: Elasticsearch, index_name: str, dimensions: [], max_docs: int,
+                               spill_dir: str = None, query: {} = None):
+    """
+    Find the documents that would be overwritten on a TSDB index, without writing any index, with a fixed amount
+    of memory. The key of each document is written to one of several partitions on local disk, and then the
+    partitions are counted one at a time, splitting again the ones that are too big. Documents with the same key
+    are always in the same partition.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param max_docs: maximum number of documents to check. -1 checks all documents.
+    :param spill_dir: directory where the partitions are written. They are deleted at the end. If not specified,
+    the temporary directory of the system is used.
+    :param query: query to filter the documents. If not specified, all documents are checked.
+    :return: number of documents checked, number of overwritten documents, the first spill_max_groups collision
+    groups, like get_overwritten_docs, and the number of collision groups.
+    """
+    n_partitions = get_number_of_partitions(get_expected_docs(client, index_name, max_docs, query))
+    n_docs = 0
+    n_overwritten = 0
+    n_groups = 0
+    groups = []
+    with tempfile.TemporaryDirectory(dir=spill_dir) as directory:
+        partitions = open_partitions(directory, n_partitions)
+        try:
+            for keys, ids in get_key_batches(client, index_name, dimensions, max_docs, query):
+                n_docs += len(keys)
+                spill_keys(partitions, keys, ids)
+        finally:
+            close_partitions(partitions)
+
+        for n in range(n_partitions):
+            partition_overwritten, partition_groups, first_docs = count_partition(directory, str(n),
+                                                                                  spill_max_groups - len(groups))
+            n_overwritten += partition_overwritten
+            n_groups += partition_groups
+            groups += first_docs
+
+    if n_groups > len(groups):
+        print("\tOnly the first {} out of {} sets of dimensions are kept.".format(len(groups), n_groups))
+    # Get the @timestamp and dimensions of the first document of each group
+    for start in range(0, len(groups), search_page_size):
+        chunk = groups[start:start + search_page_size]
+        res = client.mget(index=index_name, ids=[group["_id"] for group in chunk],
+                          source_includes=["@timestamp"] + dimensions)
+        for group, doc in zip(chunk, res["docs"]):
+            group["source"] = doc.get("_source", {})
+    return n_docs, n_overwritten, groups, n_groups
+
+
+def display_estimate(estimate: {}, index_name: str):
+    """
+    Display the estimate of the overwritten documents of an index.
+    :param estimate: estimate, as returned by estimate_overwritten.
+    :param index_name: name of the index with the documents.
+    """
+    print("Out of {} documents from the index {}, an estimated {:.0f} would be discarded ({:.4%}).".format(
+        estimate["docs"], index_name, estimate["overwritten"], estimate["overwritten"] / max(estimate["docs"], 1)))
+    print("\t{:.0%} confidence interval: {:.0f} - {:.0f} documents.".format(estimate["confidence"],
+                                                                          *estimate["interval"]))
+    print("\tBloom filter: {} documents flagged, {:.1f} false positives expected.".format(
+        estimate["bloom"]["flagged"], estimate["bloom"]["expected_false_positives"]))
+    if estimate["bloom"]["saturated"]:
+        print("\tWARNING: The Bloom filter is saturated, so its estimate is not reliable and only the HyperLogLog "
+              "is used. Run again with a bigger sketch_memory_mb.")
+    print("\tHyperLogLog: {:.0f} distinct sets of dimensions and @timestamp (relative error {:.2%}).\n".format(
+        estimate["hyperloglog"]["distinct"], estimate["hyperloglog"]["relative_error"]))
+
+
+def find_overwritten_docs(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int,
+                          max_docs: int, detection_mode: str = "client", use_cache: bool = False,
+                          memory_mb: int = sketch_memory_mb, spill_dir: str = None):
+    """
+    Given a data stream, find the documents of the given index that would be overwritten in a new index with
+    TSDB enabled. No index is created.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be checked. It is ignored by the aggregation mode.
+    :param detection_mode: "client" to read the documents and look for duplicates, "aggregation" to run a
+    composite aggregation over the dimensions and @timestamp, "sketch" to estimate the number of overwritten
+    documents with bounded memory, "spill" to count them exactly with bounded memory, using local disk.
+    :param use_cache: true to reuse the result of a previous run if the documents come from a rolled over index.
+    It is not used by the sketch mode.
+    :param memory_mb: size of the Bloom filter of the sketch mode, in MB.
+    :param spill_dir: directory where the spill mode writes its partitions. If not specified, the temporary
+    directory of the system is used.
+    :return: _source of the first document of each collision group, empty if no document would be overwritten;
+    and the time series fields of the TSDB index.
+    """
+    print("Testing data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+
+    if detection_mode == "sketch":
+        print("Estimating the overwritten documents in index {} with a {} MB sketch...".format(source_index,
+                                                                                           memory_mb))
+        estimate = estimate_overwritten_docs(client, source_index, time_series_fields["dimension"], max_docs,
+                                             memory_mb)
+        display_estimate(estimate, source_index)
+        return [], time_series_fields
+
+    result_key = None
+    result = None
+    if use_cache:
+        result_key = get_result_key(client, data_stream_name, source_index, mappings, settings,
+                                    -1 if detection_mode == "aggregation" else max_docs, detection_mode)
+        result = load_result(result_key)
+
+    if result is not None:
+        print("Using the overwritten documents found in index {} in a previous run.".format(source_index))
+        n_docs, n_overwritten, groups = result["docs"], result["overwritten"], result["groups"]
+        n_groups = result.get("n_groups", len(groups))
+    else:
+        print("Looking for overwritten documents in index {}...".format(source_index))
+        if detection_mode == "aggregation":
+            if max_docs != -1:
+                print("\tmax_docs is ignored: the aggregation checks all documents of the index.")
+            n_docs, n_overwritten, groups = get_overwritten_docs_aggregation(client, source_index,
+                                                                             time_series_fields["dimension"])
+            missing_timestamp, multi_valued = count_unsupported_docs(client, source_index,
+                                                                     time_series_fields["dimension"])
+            if missing_timestamp > 0:
+                print("WARNING: {} documents do not have @timestamp. They are not counted, and a TSDB index would "
+                      "reject them.".format(missing_timestamp))
+            if multi_valued > 0:
+                print("WARNING: {} documents have more than one value for a dimension. Each of them is counted once "
+                      "per value, so the overwritten documents might be overcounted.".format(multi_valued))
+        elif detection_mode == "spill":
+            n_docs, n_overwritten, groups, n_groups = get_overwritten_docs_spill(client, source_index,
+                                                                                 time_series_fields["dimension"],
+                                                                                 max_docs, spill_dir)
+        else:
+            n_docs, n_overwritten, groups = get_overwritten_docs(client, source_index,
+                                                                 time_series_fields["dimension"], max_docs)
+        if detection_mode != "spill":
+            n_groups = len(groups)
+        save_result(result_key, {"docs": n_docs, "overwritten": n_overwritten, "groups": groups,
+                                 "n_groups": n_groups})
+    if n_overwritten > 0:
+        print("WARNING: Out of {} documents from the index {}, {} of them would be discarded ({} sets of "
+              "dimensions).\n".format(n_docs, source_index, n_overwritten, n_groups))
+    else:
+        print("All {} documents taken from index {} would be placed in a TSDB index.\n".format(n_docs, source_index))
+    return [group["source"] for group in groups], time_series_fields
@@ -0,0 +1,236 @@
+"""
+All functions to compare the metrics of the documents that would overwrite each other are placed here.
+Not every overwritten document is lost data: agents that retry a request send the same document twice. The documents
+of the index are read sorted by @timestamp, since documents can only collide if they have the same @timestamp, so
+only the documents of a few timestamps are kept in memory. Each collision group is then classified, in batches, as:
+- identical: every counter and gauge has the same value in all documents. Nothing is lost.
+- disjoint: no counter or gauge has two different values, but some documents lack some of them. The documents
+  could be merged into one without losing anything.
+- conflicting: some counter or gauge has different values. Data is lost.
+The rest of the _source (other than the @timestamp, dimensions and metrics) is compared as a whole.
+"""
+
+import struct
+
+from utils.collisions import *
+
+# Number of documents read before their collision groups are classified.
+conflict_batch_size = 10000
+# Number of metric fields displayed, the ones with the most conflicting groups first.
+conflict_fields_displayed = 10
+# Classes of the collision groups.
+conflict_classes = ["identical", "disjoint", "conflicting"]
+
+
+def encode_value(value):
+    """
+    Encode a metric value as a 64 bit integer, so equal values have the same code. Numbers are encoded as their
+    double (as Elasticsearch stores them), and any other value, like a histogram, as a hash of its JSON.
+    :param value: value of the field.
+    :return: code of the value.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return struct.unpack("<Q", struct.pack("<d", float(value)))[0]
+    return int.from_bytes(hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(),
+                                          digest_size=8).digest(), "big")
+
+
+def flatten_source(source: {}, prefix: str = ""):
+    """
+    Get every leaf field of a _source, with its full path.
+    :param source: _source of the document.
+    :param prefix: path of @source in the document.
+    :return: generator of (path, value).
+    """
+    for key, value in source.items():
+        if isinstance(value, dict):
+            yield from flatten_source(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def get_other_fields_hash(source: {}, excluded: set):
+    """
+    Get a hash of the fields of a document that are not @timestamp, dimensions or metrics.
+    :param source: _source of the document.
+    :param excluded: fields not hashed.
+    :return: 64 bit hash.
+    """
+    fields = sorted((path, value) for path, value in flatten_source(source) if path not in excluded)
+    return int.from_bytes(hashlib.blake2b(json.dumps(fields, default=str).encode(), digest_size=8).digest(), "big")
+
+
+def new_conflict_batch(n_metrics: int):
+    """
+    Create an empty batch of encoded documents.
+    :param n_metrics: number of metric fields.
+    :return: batch.
+    """
+    return {"keys": array('Q'), "timestamps": [], "codes": [array('Q') for _ in range(n_metrics)],
+            "present": [array('b') for _ in range(n_metrics)], "others": array('Q')}
+
+
+def add_conflict_doc(batch: {}, key: int, timestamp, metric_values: [], other_hash: int):
+    """
+    Add an encoded document to a batch.
+    :param batch: batch, as returned by new_conflict_batch.
+    :param key: key of the document, as returned by get_doc_key.
+    :param timestamp: @timestamp of the document.
+    :param metric_values: values of the metric fields, missing_value if the document does not have them.
+    :param other_hash: hash of the other fields, as returned by get_other_fields_hash.
+    """
+    batch["keys"].append(key)
+    batch["timestamps"].append(timestamp)
+    batch["others"].append(other_hash)
+    for codes, present, value in zip(batch["codes"], batch["present"], metric_values):
+        present.append(value != missing_value)
+        codes.append(0 if value == missing_value else encode_value(value))
+
+
+def classify_groups(keys: np.ndarray, codes: np.ndarray, present: np.ndarray, others: np.ndarray):
+    """
+    Classify the collision groups of a batch of documents, comparing all of them at once.
+    :param keys: key of each document.
+    :param codes: matrix with the code of each metric (columns) of each document (rows).
+    :param present: matrix with whether each document has each metric.
+    :param others: hash of the other fields of each document.
+    :return: number of documents of each collision group, its class (position in conflict_classes), whether its
+    other fields differ, and the matrix of the metrics with different values in each group.
+    """
+    order = np.argsort(keys, kind="stable")
+    keys, codes, present, others = keys[order], codes[order], present[order], others[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    sizes = np.diff(np.append(starts, len(keys)))
+
+    counts = np.add.reduceat(present.astype(np.int64), starts, axis=0)
+    minimums = np.minimum.reduceat(np.where(present, codes, np.uint64(np.iinfo(np.uint64).max)), starts, axis=0)
+    maximums = np.maximum.reduceat(np.where(present, codes, 0), starts, axis=0)
+    conflicts = (counts >= 2) & (minimums != maximums)
+    partial = (counts > 0) & (counts < sizes[:, None])
+    others_differ = np.minimum.reduceat(others, starts) != np.maximum.reduceat(others, starts)
+
+    classes = np.where(conflicts.any(axis=1), 2, np.where(partial.any(axis=1), 1, 0))
+    groups = sizes > 1
+    return sizes[groups], classes[groups], others_differ[groups], conflicts[groups]
+
+
+def add_batch_to_report(report: {}, batch: {}):
+    """
+    Classify the collision groups of a batch and add them to the report.
+    :param report: report, as returned by new_conflict_report.
+    :param batch: batch, as returned by new_conflict_batch, with every document of its timestamps.
+    """
+    if len(batch["keys"]) == 0:
+        return
+    n_docs = len(batch["keys"])
+    n_metrics = len(batch["codes"])
+    codes = np.empty((n_docs, n_metrics), dtype=np.uint64)
+    present = np.empty((n_docs, n_metrics), dtype=bool)
+    for i in range(n_metrics):
+        codes[:, i] = np.frombuffer(batch["codes"][i], dtype=np.uint64)
+        present[:, i] = np.frombuffer(batch["present"][i], dtype=np.int8).astype(bool)
+    keys = np.frombuffer(batch["keys"], dtype=np.uint64)
+    others = np.frombuffer(batch["others"], dtype=np.uint64)
+    sizes, classes, others_differ, conflicts = classify_groups(keys, codes, present, others)
+    for n, name in enumerate(conflict_classes):
+        selected = classes == n
+        report[name]["groups"] += int(selected.sum())
+        report[name]["overwritten"] += int((sizes[selected] - 1).sum())
+        report[name]["other_fields_differ"] += int(others_differ[selected].sum())
+    report["field_conflicts"] += conflicts.sum(axis=0)
+
+
+def new_conflict_report(metrics: []):
+    """
+    Create an empty report.
+    :param metrics: list of metric fields.
+    :return: report.
+    """
+    report = {name: {"groups": 0, "overwritten": 0, "other_fields_differ": 0} for name in conflict_classes}
+    report |= {"docs": 0, "metrics": metrics, "field_conflicts": np.zeros(len(metrics), dtype=np.int64)}
+    return report
+
+
+def display_conflict_report(report: {}):
+    """
+    Display how many collision groups and overwritten documents of each class were found.
+    :param report: report, as returned by compare_collision_groups.
+    """
+    n_overwritten = sum(report[name]["overwritten"] for name in conflict_classes)
+    print("Out of {} documents, {} would be overwritten.".format(report["docs"], n_overwritten))
+    descriptions = {
+        "identical": "have identical metrics, nothing is lost",
+        "disjoint": "have metrics that do not overlap, they could be merged",
+        "conflicting": "have metrics with different values, data is lost"
+    }
+    for name in conflict_classes:
+        result = report[name]
+        print("\t- {} sets of dimensions ({} overwritten documents) {}.".format(result["groups"],
+                                                                                result["overwritten"],
+                                                                                descriptions[name]))
+        if result["other_fields_differ"] > 0:
+            print("\t\tIn {} of them, the other fields of the documents differ.".format(result["other_fields_differ"]))
+    fields = [(field, count) for field, count in report["field_conflicts"].items() if count > 0]
+    if len(fields) > 0:
+        print("Metrics with different values in the most sets of dimensions:")
+        for field, count in sorted(fields, key=lambda item: -item[1])[:conflict_fields_displayed]:
+            print("\t- {}: {} sets of dimensions.".format(field, count))
+    print()
+
+
+@profile_stage("compare_collision_groups")
+def compare_collision_groups(client: Elasticsearch, index_name: str, time_series_fields: {}, max_docs: int,
+                             query: {} = None):
+    """
+    Read the documents of an index sorted by @timestamp, and classify each collision group by comparing the metrics
+    of its documents. Only the documents of the timestamps being compared are kept in memory.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param time_series_fields: time series fields of the TSDB index.
+    :param max_docs: maximum number of documents to read. -1 reads all documents.
+    :param query: query to filter the documents. If not specified, all documents are read.
+    :return: report, with the collision groups and overwritten documents of each class, and the number of
+    conflicting groups of each metric.
+    """
+    dimensions = time_series_fields["dimension"]
+    metrics = time_series_fields["counter"] + time_series_fields["gauge"]
+    excluded = set(["@timestamp"] + dimensions + metrics)
+    extract_dimensions = compile_field_extractor(dimensions)
+    extract_metrics = compile_field_extractor(metrics)
+
+    report = new_conflict_report(metrics)
+    batch = new_conflict_batch(len(metrics))
+    for hit, timestamp in stream_docs(client, index_name, None, max_docs, query, by_timestamp=True):
+        report["docs"] += 1
+        # All the documents of a timestamp are read before the next one, so a batch can end when the timestamp changes
+        if len(batch["keys"]) >= conflict_batch_size and timestamp != batch["timestamps"][-1]:
+            add_batch_to_report(report, batch)
+            batch = new_conflict_batch(len(metrics))
+        source = hit["_source"]
+        add_conflict_doc(batch, get_doc_key(extract_dimensions(source), timestamp), timestamp,
+                         extract_metrics(source), get_other_fields_hash(source, excluded))
+    add_batch_to_report(report, batch)
+
+    report["field_conflicts"] = dict(zip(metrics, report["field_conflicts"].tolist()))
+    return report
+
+
+def diff_collision_groups(client: Elasticsearch, data_stream_name: str, docs_index: int,
+                          settings_mappings_index: int, max_docs: int):
+    """
+    Given a data stream, compare the metrics of the documents of the given index that would overwrite each other in
+    a new index with TSDB enabled, to tell the duplicates apart from the data that would be lost. No index is
+    created.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be compared.
+    :return: report, as returned by compare_collision_groups.
+    """
+    source_index, _, _, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                             settings_mappings_index)
+    print("Comparing the metrics of the overwritten documents of index {}...".format(source_index))
+    report = compare_collision_groups(client, source_index, time_series_fields, max_docs)
+    display_conflict_report(report)
+    return report
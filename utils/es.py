@@ -2,16 +2,43 @@
 All functions related to the ES client are placed here.
 """
 
-from elasticsearch import Elasticsearch
+from elasticsearch import ApiError, Elasticsearch, helpers
 from elasticsearch.client import IngestClient
 
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import gzip
 import json
 import os.path
+import threading
+import time
 
 from utils.tsdb import *
-
-
-def get_client(elasticsearch_host, elasticsearch_ca_path, elasticsearch_user, elasticsearch_pwd, cloud_id, cloud_pwd):
+from utils.session import *
+from utils.profile import *
+from utils.throttle import *
+from utils.export import *
+from utils.cache import *
+
+# Value displayed for a dimension that is not present in a document.
+missing_value = "(Missing value)"
+
+# Defaults for placing documents with the bulk API: documents per request, bytes per request, and number of
+# requests sent at the same time.
+bulk_chunk_size = 500
+bulk_max_chunk_bytes = 10 * 1024 * 1024
+bulk_thread_count = 4
+# Number of per document bulk errors displayed.
+bulk_errors_displayed = 10
+
+# Number of searches sent in a single msearch request when getting the overwritten documents.
+msearch_batch_size = 100
+# Number of threads writing the overwritten documents to files.
+file_writer_threads = 8
+
+
+def get_client(elasticsearch_host, elasticsearch_ca_path, elasticsearch_user, elasticsearch_pwd, cloud_id, cloud_pwd,
+               connections_per_node: int = 10):
     """
     Create ES client.
     If cloud values are provided, they will take priority over the local deployment.
@@ -21,18 +48,22 @@ def get_client(elasticsearch_host, elasticsearch_ca_path, elasticsearch_user, el
     :param elasticsearch_pwd: Password for ES.
     :param cloud_id: Cloud ID. Default is empty.
     :param cloud_pwd: Password for the elastic cloud. Default is empty.
+    :param connections_per_node: Size of the connection pool to each node. The client is thread safe, so the pool
+    should be at least as big as the number of threads sharing it.
     :return: ES client.
     """
     if cloud_id != "" and cloud_pwd != "":
         print("Client will connect to the cloud.")
         return Elasticsearch(
             cloud_id=cloud_id,
-            basic_auth=("elastic", cloud_pwd)
+            basic_auth=("elastic", cloud_pwd),
+            connections_per_node=connections_per_node
         )
     return Elasticsearch(
         hosts=elasticsearch_host,
         ca_certs=elasticsearch_ca_path,
-        basic_auth=(elasticsearch_user, elasticsearch_pwd)
+        basic_auth=(elasticsearch_user, elasticsearch_pwd),
+        connections_per_node=connections_per_node
     )
 
 
@@ -51,58 +82,152 @@ def add_doc_from_file(client: Elasticsearch, index_name: str, doc_path: str):
     client.index(index=index_name, document=content)
 
 
-def place_documents(client: Elasticsearch, index_name: str, folder_docs: str):
+def read_docs_from_file(doc_path: str):
+    """
+    Read the documents of a file, one at a time.
+    Files ending in .ndjson or .jsonl have one document per line, and can be compressed with gzip (.gz).
+    Any other file has a single JSON document.
+    :param doc_path: path to the file.
+    :return: generator of documents.
+    """
+    name = doc_path.removesuffix(".gz")
+    if not name.endswith(".ndjson") and not name.endswith(".jsonl"):
+        with open(doc_path) as file:
+            yield json.load(file)
+        return
+
+    open_file = gzip.open if doc_path.endswith(".gz") else open
+    with open_file(doc_path, 'rt') as file:
+        for line in file:
+            if line.strip() != "":
+                yield json.loads(line)
+
+
+def read_docs(path: str):
+    """
+    Read all documents from a file or from all files of a folder, one at a time.
+    :param path: path to the file or folder.
+    :return: generator of documents.
+    """
+    if os.path.isfile(path):
+        yield from read_docs_from_file(path)
+        return
+    for doc in sorted(os.listdir(path)):
+        doc_path = os.path.join(path, doc)
+        if os.path.isfile(doc_path):
+            yield from read_docs_from_file(doc_path)
+
+
+def bulk_place_documents(client: Elasticsearch, index_name: str, path: str, chunk_size: int = bulk_chunk_size,
+                         max_chunk_bytes: int = bulk_max_chunk_bytes, thread_count: int = bulk_thread_count):
+    """
+    Place all documents from a file or folder to an index using the bulk API.
+    The documents are read as they are sent, so the files can be bigger than the memory available.
+    :param client: ES client.
+    :param index_name: name of the index to add the documents.
+    :param path: path to the file or folder with the documents to add.
+    :param chunk_size: maximum number of documents per bulk request.
+    :param max_chunk_bytes: maximum size of a bulk request, in bytes.
+    :param thread_count: number of bulk requests sent at the same time.
+    :return: number of documents placed, and number of documents that failed.
+    """
+    # Data streams only accept the create operation
+    actions = ({"_op_type": "create", "_index": index_name, "_source": doc} for doc in read_docs(path))
+    n_placed = 0
+    n_failed = 0
+    for ok, item in helpers.parallel_bulk(client, actions, thread_count=thread_count, chunk_size=chunk_size,
+                                          max_chunk_bytes=max_chunk_bytes, raise_on_error=False,
+                                          raise_on_exception=False):
+        if ok:
+            n_placed += 1
+            continue
+        n_failed += 1
+        if n_failed <= bulk_errors_displayed:
+            error = item["create"].get("error", item["create"].get("status"))
+            print("\tERROR: Document could not be placed: {}".format(error))
+    if n_failed > bulk_errors_displayed:
+        print("\t... and {} more errors.".format(n_failed - bulk_errors_displayed))
+    return n_placed, n_failed
+
+
+@profile_stage("place_documents")
+def place_documents(client: Elasticsearch, index_name: str, folder_docs: str, bulk: bool = False,
+                    chunk_size: int = bulk_chunk_size, max_chunk_bytes: int = bulk_max_chunk_bytes,
+                    thread_count: int = bulk_thread_count):
     """
     Place all documents from folder to an index.
     :param client: ES client.
     :param index_name: name of the index to add the documents.
-    :param folder_docs: path to the folder with the documents to add.
+    :param folder_docs: path to the folder with the documents to add. If @bulk is True, it can also be a single
+    JSON, NDJSON or gzip NDJSON file.
+    :param bulk: true to place the documents using the bulk API, false to place them one by one.
+    :param chunk_size: maximum number of documents per bulk request.
+    :param max_chunk_bytes: maximum size of a bulk request, in bytes.
+    :param thread_count: number of bulk requests sent at the same time.
     """
     print("Placing documents on the index {name}...".format(name=index_name))
     if not client.indices.exists(index=index_name):
-        print("Index {name} does not exist. Program will end.".format(name=index_name))
-        exit(0)
-
-    if not os.path.isdir(folder_docs):
-        print("Folder {} does not exist. Documents cannot be placed. Program will end.".format(folder_docs))
-        exit(0)
+        raise MigrationError("Index {name} does not exist.".format(name=index_name))
+
+    if bulk:
+        if not os.path.exists(folder_docs):
+            raise MigrationError("Path {} does not exist. Documents cannot be placed.".format(folder_docs))
+        n_placed, n_failed = bulk_place_documents(client, index_name, folder_docs, chunk_size, max_chunk_bytes,
+                                                  thread_count)
+        if n_failed > 0:
+            print("WARNING: {} documents could not be placed on the index {}.".format(n_failed, index_name))
+    else:
+        if not os.path.isdir(folder_docs):
+            raise MigrationError("Folder {} does not exist. Documents cannot be placed.".format(folder_docs))
 
-    for doc in os.listdir(folder_docs):
-        doc_path = os.path.join(folder_docs, doc)
-        if os.path.isfile(doc_path):
-            add_doc_from_file(client, index_name, doc_path)
+        for doc in os.listdir(folder_docs):
+            doc_path = os.path.join(folder_docs, doc)
+            if os.path.isfile(doc_path):
+                add_doc_from_file(client, index_name, doc_path)
 
     # From Elastic docs: Use the refresh API to explicitly make all operations performed on one or more indices since
     # the last refresh available for search. If the request targets a data stream, it refreshes the stream’s backing
     # indices.
     client.indices.refresh(index=index_name)
-    resp = client.search(index=index_name, query={"match_all": {}})
-    n_docs = resp['hits']['total']['value']
+    n_docs = client.count(index=index_name)["count"]
     print("Successfully placed {} documents on the index {name}.\n".format(n_docs, name=index_name))
 
 
-def create_index(client: Elasticsearch, index_name: str, mappings: {} = {}, settings: {} = {}):
+def create_index(client: Elasticsearch, index_name: str, mappings: {} = {}, settings: {} = {}, session: {} = None):
     """
     Create new ES index. If the index already exists, it will be deleted and a new one created.
     :param client: ES client.
     :param index_name: name of the index.
     :param mappings: mappings to be used for the new index. If not specified, default ones will be used.
     :param settings: settings to be used for the new index. If not specified, default ones will be used.
+    :param session: state of the run that creates the index, to delete it when the session is closed.
     """
     if client.indices.exists(index=index_name):
         client.indices.delete(index=index_name)
+    if session is not None:
+        track_index(session, index_name)
     client.indices.create(index=index_name, mappings=mappings, settings=settings)
     print("Index {name} successfully created.\n".format(name=index_name))
 
 
-def create_index_missing_for_docs(client: Elasticsearch):
+@profile_stage("create_index_missing_for_docs")
+def create_index_missing_for_docs(client: Elasticsearch, sliced_reindex: bool = False,
+                                  adaptive_throttle: bool = False, session: {} = None, source_indices: [] = None):
     """
     Create an index to place all the documents that were updated at least one time.
     :param client: ES client.
+    :param sliced_reindex: true to run the reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of the reindex to the load of the cluster, false otherwise.
+    :param session: state of the run, with the names of the indices and the pipeline. If not specified, the
+    default names are used.
+    :param source_indices: indices with the documents placed with TSDB enabled, like the ones returned by
+    copy_from_data_stream_resumable. If not specified, the TSDB index of the session.
     """
-    create_index(client, overwritten_docs_index)
+    session = get_session(session)
+    create_index(client, session["overwritten_docs_index"], session=session)
     pipelines = IngestClient(client)
-    pipeline_name = 'get-missing-docs'
+    pipeline_name = session["pipeline"]
+    track_pipeline(session, pipeline_name)
     pipelines.put_pipeline(id=pipeline_name, body={
         'description': "Drop all documents that were not overwritten.",
         "processors": [
@@ -114,11 +239,50 @@ def create_index_missing_for_docs(client: Elasticsearch):
         ]
     })
     dest = {
-        "index": overwritten_docs_index,
+        "index": session["overwritten_docs_index"],
         "version_type": "external",
         "pipeline": pipeline_name
     }
-    client.reindex(source={"index": tsdb_index}, dest=dest, refresh=True)
+    if source_indices is None:
+        source_indices = [session["tsdb_index"]]
+    reindex(client, {"index": ",".join(source_indices)}, dest, -1, sliced_reindex, adaptive_throttle)
+
+
+def compile_field_extractor(fields: []):
+    """
+    Compile a function that gets the value of all the fields from the _source of a document in a single pass.
+    The field paths are placed in a trie, flattened to a dictionary from each path prefix to its node, so each key
+    of the _source needs one lookup. This works with nested objects ({"a": {"b": 1}}), dotted keys ({"a.b": 1})
+    and any mix of them.
+    :param fields: name of the fields, with each level separated by a dot.
+    :return: function that receives a _source and returns the list of values, in the same order as @fields.
+    Fields that the document does not have get missing_value.
+    """
+    # Node of each path: the position of the field for full paths, -1 for the prefixes.
+    nodes = {}
+    for position, field in enumerate(fields):
+        keys = field.split(".")
+        for i in range(1, len(keys)):
+            nodes.setdefault(".".join(keys[:i]), -1)
+        nodes[field] = position
+
+    def walk(obj: {}, prefix: str, values: []):
+        for key, value in obj.items():
+            path = prefix + key
+            position = nodes.get(path)
+            if position is None:
+                continue
+            if position >= 0:
+                values[position] = value
+            elif isinstance(value, dict):
+                walk(value, path + ".", values)
+
+    def extract(source: {}):
+        values = [missing_value] * len(fields)
+        walk(source, "", values)
+        return values
+
+    return extract
 
 
 def build_query(dimensions_exist: {}, dimensions_missing: []):
@@ -170,86 +334,241 @@ def get_and_place_documents(client: Elasticsearch, data_stream: str, dir_name: s
 
     res = client.search(index=data_stream, query=query, sort={"@timestamp": "asc"}, size=number_of_docs)
 
-    dir_for_docs = os.path.join(dir_name, str(n))
-    os.mkdir(dir_for_docs)
+    write_docs(dir_name, n, res["hits"]["hits"])
 
-    for doc in res["hits"]["hits"]:
-        name = doc["_id"] + ".json"
-        with open(os.path.join(dir_for_docs, name), 'w') as file:
-            json.dump(doc, file, indent=4)
+
+def get_and_place_documents_batch(client: Elasticsearch, data_stream: str, export: {}, searches: [],
+                                  number_of_docs: int, executor: ThreadPoolExecutor):
+    """
+    Given many sets of dimensions, get their documents with a single msearch request and export them.
+    The documents are exported by the executor threads.
+    :param client: ES client.
+    :param data_stream: Name of the data stream.
+    :param export: state of the export, as returned by open_export.
+    :param searches: list of (n, dimensions_values, dimensions_missing), as in get_and_place_documents.
+    :param number_of_docs: Number of documents to get with each set of dimensions.
+    :param executor: executor to write the files.
+    :return: futures of the documents being exported.
+    """
+    body = []
+    for _, dimensions_values, dimensions_missing in searches:
+        body.append({"index": data_stream})
+        body.append({"query": build_query(dimensions_values, dimensions_missing), "sort": {"@timestamp": "asc"},
+                     "size": number_of_docs})
+    res = client.msearch(searches=body)
+
+    futures = []
+    for (n, dimensions_values, _), resp in zip(searches, res["responses"]):
+        if "error" in resp:
+            print("WARNING: Documents for group {} could not be retrieved: {}".format(n, resp["error"]))
+            continue
+        futures.append(executor.submit(carry_stage(export_docs), export, n, dimensions_values, resp["hits"]["hits"]))
+    return futures
+
+
+def display_overwritten_doc(source: {}, dimensions: [], extract):
+    """
+    Display the @timestamp and dimensions of an overwritten document.
+    :param source: _source of the document.
+    :param dimensions: list of dimension fields.
+    :param extract: function to get the value of the dimensions, as returned by compile_field_extractor.
+    :return: values of the @timestamp and dimensions that exist in the document, and list of the dimensions missing,
+    as used by build_query.
+    """
+    dimensions_values = {"@timestamp": source["@timestamp"]}
+    dimensions_missing = []
+
+    print("- Timestamp {}:".format(source["@timestamp"]))
+    for dimension, el in zip(dimensions, extract(source)):
+        print("\t{}: {}".format(dimension, el))
+        if el != missing_value:
+            dimensions_values[dimension] = el
+        else:
+            dimensions_missing.append(dimension)
+    return dimensions_values, dimensions_missing
 
 
-def get_missing_docs_info(client: Elasticsearch, data_stream: str, display_docs: int, dir,
-                          get_overlapping_files: bool, copy_docs_per_dimension: int):
+@profile_stage("get_missing_docs_info")
+def get_missing_docs_info(client: Elasticsearch, data_stream: str, dimensions: [], display_docs: int, dir,
+                          get_overlapping_files: bool, copy_docs_per_dimension: int, overwritten_docs: [] = None,
+                          export_format: str = "files", session: {} = None):
     """
     Display the dimensions of the first @display_docs documents.
-    If @get_overlapping_files is set to True, then @copy_docs_per_dimension documents will be placed in a directory
-    (if the directory does not exist!).
+    If @get_overlapping_files is set to True, then @copy_docs_per_dimension documents will be exported (if the
+    directory or files do not exist!).
     :param client: ES client.
+    :param dimensions: list of dimension fields of the TSDB index.
     :param display_docs: number of documents to display.
-    :param dir: name of the directory.
+    :param dir: name of the directory, or path of the export without extension for the "ndjson" format.
     :param get_overlapping_files: true if you want to place fields in the directory, false otherwise.
     :param copy_docs_per_dimension: number of documents to get for a set of dimensions.
     :param docs_index: name of the index with the documents.
+    :param overwritten_docs: _source (at least @timestamp and dimensions) of the overwritten documents. If not
+    given, the documents are retrieved from the overwritten documents index.
+    :param export_format: "files" to place each document in a file, "ndjson" to write a single compressed NDJSON
+    stream.
+    :param session: state of the run, with the name of the overwritten documents index. If not specified, the
+    default name is used.
     """
+    export = None
     if get_overlapping_files:
-        if os.path.exists(dir):
-            print("WARNING: The directory {} exists. Please delete it. Documents will not be placed.\n".format(dir))
-            get_overlapping_files = False
-        else:
-            os.mkdir(dir)
-            n = 1
-
-    body = {'size': display_docs, 'query': {'match_all': {}}}
-    res = client.search(index=overwritten_docs_index, body=body)
-    dimensions = time_series_fields["dimension"]
-
-    print("The timestamp and dimensions of the first {} overwritten documents are:".format(display_docs))
-    for doc in res["hits"]["hits"]:
-        if get_overlapping_files:
-            dimensions_values = {"@timestamp": doc["_source"]["@timestamp"]}
-            dimensions_missing = []
-
-        print("- Timestamp {}:".format(doc["_source"]["@timestamp"]))
-        for dimension in dimensions:
-            el = doc["_source"]
-            keys = dimension.split(".")
-            for key in keys:
-                if key not in el:
-                    el = "(Missing value)"
-                    break
-                el = el[key]
-            print("\t{}: {}".format(dimension, el))
+        export = open_export(dir, export_format)
+        get_overlapping_files = export is not None
+        n = 1
+
+    searches = []
+    futures = []
+    executor = ThreadPoolExecutor(max_workers=file_writer_threads)
+    extract = compile_field_extractor(dimensions)
+
+    try:
+        if overwritten_docs is None:
+            body = {'size': display_docs, 'query': {'match_all': {}}}
+            res = client.search(index=get_session(session)["overwritten_docs_index"], body=body)
+            overwritten_docs = [doc["_source"] for doc in res["hits"]["hits"]]
+
+        print("The timestamp and dimensions of the first {} overwritten documents are:".format(display_docs))
+        for source in overwritten_docs[:display_docs]:
+            dimensions_values, dimensions_missing = display_overwritten_doc(source, dimensions, extract)
             if get_overlapping_files:
-                if el != "(Missing value)":
-                    dimensions_values[dimension] = el
-                else:
-                    dimensions_missing.append(dimension)
-
-        if get_overlapping_files:
-            get_and_place_documents(client, data_stream, dir, dimensions_values, dimensions_missing, n, copy_docs_per_dimension)
-            n += 1
-
-
-def copy_docs_from_to(client: Elasticsearch, source_index: str, dest_index: str, max_docs: int):
+                searches.append((n, dimensions_values, dimensions_missing))
+                n += 1
+                if len(searches) == msearch_batch_size:
+                    futures += get_and_place_documents_batch(client, data_stream, export, searches,
+                                                             copy_docs_per_dimension, executor)
+                    searches = []
+
+        if len(searches) > 0:
+            futures += get_and_place_documents_batch(client, data_stream, export, searches,
+                                                     copy_docs_per_dimension, executor)
+        executor.shutdown()
+        # Raise any error writing the files
+        for future in futures:
+            future.result()
+    except BaseException:
+        executor.shutdown(cancel_futures=True)
+        abort_export(export)
+        raise
+    close_export(export)
+
+
+def wait_for_reindex_task(client: Elasticsearch, task_id: str, throttle: {} = None, show_progress: bool = True):
+    """
+    Poll a reindex task until it completes, displaying its progress.
+    If the user presses Ctrl-C, the task is cancelled on the server and the program ends.
+    :param client: ES client.
+    :param task_id: ID of the reindex task.
+    :param throttle: state of the throttle, as returned by new_throttle, to rethrottle the task at every poll
+    according to the load of the cluster. If not specified, the task is not rethrottled.
+    :param show_progress: true to display the progress at every poll, false to poll silently, like when many tasks
+    are polled from different threads.
+    :return: response of the reindex task, with the same format as a blocking reindex.
+    """
+    start = time.time()
+    try:
+        while True:
+            task = client.tasks.get(task_id=task_id)
+            status = task["task"]["status"]
+            done = status["created"] + status["updated"] + status["deleted"] + status["noops"] + \
+                status["version_conflicts"]
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0
+            if rate > 0 and status["total"] > done:
+                eta = "{:.0f}s".format((status["total"] - done) / rate)
+            else:
+                eta = "-"
+            if show_progress:
+                print("\r\t{}/{} documents ({:.0f} docs/s, ETA {}): {} created, {} updated.".format(
+                    done, status["total"], rate, eta, status["created"], status["updated"]), end="", flush=True)
+            if task["completed"]:
+                break
+            # Only a task that was still running at this poll is rethrottled, after the load was sampled for a while
+            if throttle is not None and elapsed >= task_poll_interval:
+                adjust_throttle(client, task_id, throttle)
+            time.sleep(task_poll_interval)
+    except KeyboardInterrupt:
+        print()
+        client.tasks.cancel(task_id=task_id)
+        raise MigrationError("Reindex task {} was cancelled.".format(task_id))
+    if show_progress:
+        print()
+
+    if "error" in task:
+        raise MigrationError("Reindex task {} failed: {}.".format(task_id, task["error"]["reason"]))
+    return task["response"]
+
+
+def reindex(client: Elasticsearch, source: {}, dest: {}, max_docs: int, sliced_reindex: bool = False,
+            adaptive_throttle: bool = False, task_started=None, show_progress: bool = True):
+    """
+    Reindex documents and wait for the result.
+    :param client: ES client.
+    :param source: source of the reindex.
+    :param dest: destination of the reindex.
+    :param max_docs: max number of documents to reindex. -1 reindexes all documents.
+    :param sliced_reindex: true to run the reindex as a background task with automatic slicing, and poll it
+    until it completes. False to run a single blocking reindex.
+    :param adaptive_throttle: true to run the reindex as a background task, and rethrottle it at every poll
+    according to the load of the cluster.
+    :param task_started: function called with the ID of the task when it starts, like to save it so the task can be
+    cancelled by a later run. If specified, the reindex always runs as a background task.
+    :param show_progress: true to display the progress of a background task, false otherwise.
+    :return: response of the reindex.
+    """
+    options = {}
+    if max_docs != -1:
+        options["max_docs"] = max_docs
+    if not sliced_reindex and not adaptive_throttle and task_started is None:
+        return client.reindex(source=source, dest=dest, refresh=True, **options)
+
+    throttle = None
+    if sliced_reindex:
+        options["slices"] = "auto"
+    if adaptive_throttle:
+        throttle = new_throttle(client)
+        source = source | {"size": throttle_batch_size}
+        options["requests_per_second"] = throttle["requests_per_second"]
+    task_id = client.reindex(source=source, dest=dest, wait_for_completion=False, **options)["task"]
+    if task_started is not None:
+        task_started(task_id)
+    if show_progress:
+        print("\tReindex is running as task {}. Press Ctrl-C to cancel it.".format(task_id))
+    resp = wait_for_reindex_task(client, task_id, throttle, show_progress)
+    client.indices.refresh(index=dest["index"])
+    return resp
+
+
+@profile_stage("copy_docs_from_to")
+def copy_docs_from_to(client: Elasticsearch, source_index: str, dest_index: str, max_docs: int,
+                      sliced_reindex: bool = False, adaptive_throttle: bool = False, result_key: str = None):
     """
     Copy documents from one index to the other.
     :param client: ES client.
     :param source_index: source index with the documents to be copied to a new index.
     :param dest_index: destination index for the documents.
     :param max_docs: max number of documents to copy.
+    :param sliced_reindex: true to run the reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of the reindex to the load of the cluster, false otherwise.
+    :param result_key: key to keep the result of the reindex for the next runs. If None, it is not kept.
     :return: True if the number of documents is the same in the new index as it was in the old index.
     """
     print("Copying documents from {} to {}...".format(source_index, dest_index))
     if not client.indices.exists(index=source_index):
-        print("Source index {name} does not exist. Program will end.".format(name=source_index))
-        exit(0)
+        raise MigrationError("Source index {name} does not exist.".format(name=source_index))
 
-    if max_docs != -1:
-        resp = client.reindex(source={"index": source_index}, dest={"index": dest_index}, refresh=True,
-                              max_docs=max_docs)
-    else:
-        resp = client.reindex(source={"index": source_index}, dest={"index": dest_index}, refresh=True)
+    resp = reindex(client, {"index": source_index}, {"index": dest_index}, max_docs, sliced_reindex, adaptive_throttle)
+    save_result(result_key, {"total": resp["total"], "updated": resp["updated"]})
+    return display_reindex_result(resp, source_index, dest_index)
+
+
+def display_reindex_result(resp: {}, source_index: str, dest_index: str):
+    """
+    Display how many documents were discarded when copying documents from one index to the other.
+    :param resp: response of the reindex (at least total and updated).
+    :param source_index: source index with the documents copied.
+    :param dest_index: destination index for the documents.
+    :return: True if the number of documents is the same in the new index as it was in the old index.
+    """
     if resp["updated"] > 0:
         print("WARNING: Out of {} documents from the index {}, {} of them were discarded.\n".format(resp["total"],
                                                                                                     source_index,
@@ -264,6 +583,7 @@ def copy_docs_from_to(client: Elasticsearch, source_index: str, dest_index: str,
         return True
 
 
+@profile_stage("get_tsdb_config")
 def get_tsdb_config(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int):
     """
     Get the index name where documents are placed, and mappings and settings for the new TSDB index.
@@ -271,27 +591,41 @@ def get_tsdb_config(client: Elasticsearch, data_stream_name: str, docs_index: in
     :param data_stream_name:
     :param docs_index: number of the index in the data stream with the documents to be moved to the TSDB index.
     :param settings_mappings_index: number of the index for the settings and mappings for the TSDB index.
-    :return: documents index name, settings and mappings for the TSDB index.
+    :return: documents index name, settings and mappings for the TSDB index, and the time series fields.
     """
     data_stream = client.indices.get_data_stream(name=data_stream_name)
+    docs_index_name, settings_mappings_index_name = get_index_names(data_stream, data_stream_name, docs_index,
+                                                                    settings_mappings_index)
+
+    mappings, settings, time_series_fields = get_tsdb_mappings_settings(client, settings_mappings_index_name)
+
+    return docs_index_name, mappings, settings, time_series_fields
+
+
+def get_index_names(data_stream: {}, data_stream_name: str, docs_index: int, settings_mappings_index: int):
+    """
+    Get the name of the index with the documents and the name of the index with the mappings and settings.
+    :param data_stream: response of the get data stream API.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index in the data stream with the documents to be moved to the TSDB index.
+    :param settings_mappings_index: number of the index for the settings and mappings for the TSDB index.
+    :return: documents index name, and settings and mappings index name.
+    """
     n_indexes = len(data_stream["data_streams"][0]["indices"])
 
     # Get the index to use for document retrieval
     if docs_index == -1:
         docs_index = 0
     elif docs_index >= n_indexes:
-        print("ERROR: Data stream {} has {} indexes. Documents index number {} is not valid.".format(data_stream_name,
-                                                                                                     n_indexes,
-                                                                                                     docs_index))
-        exit(0)
+        raise MigrationError("Data stream {} has {} indexes. Documents index number {} is not valid.".format(
+            data_stream_name, n_indexes, docs_index))
 
     # Get index to use for settings/mappings
     if settings_mappings_index == -1:
         settings_mappings_index = n_indexes - 1
     elif settings_mappings_index >= n_indexes:
-        print("ERROR: Data stream {} has {} indexes. Settings/mappings index number {} is not valid.".format(
+        raise MigrationError("Data stream {} has {} indexes. Settings/mappings index number {} is not valid.".format(
             data_stream_name, n_indexes, settings_mappings_index))
-        exit(0)
 
     docs_index_name = data_stream["data_streams"][0]["indices"][docs_index]["index_name"]
     settings_mappings_index_name = data_stream["data_streams"][0]["indices"][settings_mappings_index]["index_name"]
@@ -300,16 +634,27 @@ def get_tsdb_config(client: Elasticsearch, data_stream_name: str, docs_index: in
     print("Index being used for the settings and mappings is {}.".format(settings_mappings_index_name))
     print()
 
-    mappings = client.indices.get_mapping(index=settings_mappings_index_name)[settings_mappings_index_name]["mappings"]
-    settings = client.indices.get_settings(index=settings_mappings_index_name)[settings_mappings_index_name]["settings"]
+    return docs_index_name, settings_mappings_index_name
 
-    settings = get_tsdb_settings(mappings, settings)
 
-    return docs_index_name, mappings, settings
+def get_tsdb_mappings_settings(client: Elasticsearch, index_name: str):
+    """
+    Get the mappings and settings for the new TSDB index from an existing index.
+    :param client: ES client.
+    :param index_name: name of the index to use for the settings and mappings.
+    :return: mappings and settings for the TSDB index, and the time series fields.
+    """
+    mappings = client.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    settings = client.indices.get_settings(index=index_name)[index_name]["settings"]
+
+    settings, time_series_fields = get_tsdb_settings(mappings, settings)
+
+    return mappings, settings, time_series_fields
 
 
 def copy_from_data_stream(client: Elasticsearch, data_stream_name: str, docs_index: int,settings_mappings_index: int,
-                          max_docs: int):
+                          max_docs: int, sliced_reindex: bool = False, adaptive_throttle: bool = False,
+                          session: {} = None, use_cache: bool = False):
     """
     Given a data stream, it copies the documents retrieved from the given index and places them in a new
     index with TSDB enabled.
@@ -318,16 +663,180 @@ def copy_from_data_stream(client: Elasticsearch, data_stream_name: str, docs_ind
     :param docs_index: number of the index to use to retrieve the documents.
     :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
     :param max_docs: maximum documents to be reindexed.
-    :return: True if the number of documents placed to the TSDB index remained the same. False otherwise.
+    :param sliced_reindex: true to run the reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of the reindex to the load of the cluster, false otherwise.
+    :param session: state of the run, with the name of the index with TSDB enabled. If not specified, the default
+    name is used.
+    :param use_cache: true to reuse the result of a previous run if the documents come from a rolled over index. If
+    no document was overwritten in that run, the TSDB index is not created.
+    :return: True if the number of documents placed to the TSDB index remained the same, False otherwise; and the
+    time series fields of the TSDB index.
     """
     print("Testing data stream {}.".format(data_stream_name))
 
     if not client.indices.exists(index=data_stream_name):
-        print("\tData stream {} does not exist. Program will end.".format(data_stream_name))
-        exit(0)
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+
+    result_key = None
+    if use_cache:
+        result_key = get_result_key(client, data_stream_name, source_index, mappings, settings, max_docs, "reindex")
+        result = load_result(result_key)
+        # The overwritten documents are read from the TSDB index, so it is only skipped if there are none
+        if result is not None and result["updated"] == 0:
+            print("All {} documents taken from index {} were successfully placed in a previous run. The TSDB index "
+                  "will not be created.\n".format(result["total"], source_index))
+            return True, time_series_fields
 
-    source_index, mappings, settings = get_tsdb_config(client, data_stream_name, docs_index, settings_mappings_index)
+    session = get_session(session)
+    create_index(client, session["tsdb_index"], mappings, settings, session)
 
-    create_index(client, tsdb_index, mappings, settings)
+    all_placed = copy_docs_from_to(client, source_index, session["tsdb_index"], max_docs, sliced_reindex,
+                                   adaptive_throttle, result_key)
+    return all_placed, time_series_fields
 
-    return copy_docs_from_to(client, source_index, tsdb_index, max_docs)
+
+def cancel_reindex_task(client: Elasticsearch, task_id: str):
+    """
+    Cancel a reindex task. Nothing is done if it already finished.
+    :param client: ES client.
+    :param task_id: ID of the reindex task.
+    """
+    try:
+        client.tasks.cancel(task_id=task_id)
+    except ApiError:
+        return
+    print("\tReindex task {} was cancelled.".format(task_id))
+
+
+@profile_stage("copy_backing_index")
+def copy_backing_index(client: Elasticsearch, source_index: str, dest_index: str, mappings: {}, settings: {},
+                       max_docs: int, session: {} = None, result_key: str = None, sliced_reindex: bool = False,
+                       adaptive_throttle: bool = False, task_started=None):
+    """
+    Create a TSDB index and copy the documents of one backing index to it.
+    :param client: ES client.
+    :param source_index: name of the backing index with the documents.
+    :param dest_index: name of the TSDB index to create.
+    :param mappings: mappings for the TSDB index.
+    :param settings: settings for the TSDB index.
+    :param max_docs: max number of documents to copy.
+    :param session: state of the run that creates the TSDB index.
+    :param result_key: key of the result of a previous run. If it is cached, the TSDB index is not created. If
+    None, the index is always copied.
+    :param sliced_reindex: true to run the reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of the reindex to the load of the cluster, false otherwise.
+    :param task_started: function called with the ID of the reindex task when it starts. If specified, the reindex
+    runs as a background task, and its progress is not displayed, since other backing indices are being copied.
+    :return: response of the reindex, or the cached result.
+    """
+    result = load_result(result_key)
+    if result is not None:
+        return result | {"cached": True}
+    create_index(client, dest_index, mappings, settings, session)
+    resp = reindex(client, {"index": source_index}, {"index": dest_index}, max_docs, sliced_reindex,
+                   adaptive_throttle, task_started, task_started is None)
+    save_result(result_key, {"total": resp["total"], "updated": resp["updated"]})
+    return resp
+
+
+def copy_all_backing_indices(client: Elasticsearch, data_stream_name: str, settings_mappings_index: int,
+                             max_docs: int, max_workers: int, session: {} = None, use_cache: bool = False,
+                             sliced_reindex: bool = False, adaptive_throttle: bool = False):
+    """
+    Given a data stream, copy the documents of every backing index to its own new index with TSDB enabled.
+    The backing indices are copied concurrently, with at most @max_workers reindex running at the same time. Each
+    reindex runs as a background task, and if the user presses Ctrl-C, all of them are cancelled on the server.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be reindexed per backing index.
+    :param max_workers: maximum number of backing indices being copied at the same time.
+    :param session: state of the run. The TSDB indices are named after its TSDB index. If not specified, the
+    default name is used.
+    :param use_cache: true to reuse the results of a previous run for the rolled over backing indices. The write
+    index is always copied.
+    :param sliced_reindex: true to run each reindex as a sliced background task, false otherwise.
+    :param adaptive_throttle: true to adapt the speed of each reindex to the load of the cluster, false otherwise.
+    :return: True if every backing index was copied and no document was overwritten in any of them. False
+    otherwise.
+    """
+    print("Testing all backing indices of data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    data_stream = client.indices.get_data_stream(name=data_stream_name)
+    indices = [index["index_name"] for index in data_stream["data_streams"][0]["indices"]]
+
+    if settings_mappings_index == -1:
+        settings_mappings_index = len(indices) - 1
+    elif settings_mappings_index >= len(indices):
+        raise MigrationError("Data stream {} has {} indexes. Settings/mappings index number {} is not valid.".format(
+            data_stream_name, len(indices), settings_mappings_index))
+
+    print("Index being used for the settings and mappings is {}.\n".format(indices[settings_mappings_index]))
+    mappings, settings, _ = get_tsdb_mappings_settings(client, indices[settings_mappings_index])
+
+    result_keys = [None] * len(indices)
+    if use_cache:
+        result_keys = [get_result_key(client, data_stream_name, source_index, mappings, settings, max_docs, "reindex")
+                       for source_index in indices]
+
+    session = get_session(session)
+    print("Copying documents from {} backing indices ({} at a time)...".format(len(indices), max_workers))
+    tasks = []
+    tasks_lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def task_started(task_id: str):
+        with tasks_lock:
+            tasks.append(task_id)
+        # A task started while the others were being cancelled
+        if cancelled.is_set():
+            cancel_reindex_task(client, task_id)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(carry_stage(copy_backing_index), client, source_index,
+                               session["tsdb_index"] + "-" + str(n), mappings, settings, max_docs, session,
+                               result_keys[n], sliced_reindex, adaptive_throttle, task_started)
+               for n, source_index in enumerate(indices)]
+    try:
+        wait(futures)
+    except KeyboardInterrupt:
+        # Only the main thread gets Ctrl-C, so it cancels the tasks of all the workers
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        with tasks_lock:
+            started = list(tasks)
+        for task_id in started:
+            cancel_reindex_task(client, task_id)
+        raise MigrationError("The reindex tasks of {} backing indices were cancelled.".format(len(started)))
+    executor.shutdown()
+
+    print("Overwrite report for data stream {}:".format(data_stream_name))
+    total = 0
+    updated = 0
+    failed = 0
+    for n, source_index in enumerate(indices):
+        try:
+            resp = futures[n].result()
+        except Exception as e:
+            print("\t- {}: ERROR: {}".format(source_index, e))
+            failed += 1
+            continue
+        total += resp["total"]
+        updated += resp["updated"]
+        origin = "TSDB index: " + session["tsdb_index"] + "-" + str(n)
+        if resp.get("cached"):
+            origin = "Result of a previous run"
+        print("\t- {}: {} out of {} documents were overwritten ({:.2%}). {}.".format(
+            source_index, resp["updated"], resp["total"], resp["updated"] / max(resp["total"], 1), origin))
+    print("\t- Overall: {} out of {} documents were overwritten ({:.2%}).".format(updated, total,
+                                                                                 updated / max(total, 1)))
+    if failed > 0:
+        print("WARNING: {} out of {} backing indices could not be tested.".format(failed, len(indices)))
+    print()
+    return updated == 0 and failed == 0
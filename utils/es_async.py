@@ -0,0 +1,275 @@
+"""
+All functions related to the async ES client are placed here.
+They follow the same steps, and display the same output, as the ones in utils/es.py. The difference is that
+requests that do not depend on each other are sent at the same time, with at most async_concurrency of them
+running at once.
+"""
+
+from elasticsearch import AsyncElasticsearch
+
+import asyncio
+
+from utils.es import *
+
+# Maximum number of requests (and files being written) at the same time.
+async_concurrency = 8
+
+
+def get_async_client(elasticsearch_host, elasticsearch_ca_path, elasticsearch_user, elasticsearch_pwd, cloud_id,
+                     cloud_pwd):
+    """
+    Create async ES client.
+    If cloud values are provided, they will take priority over the local deployment.
+    :param elasticsearch_host: ES host.
+    :param elasticsearch_ca_path: Path to ES certificate.
+    :param elasticsearch_user: Name of the ES user.
+    :param elasticsearch_pwd: Password for ES.
+    :param cloud_id: Cloud ID. Default is empty.
+    :param cloud_pwd: Password for the elastic cloud. Default is empty.
+    :return: async ES client.
+    """
+    if cloud_id != "" and cloud_pwd != "":
+        print("Client will connect to the cloud.")
+        return AsyncElasticsearch(
+            cloud_id=cloud_id,
+            basic_auth=("elastic", cloud_pwd),
+            connections_per_node=async_concurrency
+        )
+    return AsyncElasticsearch(
+        hosts=elasticsearch_host,
+        ca_certs=elasticsearch_ca_path,
+        basic_auth=(elasticsearch_user, elasticsearch_pwd),
+        connections_per_node=async_concurrency
+    )
+
+
+async def delete_index_if_exists(client: AsyncElasticsearch, index_name: str):
+    """
+    Delete an index if it exists.
+    :param client: async ES client.
+    :param index_name: name of the index.
+    """
+    if await client.indices.exists(index=index_name):
+        await client.indices.delete(index=index_name)
+
+
+async def create_index_async(client: AsyncElasticsearch, index_name: str, mappings: {} = {}, settings: {} = {},
+                             session: {} = None):
+    """
+    Same as create_index.
+    """
+    await delete_index_if_exists(client, index_name)
+    if session is not None:
+        track_index(session, index_name)
+    await client.indices.create(index=index_name, mappings=mappings, settings=settings)
+    print("Index {name} successfully created.\n".format(name=index_name))
+
+
+async def close_session_async(client: AsyncElasticsearch, session: {}):
+    """
+    Same as close_session. The indices and pipelines are deleted at the same time.
+    """
+    if session["keep_indices"]:
+        return
+    with session["lock"]:
+        indices, session["indices"] = session["indices"], []
+        pipelines, session["pipelines"] = session["pipelines"], []
+    await asyncio.gather(*[client.indices.delete(index=index_name, ignore_unavailable=True) for index_name in indices],
+                         *[client.options(ignore_status=404).ingest.delete_pipeline(id=pipeline_name)
+                           for pipeline_name in pipelines])
+
+
+async def get_tsdb_config_async(client: AsyncElasticsearch, data_stream_name: str, docs_index: int,
+                                settings_mappings_index: int):
+    """
+    Same as get_tsdb_config. The mappings and the settings are retrieved at the same time.
+    """
+    data_stream = await client.indices.get_data_stream(name=data_stream_name)
+    docs_index_name, settings_mappings_index_name = get_index_names(data_stream, data_stream_name, docs_index,
+                                                                    settings_mappings_index)
+
+    mappings, settings = await asyncio.gather(client.indices.get_mapping(index=settings_mappings_index_name),
+                                              client.indices.get_settings(index=settings_mappings_index_name))
+    mappings = mappings[settings_mappings_index_name]["mappings"]
+    settings = settings[settings_mappings_index_name]["settings"]
+
+    settings, time_series_fields = get_tsdb_settings(mappings, settings)
+
+    return docs_index_name, mappings, settings, time_series_fields
+
+
+async def copy_from_data_stream_async(client: AsyncElasticsearch, data_stream_name: str, docs_index: int,
+                                      settings_mappings_index: int, max_docs: int, session: {} = None):
+    """
+    Same as copy_from_data_stream. The old TSDB index is deleted while the mappings and settings are retrieved.
+    """
+    print("Testing data stream {}.".format(data_stream_name))
+
+    if not await client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    session = get_session(session)
+    tsdb_index_name = session["tsdb_index"]
+
+    (source_index, mappings, settings, time_series_fields), _ = await asyncio.gather(
+        get_tsdb_config_async(client, data_stream_name, docs_index, settings_mappings_index),
+        delete_index_if_exists(client, tsdb_index_name))
+
+    await create_index_async(client, tsdb_index_name, mappings, settings, session)
+
+    print("Copying documents from {} to {}...".format(source_index, tsdb_index_name))
+    options = {}
+    if max_docs != -1:
+        options["max_docs"] = max_docs
+    resp = await client.reindex(source={"index": source_index}, dest={"index": tsdb_index_name}, refresh=True,
+                                **options)
+    all_placed = display_reindex_result(resp, source_index, tsdb_index_name)
+    return all_placed, time_series_fields
+
+
+async def create_index_missing_for_docs_async(client: AsyncElasticsearch, session: {} = None):
+    """
+    Same as create_index_missing_for_docs. The index and the pipeline are created at the same time.
+    """
+    session = get_session(session)
+    pipeline_name = session["pipeline"]
+    track_pipeline(session, pipeline_name)
+    put_pipeline = client.ingest.put_pipeline(
+        id=pipeline_name,
+        description="Drop all documents that were not overwritten.",
+        processors=[
+            {
+                "drop": {
+                    "if": "ctx._version == 1"
+                }
+            }
+        ]
+    )
+    await asyncio.gather(create_index_async(client, session["overwritten_docs_index"], session=session), put_pipeline)
+    dest = {
+        "index": session["overwritten_docs_index"],
+        "version_type": "external",
+        "pipeline": pipeline_name
+    }
+    await client.reindex(source={"index": session["tsdb_index"]}, dest=dest, refresh=True)
+
+
+async def get_and_place_documents_batch_async(client: AsyncElasticsearch, semaphore: asyncio.Semaphore,
+                                              data_stream: str, export: {}, searches: [], number_of_docs: int):
+    """
+    Same as get_and_place_documents_batch. The documents are exported in threads, while other requests run.
+    """
+    body = []
+    for _, dimensions_values, dimensions_missing in searches:
+        body.append({"index": data_stream})
+        body.append({"query": build_query(dimensions_values, dimensions_missing), "sort": {"@timestamp": "asc"},
+                     "size": number_of_docs})
+    async with semaphore:
+        res = await client.msearch(searches=body)
+
+    async def write(n: int, dimensions_values: {}, docs: []):
+        async with semaphore:
+            await asyncio.to_thread(export_docs, export, n, dimensions_values, docs)
+
+    writes = []
+    for (n, dimensions_values, _), resp in zip(searches, res["responses"]):
+        if "error" in resp:
+            print("WARNING: Documents for group {} could not be retrieved: {}".format(n, resp["error"]))
+            continue
+        writes.append(write(n, dimensions_values, resp["hits"]["hits"]))
+    await asyncio.gather(*writes)
+
+
+async def get_missing_docs_info_async(client: AsyncElasticsearch, data_stream: str, dimensions: [], display_docs: int,
+                                      dir, get_overlapping_files: bool, copy_docs_per_dimension: int,
+                                      export_format: str = "files", session: {} = None):
+    """
+    Same as get_missing_docs_info. The overwritten documents are retrieved in pages: while a page is displayed and
+    its documents are exported, the next page is already loading.
+    """
+    export = None
+    if get_overlapping_files:
+        export = open_export(dir, export_format)
+        get_overlapping_files = export is not None
+        n = 1
+
+    semaphore = asyncio.Semaphore(async_concurrency)
+    extract = compile_field_extractor(dimensions)
+    index_name = get_session(session)["overwritten_docs_index"]
+
+    async def get_page(start: int):
+        async with semaphore:
+            res = await client.search(index=index_name, query={'match_all': {}}, sort=["_doc"],
+                                      from_=start, size=min(msearch_batch_size, display_docs - start))
+        return [doc["_source"] for doc in res["hits"]["hits"]]
+
+    exports = []
+    start = 0
+    next_page = asyncio.create_task(get_page(start))
+
+    print("The timestamp and dimensions of the first {} overwritten documents are:".format(display_docs))
+    while next_page is not None:
+        overwritten_docs = await next_page
+        start += len(overwritten_docs)
+        next_page = None
+        if len(overwritten_docs) == msearch_batch_size and start < display_docs:
+            next_page = asyncio.create_task(get_page(start))
+
+        searches = []
+        for source in overwritten_docs:
+            dimensions_values, dimensions_missing = display_overwritten_doc(source, dimensions, extract)
+            if get_overlapping_files:
+                searches.append((n, dimensions_values, dimensions_missing))
+                n += 1
+
+        if len(searches) > 0:
+            exports.append(asyncio.create_task(get_and_place_documents_batch_async(
+                client, semaphore, data_stream, export, searches, copy_docs_per_dimension)))
+
+    try:
+        await asyncio.gather(*exports)
+    except BaseException:
+        abort_export(export)
+        raise
+    close_export(export)
+
+
+async def test_data_stream_async(client: AsyncElasticsearch, data_stream_name: str, docs_index: int,
+                                 settings_mappings_index: int, max_docs: int, display_docs: int, dir,
+                                 get_overlapping_files: bool, copy_docs_per_dimension: int,
+                                 export_format: str = "files", session: {} = None):
+    """
+    Run the whole migration test with the async client: create the TSDB index, place the documents and, if
+    any document was overwritten, display its information.
+    The session, if any, and the client are closed at the end.
+    :param client: async ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs: maximum documents to be reindexed.
+    :param display_docs: number of overwritten documents to display.
+    :param dir: name of the directory to place the overwritten documents.
+    :param get_overlapping_files: true if you want to place the overwritten documents in the directory.
+    :param copy_docs_per_dimension: number of documents to get for a set of dimensions.
+    :param export_format: format to export the overwritten documents, "files" or "ndjson".
+    :param session: state of the run, with the names of the indices and the pipeline. If not specified, the
+    default names are used.
+    """
+    try:
+        info = await client.info()
+        print("You're testing with version {}.\n".format(info["version"]["number"]))
+
+        all_placed, time_series_fields = await copy_from_data_stream_async(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index, max_docs, session)
+        if not all_placed:
+            print("Overwritten documents will be placed in new index.")
+            await create_index_missing_for_docs_async(client, session)
+            await get_missing_docs_info_async(client, data_stream_name, time_series_fields["dimension"], display_docs,
+                                              dir, get_overlapping_files, copy_docs_per_dimension, export_format,
+                                              session)
+    finally:
+        try:
+            if session is not None:
+                await close_session_async(client, session)
+        finally:
+            await client.close()
@@ -0,0 +1,227 @@
+"""
+All functions to export the overwritten documents are placed here.
+The documents can be exported as files, one directory per collision group and one JSON file per document, or as a
+single gzip compressed NDJSON stream per run. The stream is written as a sequence of gzip members, and a small index
+file gives the offset of the member with each collision group, so a group can be read without decompressing the
+whole stream.
+The documents being compressed are bounded by export_member_bytes, but the _index and _id of every document
+exported, and the dimensions of every group, are kept in memory until the export is closed. Bounding them is out of
+scope: only the first display_docs collision groups are exported, with at most copy_docs_per_dimension documents
+each, so they grow with these options and not with the size of the index.
+If the export is interrupted, the stream being written is deleted, so a stream that exists is always complete.
+"""
+
+import gzip
+import json
+import os
+import threading
+import zlib
+
+# Formats to export the overwritten documents.
+export_formats = ["files", "ndjson"]
+# Uncompressed bytes of NDJSON buffered before they are compressed as a new gzip member. It bounds the memory used
+# for the documents being exported, and the bytes to decompress to read a group.
+export_member_bytes = 1024 * 1024
+
+
+def write_docs(dir_name: str, n: int, docs: []):
+    """
+    Place the documents in a new directory, one file per document.
+    :param dir_name: Name of the parent directory.
+    :param n: Number of the directory inside the parent directory. Example: 1 would create dir_name/1.
+    :param docs: documents (search hits) to place.
+    """
+    dir_for_docs = os.path.join(dir_name, str(n))
+    os.mkdir(dir_for_docs)
+
+    for doc in docs:
+        name = doc["_id"] + ".json"
+        with open(os.path.join(dir_for_docs, name), 'w') as file:
+            json.dump(doc, file, indent=4)
+
+
+def get_export_paths(path: str):
+    """
+    Get the paths of the NDJSON export.
+    :param path: path of the export, without extension.
+    :return: path of the NDJSON stream and path of its index.
+    """
+    return path + ".ndjson.gz", path + ".index.json"
+
+
+def open_export(path: str, export_format: str = "files"):
+    """
+    Prepare the export of the overwritten documents. Nothing is exported if the files already exist.
+    :param path: directory of the documents for the "files" format. For the "ndjson" format, the stream is written
+    to @path.ndjson.gz and its index to @path.index.json.
+    :param export_format: "files" or "ndjson".
+    :return: state of the export, or None if the documents will not be exported.
+    """
+    if export_format == "files":
+        if os.path.exists(path):
+            print("WARNING: The directory {} exists. Please delete it. Documents will not be placed.\n".format(path))
+            return None
+        os.mkdir(path)
+        return {"format": export_format, "path": path}
+
+    data_path, index_path = get_export_paths(path)
+    for existing_path in [data_path, index_path]:
+        if os.path.exists(existing_path):
+            print("WARNING: The file {} exists. Please delete it. Documents will not be placed.\n"
+                  .format(existing_path))
+            return None
+    return {
+        "format": export_format,
+        "path": data_path,
+        "index_path": index_path,
+        # The stream is renamed when it is complete, so a stream that exists is never half written
+        "file": open(data_path + ".tmp", 'wb'),
+        "lock": threading.Lock(),
+        # _index and _id of every document exported, and the group it was exported with
+        "seen": {},
+        "lines": [],
+        "lines_bytes": 0,
+        "lines_groups": [],
+        "groups": {},
+        "docs": 0,
+        "duplicates": 0
+    }
+
+
+def get_doc_id_key(doc: {}):
+    """
+    Get the key of a document among all the exported ones: its _index and _id.
+    :param doc: document (search hit).
+    :return: key of the document.
+    """
+    return doc.get("_index"), doc["_id"]
+
+
+def flush_export(export: {}):
+    """
+    Compress the lines buffered as a new gzip member of the stream. export["lock"] must be held.
+    :param export: state of the export.
+    """
+    if len(export["lines"]) == 0:
+        return
+    offset = export["file"].tell()
+    export["file"].write(gzip.compress(b"".join(export["lines"])))
+    for n in export["lines_groups"]:
+        export["groups"][n]["offset"] = offset
+    export["lines"] = []
+    export["lines_bytes"] = 0
+    export["lines_groups"] = []
+
+
+def export_docs(export: {}, n: int, dimensions_values: {}, docs: []):
+    """
+    Export the documents of a collision group.
+    In the "ndjson" format, each document is a line tagged with the group. A document already exported with
+    another group is written with just its _id and the group it was exported with (duplicate_of).
+    It can be called from many threads at the same time.
+    :param export: state of the export, as returned by open_export.
+    :param n: number of the collision group.
+    :param dimensions_values: values of the @timestamp and dimensions of the group.
+    :param docs: documents (search hits) of the group.
+    """
+    if export["format"] == "files":
+        write_docs(export["path"], n, docs)
+        return
+
+    lines = []
+    keys = [get_doc_id_key(doc) for doc in docs]
+    with export["lock"]:
+        for doc, key in zip(docs, keys):
+            record = {"group": n, "_index": doc.get("_index"), "_id": doc["_id"]}
+            if key in export["seen"]:
+                record["duplicate_of"] = export["seen"][key]
+                export["duplicates"] += 1
+            else:
+                export["seen"][key] = n
+                record["_source"] = doc.get("_source", {})
+            lines.append((json.dumps(record, default=str) + "\n").encode())
+
+        # All the lines of a group go to the same gzip member
+        export["lines"] += lines
+        export["lines_bytes"] += sum(len(line) for line in lines)
+        export["lines_groups"].append(n)
+        export["groups"][n] = {"dimensions": dimensions_values, "docs": len(docs)}
+        export["docs"] += len(docs)
+        if export["lines_bytes"] >= export_member_bytes:
+            flush_export(export)
+
+
+def close_export(export: {}):
+    """
+    Finish the export of the overwritten documents. In the "ndjson" format, the stream is completed and its index
+    written.
+    :param export: state of the export, as returned by open_export. Nothing is done if it is None.
+    """
+    if export is None or export["format"] == "files":
+        return
+
+    with export["lock"]:
+        try:
+            flush_export(export)
+            export["file"].close()
+            os.replace(export["path"] + ".tmp", export["path"])
+        except BaseException:
+            abort_export(export)
+            raise
+
+        index = {
+            "file": os.path.basename(export["path"]),
+            "groups": {str(n): export["groups"][n] for n in sorted(export["groups"])}
+        }
+        tmp_path = export["index_path"] + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file, indent=4, default=str)
+        os.replace(tmp_path, export["index_path"])
+
+    print("{} documents exported to {} ({} already exported with another group). The index of the groups is {}."
+          .format(export["docs"], export["path"], export["duplicates"], export["index_path"]))
+
+
+def abort_export(export: {}):
+    """
+    Stop an export that cannot be completed. In the "ndjson" format, the stream being written is closed and deleted.
+    The files already written in the "files" format are kept.
+    :param export: state of the export, as returned by open_export. Nothing is done if it is None.
+    """
+    if export is None or export["format"] == "files":
+        return
+    export["file"].close()
+    tmp_path = export["path"] + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def read_export_group(path: str, n: int):
+    """
+    Read the documents of a collision group from an NDJSON export. Only the gzip member with the group is read.
+    :param path: path of the export, without extension, as given to open_export.
+    :param n: number of the collision group.
+    :return: records of the group, in the order they were exported. Empty if the group was not exported.
+    """
+    data_path, index_path = get_export_paths(path)
+    with open(index_path) as file:
+        group = json.load(file)["groups"].get(str(n))
+    if group is None:
+        return []
+
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    data = []
+    with open(data_path, 'rb') as file:
+        file.seek(group["offset"])
+        while not decompressor.eof:
+            chunk = file.read(64 * 1024)
+            if len(chunk) == 0:
+                break
+            data.append(decompressor.decompress(chunk))
+
+    records = []
+    for line in b"".join(data).splitlines():
+        record = json.loads(line)
+        if record["group"] == n:
+            records.append(record)
+    return records
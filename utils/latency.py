@@ -0,0 +1,194 @@
+"""
+All functions to compare the query latency of the source index and the TSDB index are placed here.
+Queries like the ones of a metrics dashboard are built from the time series fields: date histograms with the
+average and maximum of the gauges, split by dimension or not, the rate of the counters, and the top terms of the
+dimension with the most values. Each query runs on both indices, alternating them, after some warm up runs.
+"""
+
+import numpy as np
+
+from utils.sampling import *
+
+# Number of runs of each query on each index before the latency is measured.
+latency_warmup = 3
+# Number of measured runs of each query on each index.
+latency_repetitions = 20
+# Number of buckets of the date histograms.
+latency_histogram_buckets = 100
+# Maximum number of gauges, counters and dimensions used to build the queries.
+latency_max_fields = 3
+# Number of terms of the terms aggregations.
+latency_split_terms = 10
+latency_top_terms = 100
+# Percentiles of the latency displayed.
+latency_percentiles = [50, 95, 99]
+
+
+def get_metric_aggs(gauges: []):
+    """
+    Get the average and maximum aggregations of the gauges.
+    :param gauges: list of gauge fields.
+    :return: aggregations.
+    """
+    aggs = {}
+    for gauge in gauges:
+        aggs["avg-" + gauge] = {"avg": {"field": gauge}}
+        aggs["max-" + gauge] = {"max": {"field": gauge}}
+    return aggs
+
+
+def get_highest_cardinality_dimension(client: Elasticsearch, index_name: str, dimensions: []):
+    """
+    Get the dimension with the most distinct values.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param dimensions: list of dimension fields.
+    :return: name of the dimension.
+    """
+    aggs = {dimension: {"cardinality": {"field": dimension}} for dimension in dimensions}
+    res = client.search(index=index_name, size=0, aggs=aggs)
+    return max(dimensions, key=lambda dimension: res["aggregations"][dimension]["value"])
+
+
+def get_latency_queries(client: Elasticsearch, index_name: str, time_series_fields: {}):
+    """
+    Build the queries of the benchmark from the time series fields. All of them filter the @timestamp range of the
+    documents of @index_name.
+    :param client: ES client.
+    :param index_name: name of the index used to get the @timestamp range and the cardinality of the dimensions.
+    :param time_series_fields: time series fields of the TSDB index.
+    :return: name and body of each query.
+    """
+    first, last, n_docs = get_timestamp_range(client, index_name)
+    if n_docs == 0:
+        return {}
+    interval = "{}ms".format(max(1000, (last - first) // latency_histogram_buckets + 1))
+    query = {"range": {"@timestamp": {"gte": first, "lte": last, "format": "epoch_millis"}}}
+    gauges = time_series_fields["gauge"][:latency_max_fields]
+    counters = time_series_fields["counter"][:latency_max_fields]
+    dimensions = time_series_fields["dimension"]
+
+    def date_histogram(aggs: {}):
+        return {"date_histogram": {"field": "@timestamp", "fixed_interval": interval}, "aggs": aggs}
+
+    queries = {"date_histogram": {"query": query, "aggs": {"histogram": date_histogram(get_metric_aggs(gauges))}}}
+    for dimension in dimensions[:latency_max_fields]:
+        queries["date_histogram by " + dimension] = {"query": query, "aggs": {"split": {
+            "terms": {"field": dimension, "size": latency_split_terms},
+            "aggs": {"histogram": date_histogram(get_metric_aggs(gauges))}}}}
+    if len(counters) > 0:
+        rates = {"rate-" + counter: {"rate": {"field": counter, "unit": "second"}} for counter in counters}
+        queries["rate of counters"] = {"query": query, "aggs": {"histogram": date_histogram(rates)}}
+    if len(dimensions) > 0:
+        dimension = get_highest_cardinality_dimension(client, index_name, dimensions)
+        queries["top terms of " + dimension] = {"query": query, "aggs": {"top": {
+            "terms": {"field": dimension, "size": latency_top_terms}, "aggs": get_metric_aggs(gauges[:1])}}}
+    return queries
+
+
+def time_query(client: Elasticsearch, index_name: str, body: {}):
+    """
+    Run a query and measure its latency. The request cache is not used, so every run is computed again.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param body: query and aggregations.
+    :return: latency, in milliseconds, as seen by the client.
+    """
+    start = time.perf_counter()
+    client.search(index=index_name, size=0, request_cache=False, **body)
+    return (time.perf_counter() - start) * 1000
+
+
+def run_latency_benchmark(client: Elasticsearch, indices: [], queries: {}, warmup: int, repetitions: int):
+    """
+    Run every query on every index and measure its latency. The runs of the indices are interleaved, so changes in
+    the load of the cluster affect all of them the same.
+    :param client: ES client.
+    :param indices: names of the indices.
+    :param queries: name and body of each query.
+    :param warmup: number of runs not measured.
+    :param repetitions: number of runs measured.
+    :return: for each query, the latencies on each index in milliseconds, or the error of the query on the index.
+    """
+    results = {}
+    for name, body in queries.items():
+        results[name] = {}
+        for index_name in indices:
+            try:
+                for _ in range(warmup):
+                    time_query(client, index_name, body)
+                results[name][index_name] = []
+            except Exception as e:
+                results[name][index_name] = str(e)
+        for _ in range(repetitions):
+            for index_name in indices:
+                if not isinstance(results[name][index_name], list):
+                    continue
+                try:
+                    results[name][index_name].append(time_query(client, index_name, body))
+                except Exception as e:
+                    # Like a timeout, or a query rejected by a busy cluster. The index is not measured again
+                    results[name][index_name] = str(e)
+    return results
+
+
+def display_latency_results(results: {}, source_index: str, dest_index: str):
+    """
+    Display the latency percentiles of each query on both indices, and the speedup of the TSDB index.
+    :param results: latencies of each query, as returned by run_latency_benchmark.
+    :param source_index: name of the source index.
+    :param dest_index: name of the TSDB index.
+    :return: percentiles of each query on each index, and speedup of the median latency.
+    """
+    report = {}
+    for name, latencies in results.items():
+        print("\t- {}:".format(name))
+        report[name] = {}
+        for index_name in [source_index, dest_index]:
+            if not isinstance(latencies[index_name], list):
+                print("\t\t{}: ERROR: {}".format(index_name, latencies[index_name]))
+                report[name][index_name] = {"error": latencies[index_name]}
+                continue
+            percentiles = np.percentile(latencies[index_name], latency_percentiles)
+            report[name][index_name] = {"p{}".format(p): float(value)
+                                        for p, value in zip(latency_percentiles, percentiles)}
+            print("\t\t{}: {}.".format(index_name, ", ".join("p{} {:.1f}ms".format(p, value)
+                                                             for p, value in zip(latency_percentiles, percentiles))))
+        if "p50" in report[name][source_index] and "p50" in report[name][dest_index]:
+            speedup = report[name][source_index]["p50"] / max(report[name][dest_index]["p50"], 1e-9)
+            report[name]["speedup"] = speedup
+            print("\t\tSpeedup of the TSDB index: {:.2f}x.".format(speedup))
+    print()
+    return report
+
+
+@profile_stage("benchmark_query_latency")
+def benchmark_query_latency(client: Elasticsearch, data_stream_name: str, docs_index: int, dest_index: str,
+                            time_series_fields: {}, warmup: int = latency_warmup,
+                            repetitions: int = latency_repetitions):
+    """
+    Compare the latency of dashboard-like queries on the source index and the TSDB index.
+    The queries filter the @timestamp range of the TSDB index, so if not all documents were copied (max_docs), both
+    indices are queried over the same time span, even though the source index might have more documents in it.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index used to retrieve the documents.
+    :param dest_index: name of the TSDB index, or comma-separated names of the TSDB indices the documents were
+    copied to. They are queried together.
+    :param time_series_fields: time series fields of the TSDB index.
+    :param warmup: number of runs of each query on each index before measuring.
+    :param repetitions: number of measured runs of each query on each index.
+    :return: latency percentiles of each query on each index, and speedup of the median latency.
+    """
+    data_stream = client.indices.get_data_stream(name=data_stream_name)["data_streams"][0]
+    # The number of the index was already checked when the documents were copied
+    source_index = data_stream["indices"][max(docs_index, 0)]["index_name"]
+
+    queries = get_latency_queries(client, dest_index, time_series_fields)
+    if len(queries) == 0:
+        print("Index {} has no documents. Query latency will not be compared.\n".format(dest_index))
+        return {}
+    print("Comparing the latency of {} queries on indices {} and {} ({} warm up runs, {} measured runs)...".format(
+        len(queries), source_index, dest_index, warmup, repetitions))
+    results = run_latency_benchmark(client, [source_index, dest_index], queries, warmup, repetitions)
+    return display_latency_results(results, source_index, dest_index)
@@ -0,0 +1,356 @@
+"""
+All functions to find the overwritten documents in exported files, without a cluster, are placed here.
+The files are memory-mapped and split in chunks, and the chunks are read by a pool of processes:
+1. Each process hashes the (dimensions, @timestamp) key of the documents of its chunk, and writes the hash and
+   location of each document to one shard file per hash range.
+2. Each process takes a shard and looks for the hashes that appear more than once. Since all the documents with
+   the same key are in the same shard, the shards are checked independently. Documents with the same hash are
+   read again and compared by their key, so the collisions are exact.
+"""
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import mmap
+import shutil
+import tempfile
+
+import numpy as np
+
+from utils.collisions import *
+
+# Size of the chunks the files are split in, in bytes.
+chunk_bytes = 64 * 1024 * 1024
+# Number of shard files per process. More shards use less memory per shard.
+shards_per_process = 4
+# Each location of a document is written as three unsigned 64 bit integers: hash, file number and offset.
+location_size = 3
+
+
+def read_mappings(mappings_path: str):
+    """
+    Read the mappings from a JSON file. The file can have an index template, the response of the get mapping API
+    or just the mappings.
+    :param mappings_path: path to the file.
+    :return: mappings.
+    """
+    if not os.path.isfile(mappings_path):
+        raise MigrationError("File {} with the mappings does not exist.".format(mappings_path))
+    with open(mappings_path) as file:
+        content = json.load(file)
+    if "index_templates" in content:
+        content = content["index_templates"][0]["index_template"]
+    if "template" in content:
+        content = content["template"]
+    if "mappings" not in content and len(content) == 1:
+        content = next(iter(content.values()))
+    return content.get("mappings", content)
+
+
+def get_timestamp_millis(timestamp):
+    """
+    Get the @timestamp of a document in milliseconds, so different formats of the same date have the same key.
+    :param timestamp: @timestamp of the document, as a date string or in milliseconds.
+    :return: @timestamp in milliseconds, or the same value if it cannot be parsed.
+    """
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    try:
+        date = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return timestamp
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def get_exact_key(source: {}, extract):
+    """
+    Get the (dimensions, @timestamp) key of a document.
+    :param source: _source of the document.
+    :param extract: function to get the value of the dimensions, as returned by compile_field_extractor.
+    :return: dimension values and @timestamp in milliseconds.
+    """
+    return extract(source), get_timestamp_millis(source.get("@timestamp"))
+
+
+def parse_line(line: bytes):
+    """
+    Get the _source of a document from a line of an exported file. The line can have the _source or a search hit.
+    :param line: line of the file.
+    :return: the document as a hit, with the _source and _id (if any), or None if the line is not a document.
+    """
+    line = line.strip()
+    if len(line) == 0:
+        return None
+    try:
+        doc = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(doc, dict):
+        return None
+    if "_source" in doc:
+        return doc
+    return {"_source": doc}
+
+
+def read_doc_at(mapped_file: mmap.mmap, offset: int):
+    """
+    Read the document of the line starting at an offset.
+    :param mapped_file: memory-mapped file.
+    :param offset: offset of the line.
+    :return: the document as a hit.
+    """
+    end = mapped_file.find(b"\n", offset)
+    if end == -1:
+        end = len(mapped_file)
+    return parse_line(mapped_file[offset:end])
+
+
+def open_mapped_files(paths: []):
+    """
+    Memory-map the files. Empty files are not mapped.
+    :param paths: path of each file.
+    :return: list of (file, memory-mapped file or None).
+    """
+    mapped_files = []
+    for path in paths:
+        file = open(path, 'rb')
+        mapped_file = None
+        if os.path.getsize(path) > 0:
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        mapped_files.append((file, mapped_file))
+    return mapped_files
+
+
+def close_mapped_files(mapped_files: []):
+    for file, mapped_file in mapped_files:
+        if mapped_file is not None:
+            mapped_file.close()
+        file.close()
+
+
+def hash_chunk(path: str, file_n: int, start: int, end: int, dimensions: [], shard_paths: []):
+    """
+    Hash the key of the documents whose line starts in the chunk, and write their location to the shard files.
+    :param path: path to the file.
+    :param file_n: number of the file.
+    :param start: first byte of the chunk.
+    :param end: byte after the last one of the chunk.
+    :param dimensions: list of dimension fields.
+    :param shard_paths: path of the file of each shard, with the chunk as a suffix.
+    :return: number of documents, and number of lines that are not documents.
+    """
+    extract = compile_field_extractor(dimensions)
+    shards = [array("Q") for _ in shard_paths]
+    n_docs = 0
+    n_invalid = 0
+    (file, mapped_file), = open_mapped_files([path])
+    try:
+        pos = start
+        if start > 0:
+            pos = mapped_file.find(b"\n", start - 1) + 1
+            if pos == 0:
+                pos = end
+        while pos < end:
+            line_end = mapped_file.find(b"\n", pos)
+            if line_end == -1:
+                line_end = len(mapped_file)
+            doc = parse_line(mapped_file[pos:line_end])
+            if doc is not None:
+                values, timestamp = get_exact_key(doc["_source"], extract)
+                key = get_doc_key(values, timestamp)
+                shards[key % len(shards)].extend((key, file_n, pos))
+                n_docs += 1
+            elif len(mapped_file[pos:line_end].strip()) > 0:
+                n_invalid += 1
+            pos = line_end + 1
+    finally:
+        close_mapped_files([(file, mapped_file)])
+
+    for shard, shard_path in zip(shards, shard_paths):
+        if len(shard) > 0:
+            with open(shard_path, 'wb') as file:
+                shard.tofile(file)
+    return n_docs, n_invalid
+
+
+def find_shard_collisions(shard_paths: [], paths: [], dimensions: []):
+    """
+    Find the documents of a shard with the same key.
+    :param shard_paths: paths to the files of the shard, one per chunk.
+    :param paths: path of each input file.
+    :param dimensions: list of dimension fields.
+    :return: collision groups, each one a list of (file number, offset) of its documents, in the order they appear.
+    """
+    locations = [np.fromfile(shard_path, dtype=np.uint64) for shard_path in shard_paths if os.path.isfile(shard_path)]
+    if len(locations) == 0:
+        return []
+    locations = np.concatenate(locations).reshape(-1, location_size)
+
+    # Sort the hashes, and only build the list of locations of the ones that appear more than once
+    order = np.argsort(locations[:, 0], kind="stable")
+    keys = locations[order, 0]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys)))
+    repeated = counts > 1
+    if not repeated.any():
+        return []
+    members = locations[order[np.repeat(repeated, counts)], 1:].tolist()
+    bounds = np.cumsum(counts[repeated])[:-1].tolist()
+    candidates = [members[start:end] for start, end in zip([0] + bounds, bounds + [len(members)])]
+
+    # Two different keys could have the same hash, so the documents are compared by their key
+    extract = compile_field_extractor(dimensions)
+    mapped_files = open_mapped_files(paths)
+    groups = []
+    try:
+        for candidate in candidates:
+            same_key = {}
+            for file_n, offset in sorted(candidate):
+                doc = read_doc_at(mapped_files[file_n][1], offset)
+                key = json.dumps(get_exact_key(doc["_source"], extract), default=str)
+                same_key.setdefault(key, []).append((file_n, offset))
+            groups += [group for group in same_key.values() if len(group) > 1]
+    finally:
+        close_mapped_files(mapped_files)
+    return groups
+
+
+def decompress_files(paths: [], work_dir: str, executor: ProcessPoolExecutor):
+    """
+    Decompress the gzip files to the work directory, since they cannot be memory-mapped.
+    :param paths: path of each input file.
+    :param work_dir: directory for the decompressed files.
+    :param executor: executor to decompress the files.
+    :return: path of each file to read.
+    """
+    futures = {}
+    for n, path in enumerate(paths):
+        if path.endswith(".gz"):
+            futures[n] = executor.submit(decompress_file, path, os.path.join(work_dir, "input-{}".format(n)))
+    return [futures[n].result() if n in futures else path for n, path in enumerate(paths)]
+
+
+def decompress_file(path: str, dest_path: str):
+    with gzip.open(path, 'rb') as source, open(dest_path, 'wb') as dest:
+        shutil.copyfileobj(source, dest)
+    return dest_path
+
+
+def get_input_files(paths: []):
+    """
+    Get the files to analyze. Folders are replaced by the files they have.
+    :param paths: paths to files or folders.
+    :return: sorted list of files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if os.path.isfile(os.path.join(path, name)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise MigrationError("Path {} does not exist.".format(path))
+    return files
+
+
+def find_overwritten_docs_offline(paths: [], dimensions: [], n_processes: int):
+    """
+    Find the documents of the files that would be overwritten in a TSDB index.
+    :param paths: path of each NDJSON file, gzip compressed or not.
+    :param dimensions: list of dimension fields.
+    :param n_processes: number of processes.
+    :return: number of documents, number of overwritten documents, and the collision groups. Each group is a list
+    of the documents (as hits) with the same key, in the order they appear in the files.
+    """
+    work_dir = tempfile.mkdtemp(prefix="tsdb-offline-")
+    try:
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            mapped_paths = decompress_files(paths, work_dir, executor)
+
+            n_shards = n_processes * shards_per_process
+            chunks = []
+            for file_n, path in enumerate(mapped_paths):
+                size = os.path.getsize(path)
+                chunks += [(path, file_n, start, min(start + chunk_bytes, size))
+                           for start in range(0, size, chunk_bytes)]
+            print("Reading {} files in {} chunks with {} processes...".format(len(paths), len(chunks), n_processes))
+            futures = [executor.submit(hash_chunk, path, file_n, start, end, dimensions,
+                                       [os.path.join(work_dir, "shard-{}-{}".format(shard, n))
+                                        for shard in range(n_shards)])
+                       for n, (path, file_n, start, end) in enumerate(chunks)]
+            results = [future.result() for future in futures]
+            n_docs = sum(docs for docs, _ in results)
+            n_invalid = sum(invalid for _, invalid in results)
+            if n_invalid > 0:
+                print("WARNING: {} lines are not JSON documents and were ignored.".format(n_invalid))
+
+            futures = [executor.submit(find_shard_collisions,
+                                       [os.path.join(work_dir, "shard-{}-{}".format(shard, n))
+                                        for n in range(len(chunks))], mapped_paths, dimensions)
+                       for shard in range(n_shards)]
+            groups = sorted(group for future in futures for group in future.result())
+
+        mapped_files = open_mapped_files(mapped_paths)
+        try:
+            docs_groups = []
+            for group in groups:
+                docs = []
+                for file_n, offset in group:
+                    doc = read_doc_at(mapped_files[file_n][1], offset)
+                    # The files of the documents are named after the _id, so documents without one get their location
+                    doc.setdefault("_id", "{}-{}".format(file_n, offset))
+                    docs.append(doc)
+                docs_groups.append(docs)
+        finally:
+            close_mapped_files(mapped_files)
+    finally:
+        shutil.rmtree(work_dir)
+
+    n_overwritten = sum(len(group) - 1 for group in docs_groups)
+    return n_docs, n_overwritten, docs_groups
+
+
+def analyze_files(paths: [], mappings_path: str, n_processes: int, display_docs: int, dir,
+                  get_overlapping_files: bool, copy_docs_per_dimension: int, export_format: str = "files"):
+    """
+    Given exported files of an index and its mappings, find the documents that would be overwritten in a TSDB
+    index, and display them as get_missing_docs_info does.
+    :param paths: paths to the NDJSON files (gzip compressed or not), or to folders with them.
+    :param mappings_path: path to the JSON file with the mappings.
+    :param n_processes: number of processes.
+    :param display_docs: number of overwritten documents to display.
+    :param dir: name of the directory to place the overwritten documents.
+    :param get_overlapping_files: true if you want to place the overwritten documents in the directory.
+    :param copy_docs_per_dimension: number of documents to place for a set of dimensions.
+    :param export_format: format to export the overwritten documents, "files" or "ndjson".
+    :return: True if no document would be overwritten, False otherwise.
+    """
+    paths = get_input_files(paths)
+    time_series_fields = get_time_series_fields(read_mappings(mappings_path))
+    dimensions = time_series_fields["dimension"]
+
+    n_docs, n_overwritten, groups = find_overwritten_docs_offline(paths, dimensions, n_processes)
+    if n_overwritten == 0:
+        print("All {} documents taken from the files would be placed in a TSDB index.\n".format(n_docs))
+        return True
+    print("WARNING: Out of {} documents from the files, {} of them would be discarded ({} sets of "
+          "dimensions).\n".format(n_docs, n_overwritten, len(groups)))
+
+    export = open_export(dir, export_format) if get_overlapping_files else None
+
+    extract = compile_field_extractor(dimensions)
+    print("The timestamp and dimensions of the first {} overwritten documents are:".format(display_docs))
+    try:
+        for n, group in enumerate(groups[:display_docs], 1):
+            dimensions_values, _ = display_overwritten_doc(group[0]["_source"], dimensions, extract)
+            if export is not None:
+                export_docs(export, n, dimensions_values, group[:copy_docs_per_dimension])
+    except BaseException:
+        abort_export(export)
+        raise
+    close_export(export)
+    return False
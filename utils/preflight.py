@@ -0,0 +1,182 @@
+"""
+All functions to find the documents that a TSDB index would reject, before reindexing them, are placed here.
+A single search on the source index counts them: a runtime field checks the dimensions of the _source of each
+document, and filters check the @timestamp. A few documents of each problem are displayed.
+"""
+
+from utils.es import *
+
+# Elasticsearch rejects dimension values longer than this, in bytes.
+dimension_max_bytes = 1024
+# Elasticsearch rejects documents whose dimensions (names and values) add up to more than this, in bytes.
+tsid_max_bytes = 32766
+# Default maximum number of dimension fields of an index (index.mapping.dimension_fields.limit) in Elasticsearch 8.x.
+dimension_fields_limit = 16
+# Maximum number of documents checked per shard. -1 checks all documents.
+preflight_max_docs_per_shard = 1000000
+# Number of documents displayed for each problem.
+preflight_samples = 3
+
+# Runtime field that emits one value per problem of the document.
+preflight_script = """
+int utf8Length(String value) {
+    int length = 0;
+    for (int i = 0; i < value.length(); i++) {
+        char c = value.charAt(i);
+        if (c < 0x80) { length += 1; }
+        // Each half of a surrogate pair counts 2 of the 4 bytes of the character
+        else if (c < 0x800 || (c >= 0xD800 && c <= 0xDFFF)) { length += 2; }
+        else { length += 3; }
+    }
+    return length;
+}
+
+def getValue(Map source, String path) {
+    if (source.containsKey(path)) {
+        return source.get(path);
+    }
+    def obj = source;
+    for (String key : path.splitOnToken('.')) {
+        if (obj instanceof Map && obj.containsKey(key)) {
+            obj = obj.get(key);
+        } else {
+            return null;
+        }
+    }
+    return obj;
+}
+
+long total = 0;
+boolean routed = false;
+for (String dimension : params.dimensions) {
+    def value = getValue(params._source, dimension);
+    if (value instanceof List) {
+        if (value.size() > 1) {
+            emit('array dimension: ' + dimension);
+        }
+        value = value.size() > 0 ? value.get(0) : null;
+    }
+    if (value == null) {
+        continue;
+    }
+    if (value instanceof Map) {
+        emit('object dimension: ' + dimension);
+        continue;
+    }
+    int length = utf8Length(value.toString());
+    total += utf8Length(dimension) + length;
+    if (length > params.dimension_max_bytes) {
+        emit('dimension too long: ' + dimension);
+    }
+    if (params.routing_path.contains(dimension)) {
+        routed = true;
+    }
+}
+if (!routed) {
+    emit('no routing_path value');
+}
+if (total > params.tsid_max_bytes) {
+    emit('dimensions too long');
+}
+"""
+
+
+def get_sample_aggs(dimensions: []):
+    """
+    Get the aggregation with the first documents of a problem.
+    :param dimensions: list of dimension fields.
+    :return: aggregations.
+    """
+    return {"samples": {"top_hits": {"size": preflight_samples, "_source": {"includes": ["@timestamp"] + dimensions}}}}
+
+
+def find_rejected_docs(client: Elasticsearch, index_name: str, time_series_fields: {}, settings: {},
+                       max_docs_per_shard: int = preflight_max_docs_per_shard):
+    """
+    Count the documents of an index that a TSDB index would reject, with a single search.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param time_series_fields: time series fields of the TSDB index.
+    :param settings: settings of the TSDB index, with its time_series start_time and end_time.
+    :param max_docs_per_shard: maximum number of documents checked per shard. -1 checks all documents.
+    :return: number of documents checked, and the number of documents and first documents of each problem.
+    """
+    dimensions = time_series_fields["dimension"]
+    time_series = settings["index"]["time_series"]
+    runtime_mappings = {"tsdb_preflight": {"type": "keyword", "script": {"source": preflight_script, "params": {
+        "dimensions": dimensions,
+        "routing_path": time_series_fields["routing_path"],
+        "dimension_max_bytes": dimension_max_bytes,
+        "tsid_max_bytes": tsid_max_bytes
+    }}}}
+    outside_window = {"bool": {"minimum_should_match": 1, "should": [
+        {"range": {"@timestamp": {"lt": time_series["start_time"]}}},
+        {"range": {"@timestamp": {"gte": time_series["end_time"]}}}
+    ]}}
+    aggs = {
+        "problems": {"terms": {"field": "tsdb_preflight", "size": 100}, "aggs": get_sample_aggs(dimensions)},
+        "outside_window": {"filter": outside_window, "aggs": get_sample_aggs(dimensions)},
+        "missing_timestamp": {"missing": {"field": "@timestamp"}, "aggs": get_sample_aggs(dimensions)}
+    }
+    options = {}
+    if max_docs_per_shard != -1:
+        options["terminate_after"] = max_docs_per_shard
+    res = client.search(index=index_name, size=0, track_total_hits=True, runtime_mappings=runtime_mappings,
+                        aggs=aggs, **options)
+
+    problems = {}
+    for bucket in res["aggregations"]["problems"]["buckets"]:
+        problems[bucket["key"]] = bucket
+    if res["aggregations"]["outside_window"]["doc_count"] > 0:
+        problems["@timestamp outside of the time series window"] = res["aggregations"]["outside_window"]
+    if res["aggregations"]["missing_timestamp"]["doc_count"] > 0:
+        problems["missing @timestamp"] = res["aggregations"]["missing_timestamp"]
+    return res["hits"]["total"]["value"], {problem: {"doc_count": agg["doc_count"],
+                                                      "samples": agg["samples"]["hits"]["hits"]}
+                                           for problem, agg in problems.items()}
+
+
+@profile_stage("preflight_check")
+def preflight_check(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int,
+                    max_docs_per_shard: int = preflight_max_docs_per_shard):
+    """
+    Given a data stream, display the documents of the given index that a TSDB index would reject, and whether the
+    TSDB index would have too many dimension fields. No index is created.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param max_docs_per_shard: maximum number of documents checked per shard. -1 checks all documents.
+    :return: True if no document would be rejected, False otherwise.
+    """
+    print("Running preflight checks on data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+    dimensions = time_series_fields["dimension"]
+
+    limit = int(settings["index"].get("mapping", {}).get("dimension_fields", {}).get("limit", dimension_fields_limit))
+    if len(dimensions) > limit:
+        print("WARNING: The TSDB index has {} dimension fields. Versions of Elasticsearch with a limit of {} "
+              "(index.mapping.dimension_fields.limit) will not create it.".format(len(dimensions), limit))
+
+    start = time.time()
+    n_docs, problems = find_rejected_docs(client, source_index, time_series_fields, settings, max_docs_per_shard)
+    print("Checked {} documents of index {} in {:.1f}s.".format(n_docs, source_index, time.time() - start))
+    if len(problems) == 0:
+        print("No document would be rejected by the TSDB index.\n")
+        return True
+
+    extract = compile_field_extractor(dimensions)
+    print("WARNING: Some documents would be rejected by the TSDB index:")
+    for problem, result in problems.items():
+        print("\t- {}: {} documents. For example:".format(problem, result["doc_count"]))
+        for hit in result["samples"]:
+            values = ", ".join("{}: {}".format(dimension, str(value)[:100])
+                               for dimension, value in zip(dimensions, extract(hit["_source"])))
+            print("\t\t- {} (@timestamp {}) {}".format(hit["_id"], hit["_source"].get("@timestamp"), values))
+    print()
+    return False
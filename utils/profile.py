@@ -0,0 +1,275 @@
+"""
+All functions to profile a run are placed here.
+When profiling is started, every request of the ES client is counted in the stage that sent it: the innermost
+function decorated with profile_stage that is running in the same thread, or "other" if there is none. Functions
+submitted to a thread pool with carry_stage run in the stages of the thread that submitted them, and the requests of
+other threads (like the ones of the bulk helpers) are counted in the stage of the thread that started the profile.
+The profile can then be written as JSON and in the Prometheus textfile format.
+"""
+
+from datetime import datetime, timezone
+
+import functools
+import json
+import os
+import threading
+import time
+
+# Keys of the reindex responses (or of the response of a finished reindex task) added up for each stage.
+reindex_stats = ["total", "created", "updated", "deleted", "noops", "version_conflicts", "batches",
+                 "throttled_millis"]
+# Prefix of the Prometheus metrics.
+metrics_prefix = "tsdb_migration"
+
+# State of the profile. None if the run is not being profiled.
+profile_state = None
+profile_lock = threading.Lock()
+# Stages running in each thread, the innermost last.
+profile_stack = threading.local()
+
+
+def new_stage_stats():
+    """
+    Get the stats of a stage that did not run yet.
+    :return: stats of the stage.
+    """
+    return {
+        "calls": 0,
+        "wall_seconds": 0.0,
+        "requests": 0,
+        "request_bytes": 0,
+        "response_bytes": 0,
+        "server_took_millis": 0,
+        "reindex": {stat: 0 for stat in reindex_stats}
+    }
+
+
+def get_stage_stack():
+    """
+    Get the stages running in the current thread.
+    :return: list of the names of the stages, the innermost last.
+    """
+    if not hasattr(profile_stack, "stages"):
+        profile_stack.stages = []
+    return profile_stack.stages
+
+
+def get_current_stage_stats():
+    """
+    Get the stats of the stage running in the current thread, or in the thread that started the profile if there
+    is none. profile_lock must be held.
+    :return: stats of the stage.
+    """
+    stack = get_stage_stack() or profile_state["main_stack"]
+    name = stack[-1] if len(stack) > 0 else "other"
+    return profile_state["stages"].setdefault(name, new_stage_stats())
+
+
+def add_response_stats(stats: {}, target: str, body):
+    """
+    Add the time spent by Elasticsearch, and the reindex stats, of a response to the stats of a stage.
+    :param stats: stats of the stage.
+    :param target: path of the request.
+    :param body: response.
+    """
+    if not isinstance(body, dict):
+        return
+    if target.startswith("/_tasks/"):
+        # Reindex tasks are polled until they finish. Only the response of the finished task is counted.
+        if not body.get("completed") or "response" not in body:
+            return
+        body = body["response"]
+    if isinstance(body.get("took"), int):
+        stats["server_took_millis"] += body["took"]
+    if "_reindex" in target or target.startswith("/_tasks/"):
+        for stat in reindex_stats:
+            if isinstance(body.get(stat), int):
+                stats["reindex"][stat] += body[stat]
+
+
+def start_profile(client):
+    """
+    Start counting the requests of the client, and their bytes, in the stage that sends them.
+    The requests are counted when they reach the transport of the client, so the clients created from it
+    (like the ones used by the bulk helpers) are counted as well.
+    :param client: ES client.
+    """
+    global profile_state
+    profile_state = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "start": time.perf_counter(),
+        "main_stack": get_stage_stack(),
+        "stages": {}
+    }
+
+    transport = client.transport
+    transport_perform_request = transport.perform_request
+
+    def perform_request(method, target, **kwargs):
+        resp = transport_perform_request(method, target, **kwargs)
+        with profile_lock:
+            stats = get_current_stage_stats()
+            stats["requests"] += 1
+            add_response_stats(stats, target, resp.body)
+        return resp
+
+    transport.perform_request = perform_request
+
+    # The nodes send the serialized (and compressed, if enabled) bodies, which are the bytes sent over the network
+    for node in transport.node_pool.all():
+        node.perform_request = count_node_bytes(node.perform_request)
+
+
+def count_node_bytes(node_perform_request):
+    """
+    Count the bytes sent and received by a node.
+    :param node_perform_request: perform_request function of the node.
+    :return: same function, counting the bytes in the stage running.
+    """
+    def perform_request(method, target, body=None, **kwargs):
+        resp = node_perform_request(method, target, body=body, **kwargs)
+        with profile_lock:
+            stats = get_current_stage_stats()
+            stats["request_bytes"] += len(body) if body is not None else 0
+            stats["response_bytes"] += len(resp.body) if resp.body is not None else 0
+        return resp
+
+    return perform_request
+
+
+def profile_stage(name: str):
+    """
+    Decorator to count the time and requests of a function in the stage @name when the run is profiled.
+    Time is counted for every call of the function, including the time of the stages it runs. Requests are only
+    counted in the innermost stage of the thread that sends them, so the stages of many threads can run at the same
+    time.
+    :param name: name of the stage.
+    :return: decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if profile_state is None:
+                return function(*args, **kwargs)
+            stack = get_stage_stack()
+            with profile_lock:
+                stack.append(name)
+                stats = get_current_stage_stats()
+                stats["calls"] += 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with profile_lock:
+                    stats["wall_seconds"] += time.perf_counter() - start
+                    stack.pop()
+        return wrapper
+
+    return decorator
+
+
+def carry_stage(function):
+    """
+    Get a function to submit to a thread pool, that runs @function in the stages running in the current thread, so
+    the requests it sends are counted in them.
+    :param function: function to run in another thread.
+    :return: function that runs @function.
+    """
+    stages = list(get_stage_stack())
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = get_stage_stack()
+        profile_stack.stages = stages + previous
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile_stack.stages = previous
+
+    return wrapper
+
+
+def get_prometheus_labels(labels: {}):
+    """
+    Format labels for the Prometheus textfile format.
+    :param labels: name and value of each label.
+    :return: labels between braces.
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join("{}=\"{}\"".format(name, escape(value)) for name, value in labels.items()) + "}"
+
+
+def get_prometheus_metrics(report: {}):
+    """
+    Get the profile in the Prometheus textfile format. Every metric is a gauge with the value of this run.
+    :param report: profile, as written to the JSON file.
+    :return: content of the textfile.
+    """
+    metrics = {
+        "stage_calls": ("Number of times the stage ran.", lambda stats: stats["calls"]),
+        "stage_duration_seconds": ("Wall time of the stage.", lambda stats: stats["wall_seconds"]),
+        "stage_requests": ("Number of Elasticsearch requests sent by the stage.", lambda stats: stats["requests"]),
+        "stage_request_bytes": ("Bytes sent to Elasticsearch by the stage.", lambda stats: stats["request_bytes"]),
+        "stage_response_bytes": ("Bytes received from Elasticsearch by the stage.",
+                                 lambda stats: stats["response_bytes"]),
+        "stage_server_took_seconds": ("Time spent by Elasticsearch on the requests of the stage, as reported in the "
+                                      "took of the responses.", lambda stats: stats["server_took_millis"] / 1000),
+        "stage_reindex_throttled_seconds": ("Time the reindex of the stage was throttled.",
+                                            lambda stats: stats["reindex"]["throttled_millis"] / 1000)
+    }
+    lines = []
+    for metric, (description, get_value) in metrics.items():
+        name = "{}_{}".format(metrics_prefix, metric)
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        for stage, stats in report["stages"].items():
+            lines.append("{}{} {}".format(name, get_prometheus_labels(report["labels"] | {"stage": stage}),
+                                          get_value(stats)))
+
+    name = "{}_stage_reindex_documents".format(metrics_prefix)
+    lines.append("# HELP {} Documents processed by the reindex of the stage, by result.".format(name))
+    lines.append("# TYPE {} gauge".format(name))
+    for stage, stats in report["stages"].items():
+        for stat in reindex_stats:
+            if stat in ["batches", "throttled_millis"]:
+                continue
+            labels = report["labels"] | {"stage": stage, "result": stat}
+            lines.append("{}{} {}".format(name, get_prometheus_labels(labels), stats["reindex"][stat]))
+
+    name = "{}_run_duration_seconds".format(metrics_prefix)
+    lines.append("# HELP {} Wall time of the run.".format(name))
+    lines.append("# TYPE {} gauge".format(name))
+    lines.append("{}{} {}".format(name, get_prometheus_labels(report["labels"]), report["wall_seconds"]))
+    return "\n".join(lines) + "\n"
+
+
+def write_profile(json_path: str, prometheus_path: str, labels: {}):
+    """
+    Write the profile of the run as JSON and in the Prometheus textfile format, and display a summary.
+    The files are replaced atomically, so a Prometheus collector never reads them half written.
+    :param json_path: path to the JSON file.
+    :param prometheus_path: path to the Prometheus textfile.
+    :param labels: labels to identify the run, like the data stream and the cluster.
+    """
+    with profile_lock:
+        report = {
+            "started_at": profile_state["started_at"],
+            "wall_seconds": time.perf_counter() - profile_state["start"],
+            "labels": labels,
+            "stages": json.loads(json.dumps(profile_state["stages"]))
+        }
+
+    print("\nProfile of the run ({:.2f}s):".format(report["wall_seconds"]))
+    for stage, stats in report["stages"].items():
+        print("\t- {}: {:.2f}s, {} requests, {} bytes sent, {} bytes received, {:.2f}s in Elasticsearch.".format(
+            stage, stats["wall_seconds"], stats["requests"], stats["request_bytes"], stats["response_bytes"],
+            stats["server_took_millis"] / 1000))
+
+    for path, content in [(json_path, json.dumps(report, indent=4)), (prometheus_path, get_prometheus_metrics(report))]:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    print("Profile written to {} and {}.".format(json_path, prometheus_path))
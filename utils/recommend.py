@@ -0,0 +1,202 @@
+"""
+All functions to recommend new dimensions are placed here.
+Given the collision groups (documents with the same dimensions and @timestamp), these functions look for
+the smallest set of extra keyword fields that would make every document unique.
+"""
+
+from array import array
+
+import numpy as np
+
+from utils.collisions import *
+
+# Maximum number of documents retrieved per collision group.
+max_docs_per_group = 100
+# Number of extra fields in the greedy search.
+max_recommended_fields = 5
+# Number of single field suggestions displayed.
+suggestions_displayed = 10
+
+
+def get_candidate_fields(client: Elasticsearch, data_stream: str, dimensions: []):
+    """
+    Get the keyword fields of the data stream that are not dimensions yet.
+    :param client: ES client.
+    :param data_stream: name of the data stream.
+    :param dimensions: list of dimension fields.
+    :return: sorted list of candidate fields.
+    """
+    candidates = set()
+    for index in client.indices.get_mapping(index=data_stream).values():
+        for field, mapping in flatten_mappings(index["mappings"]).items():
+            if mapping.get("type") in accepted_fields_for_routing and field not in dimensions:
+                candidates.add(field)
+    return sorted(candidates)
+
+
+def get_group_queries(dimensions: [], overwritten_docs: []):
+    """
+    Get the query of each collision group. Overwritten documents with the same dimensions and @timestamp
+    belong to the same group.
+    :param dimensions: list of dimension fields.
+    :param overwritten_docs: _source (at least @timestamp and dimensions) of the overwritten documents.
+    :return: list of (dimensions_values, dimensions_missing), as used by build_query.
+    """
+    queries = {}
+    extract = compile_field_extractor(dimensions)
+    for source in overwritten_docs:
+        dimensions_values = {"@timestamp": source["@timestamp"]}
+        dimensions_missing = []
+        for dimension, el in zip(dimensions, extract(source)):
+            if el != missing_value:
+                dimensions_values[dimension] = el
+            else:
+                dimensions_missing.append(dimension)
+        key = json.dumps([dimensions_values, dimensions_missing], sort_keys=True, default=str)
+        queries.setdefault(key, (dimensions_values, dimensions_missing))
+    return list(queries.values())
+
+
+def encode_column(values: []):
+    """
+    Encode the values of a field as integer codes, so equal values have the same code. Keyword values are compared
+    as they are, and any other value (like a list of values) by its JSON.
+    :param values: value of the field for each document.
+    :return: code of each document, and the number of distinct codes.
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    keys = np.array([value if isinstance(value, str) else "\0" + json.dumps(value, sort_keys=True, default=str)
+                     for value in values])
+    unique, column = np.unique(keys, return_inverse=True)
+    return column.astype(np.int64).reshape(-1), len(unique)
+
+
+def get_group_columns(client: Elasticsearch, data_stream: str, queries: [], fields: []):
+    """
+    Get the documents of every collision group and encode the value of each field as an integer code.
+    :param client: ES client.
+    :param data_stream: name of the data stream.
+    :param queries: query of each collision group, as returned by get_group_queries.
+    :param fields: fields to encode.
+    :return: group of each document, code of each field for each document, and the number of distinct codes
+    of each field.
+    """
+    groups = array("q")
+    values = [[] for _ in fields]
+    extract = compile_field_extractor(fields)
+    for start in range(0, len(queries), msearch_batch_size):
+        body = []
+        for dimensions_values, dimensions_missing in queries[start:start + msearch_batch_size]:
+            body.append({"index": data_stream})
+            body.append({"query": build_query(dimensions_values, dimensions_missing), "size": max_docs_per_group,
+                         "_source": fields})
+        res = client.msearch(searches=body)
+        for group, resp in enumerate(res["responses"], start):
+            if "error" in resp:
+                continue
+            for doc in resp["hits"]["hits"]:
+                groups.append(group)
+                for field_values, value in zip(values, extract(doc["_source"])):
+                    field_values.append(value)
+    # Each field is encoded at once, sorting its values, instead of looking up every value of every document
+    encoded = [encode_column(field_values) for field_values in values]
+    return (np.frombuffer(groups, dtype=np.int64), [column for column, _ in encoded],
+            [cardinality for _, cardinality in encoded])
+
+
+def combine_keys(keys: np.ndarray, column: np.ndarray, cardinality: int):
+    """
+    Combine the key of each document with the code of a new field.
+    :param keys: key of each document, between 0 and the number of documents.
+    :param column: code of the new field for each document.
+    :param cardinality: number of distinct codes of the new field.
+    :return: new key of each document, between 0 and the number of documents, and the number of distinct keys.
+    """
+    unique, keys = np.unique(keys * cardinality + column, return_inverse=True)
+    return keys, len(unique)
+
+
+def recommend_dimensions(groups: np.ndarray, columns: [], cardinalities: [], fields: []):
+    """
+    Rank the candidate fields by the number of collisions they resolve on their own, and greedily search the
+    smallest set of fields that makes every document unique.
+    A collision is a document with the same key (group and extra fields) as a previous document.
+    :param groups: group of each document.
+    :param columns: code of each field for each document.
+    :param cardinalities: number of distinct codes of each field.
+    :param fields: name of each field.
+    :return: list of (field, collisions resolved) sorted by collisions resolved, and list of (field, collisions
+    left) with the fields chosen by the greedy search, in order.
+    """
+    n_docs = len(groups)
+    keys, n_keys = combine_keys(groups, np.zeros(n_docs, dtype=np.int64), 1)
+    base_collisions = n_docs - n_keys
+
+    resolved = []
+    for i in range(len(fields)):
+        _, n_field_keys = combine_keys(keys, columns[i], cardinalities[i])
+        resolved.append(n_field_keys - n_keys)
+    order = sorted(range(len(fields)), key=lambda i: -resolved[i])
+    ranking = [(fields[i], resolved[i]) for i in order]
+
+    chosen = []
+    collisions = base_collisions
+    remaining = [i for i in order if resolved[i] > 0]
+    while collisions > 0 and len(chosen) < max_recommended_fields and len(remaining) > 0:
+        best = None
+        for i in remaining:
+            new_keys, n_new_keys = combine_keys(keys, columns[i], cardinalities[i])
+            if best is None or n_new_keys > best[2]:
+                best = (i, new_keys, n_new_keys)
+        i, new_keys, n_new_keys = best
+        if n_new_keys == n_keys:
+            break
+        keys, n_keys = new_keys, n_new_keys
+        collisions = n_docs - n_keys
+        chosen.append((fields[i], collisions))
+        remaining.remove(i)
+    return ranking, chosen
+
+
+@profile_stage("display_dimension_recommendations")
+def display_dimension_recommendations(client: Elasticsearch, data_stream: str, dimensions: [],
+                                      overwritten_docs: [] = None, session: {} = None):
+    """
+    Display the extra dimensions that would avoid the overwritten documents.
+    :param client: ES client.
+    :param data_stream: name of the data stream.
+    :param dimensions: list of dimension fields.
+    :param overwritten_docs: _source (at least @timestamp and dimensions) of the overwritten documents. If not
+    given, the documents are retrieved from the overwritten documents index.
+    :param session: state of the run, with the name of the overwritten documents index. If not specified, the
+    default name is used.
+    """
+    if overwritten_docs is None:
+        index_name = get_session(session)["overwritten_docs_index"]
+        overwritten_docs = [hit["_source"] for hit, _ in stream_docs(client, index_name, dimensions, -1)]
+    queries = get_group_queries(dimensions, overwritten_docs)
+    fields = get_candidate_fields(client, data_stream, dimensions)
+    print("Looking for new dimensions among {} keyword fields for {} sets of dimensions...".format(len(fields),
+                                                                                                   len(queries)))
+    if len(fields) == 0 or len(queries) == 0:
+        print("There are no fields to recommend.\n")
+        return
+
+    groups, columns, cardinalities = get_group_columns(client, data_stream, queries, fields)
+    ranking, chosen = recommend_dimensions(groups, columns, cardinalities, fields)
+    collisions = len(groups) - len(np.unique(groups))
+
+    print("Out of {} documents, {} have the same dimensions and timestamp as another one.".format(len(groups),
+                                                                                                  collisions))
+    print("Collisions resolved by adding a single field as dimension:")
+    for field, resolved in ranking[:suggestions_displayed]:
+        if resolved > 0:
+            print("\t- {}: {} collisions resolved.".format(field, resolved))
+    if len(chosen) == 0:
+        print("No field resolves any collision.\n")
+        return
+    print("Smallest set of fields found to add as dimensions:")
+    for field, left in chosen:
+        print("\t- {} ({} collisions left).".format(field, left))
+    print()
@@ -0,0 +1,250 @@
+"""
+All functions to analyze how the time series of a TSDB index would be spread across its shards are placed here.
+A TSDB index sends each document to a shard using a hash of its routing_path fields. These functions get every
+time series of the documents (every distinct set of dimensions) with a composite aggregation, compute the same hash
+as Elasticsearch, and count the documents and time series that each shard would get, for other numbers of shards and
+routing paths as well.
+"""
+
+from array import array
+
+import numpy as np
+
+from utils.collisions import *
+
+# Numbers of shards compared with the number of shards of the index.
+routing_shard_counts = [1, 2, 3, 4, 6, 8, 12, 16]
+# A shard is a hotspot if it gets more than this many times the documents of the average shard.
+hotspot_factor = 1.2
+# Maximum number of hotspot shards displayed.
+hotspots_displayed = 5
+
+
+def murmurhash3_x86_32(data: bytes, seed: int = 0):
+    """
+    Get the 32 bit MurmurHash3 of some bytes, as Lucene's StringHelper.murmurhash3_x86_32 does.
+    :param data: bytes to hash.
+    :param seed: seed of the hash.
+    :return: hash, as a signed 32 bit integer.
+    """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    h = seed & 0xffffffff
+    n_blocks = len(data) // 4
+    for i in range(n_blocks):
+        k = int.from_bytes(data[i * 4:i * 4 + 4], "little")
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+
+    tail = data[n_blocks * 4:]
+    if len(tail) > 0:
+        k = int.from_bytes(tail, "little")
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h - (1 << 32) if h >= 1 << 31 else h
+
+
+def get_time_series(client: Elasticsearch, index_name: str, dimensions: [], routing_path: []):
+    """
+    Get the number of documents of every time series of an index, and the hash of each of its routing_path values.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param dimensions: list of dimension fields. Each distinct set of values is a time series.
+    :param routing_path: list of routing_path fields, which are dimensions as well.
+    :return: number of documents of each time series; and, for each routing_path field, the hash of the name of the
+    field XOR the hash of its value in each time series. Time series without the field have None.
+    """
+    sources = [{dimension: {"terms": {"field": dimension, "missing_bucket": True}}} for dimension in dimensions]
+    composite = {"size": composite_page_size, "sources": sources}
+
+    doc_counts = array('q')
+    columns = {field: array('q') for field in routing_path}
+    missing = {field: array('b') for field in routing_path}
+    value_hashes = {field: {} for field in routing_path}
+    name_hashes = {field: murmurhash3_x86_32(field.encode()) for field in routing_path}
+    while True:
+        res = client.search(index=index_name, size=0, aggs={"series": {"composite": composite}})
+        agg = res["aggregations"]["series"]
+        for bucket in agg["buckets"]:
+            doc_counts.append(bucket["doc_count"])
+            for field in routing_path:
+                value = bucket["key"][field]
+                missing[field].append(value is None)
+                if value is None:
+                    columns[field].append(0)
+                    continue
+                value = str(value)
+                if value not in value_hashes[field]:
+                    value_hashes[field][value] = name_hashes[field] ^ murmurhash3_x86_32(value.encode())
+                columns[field].append(value_hashes[field][value])
+        if "after_key" not in agg or len(agg["buckets"]) == 0:
+            break
+        composite["after"] = agg["after_key"]
+
+    columns = {field: np.ma.masked_array(np.frombuffer(columns[field], dtype=np.int64),
+                                         mask=np.frombuffer(missing[field], dtype=np.int8).astype(bool))
+               for field in routing_path}
+    return np.frombuffer(doc_counts, dtype=np.int64), columns
+
+
+def get_routing_hashes(columns: {}, routing_path: []):
+    """
+    Get the routing hash of every time series for a routing path. As Elasticsearch does, the fields are sorted by
+    name, and the hash of each one is added to the previous ones multiplied by 31, as 32 bit integers.
+    :param columns: hashes of the routing_path fields in each time series, as returned by get_time_series.
+    :param routing_path: list of routing_path fields to use.
+    :return: routing hash of each time series, and whether the time series has any routing_path field. Documents
+    without any of them cannot be placed in a TSDB index.
+    """
+    n_series = len(next(iter(columns.values())))
+    hashes = np.zeros(n_series, dtype=np.int64)
+    routable = np.zeros(n_series, dtype=bool)
+    for field in sorted(routing_path):
+        present = ~np.ma.getmaskarray(columns[field])
+        values = columns[field].filled(0)
+        combined = np.where(routable, hashes * 31 + values, values)
+        # Keep the hash as a signed 32 bit integer
+        combined = (combined + (1 << 31)) % (1 << 32) - (1 << 31)
+        hashes = np.where(present, combined, hashes)
+        routable |= present
+    return hashes, routable
+
+
+def get_number_of_routing_shards(n_shards: int):
+    """
+    Get the default number of routing shards of an index, as Elasticsearch does: the biggest number of shards the
+    index could be split to, up to 1024.
+    :param n_shards: number of shards of the index.
+    :return: number of routing shards.
+    """
+    log2_num_shards = (n_shards - 1).bit_length()
+    n_splits = max(1, 10 - log2_num_shards)
+    return n_shards << n_splits
+
+
+def get_shard_spread(hashes: np.ndarray, doc_counts: np.ndarray, n_shards: int, n_routing_shards: int = None):
+    """
+    Get the documents and time series that each shard would get.
+    :param hashes: routing hash of each time series.
+    :param doc_counts: number of documents of each time series.
+    :param n_shards: number of shards.
+    :param n_routing_shards: number of routing shards of the index. If not specified, the default one is used.
+    :return: spread of the documents, with the documents and time series of each shard, the imbalance (documents of
+    the biggest shard divided by the documents of the average shard) and the hotspot shards.
+    """
+    if n_routing_shards is None:
+        n_routing_shards = get_number_of_routing_shards(n_shards)
+    shards = (hashes % n_routing_shards) // (n_routing_shards // n_shards)
+    docs = np.bincount(shards, weights=doc_counts, minlength=n_shards).astype(np.int64)
+    series = np.bincount(shards, minlength=n_shards)
+    average = docs.sum() / n_shards
+    imbalance = docs.max() / average if average > 0 else 1.0
+    hotspots = [shard for shard in np.argsort(-docs) if docs[shard] > average * hotspot_factor]
+    return {
+        "shards": n_shards,
+        "docs": docs.tolist(),
+        "series": series.tolist(),
+        "imbalance": float(imbalance),
+        "hotspots": [int(shard) for shard in hotspots]
+    }
+
+
+def display_shard_spread(spread: {}, title: str):
+    """
+    Display the imbalance and hotspot shards of a spread of the documents.
+    :param spread: spread of the documents, as returned by get_shard_spread.
+    :param title: description of the spread.
+    """
+    total = max(sum(spread["docs"]), 1)
+    hotspots = ", ".join("shard {} ({:.1%} of the documents, {} time series)".format(
+        shard, spread["docs"][shard] / total, spread["series"][shard])
+        for shard in spread["hotspots"][:hotspots_displayed])
+    print("\t- {}: imbalance {:.2f}{}.".format(title, spread["imbalance"],
+                                               ", hotspots: " + hotspots if hotspots != "" else ", no hotspots"))
+
+
+@profile_stage("analyze_routing")
+def analyze_routing(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int,
+                    shard_counts: [] = None):
+    """
+    Given a data stream, display how the documents of the given index would be spread across the shards of a TSDB
+    index: with the routing_path and number of shards of the TSDB index, with other numbers of shards, and with the
+    routing_path without each of its fields. No index is created.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param shard_counts: numbers of shards to compare. If not specified, routing_shard_counts are used.
+    :return: spread of the documents for each number of shards, and for each routing_path without one field.
+    """
+    if shard_counts is None:
+        shard_counts = routing_shard_counts
+    print("Testing data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+    dimensions = time_series_fields["dimension"]
+    routing_path = time_series_fields["routing_path"]
+    n_shards = int(settings["index"].get("number_of_shards", 1))
+    n_routing_shards = settings["index"].get("number_of_routing_shards")
+    if n_routing_shards is not None:
+        n_routing_shards = int(n_routing_shards)
+
+    print("Looking for the time series of index {}...".format(source_index))
+    doc_counts, columns = get_time_series(client, source_index, dimensions, routing_path)
+    hashes, routable = get_routing_hashes(columns, routing_path)
+    n_unroutable = int(doc_counts[~routable].sum())
+    print("Out of {} documents, there are {} time series.".format(int(doc_counts.sum()), len(doc_counts)))
+    if n_unroutable > 0:
+        print("WARNING: {} documents do not have any routing_path field. They cannot be placed in a TSDB "
+              "index.".format(n_unroutable))
+    hashes, doc_counts = hashes[routable], doc_counts[routable]
+    if len(doc_counts) == 0:
+        print("There are no documents to route.\n")
+        return {}
+
+    report = {"routing_path": routing_path, "shards": n_shards, "shard_counts": [], "routing_paths": []}
+    print("Spread of the documents across {} shards, with routing_path {}:".format(n_shards, routing_path))
+    spread = get_shard_spread(hashes, doc_counts, n_shards, n_routing_shards)
+    report["current"] = spread
+    for shard in range(n_shards):
+        print("\t- Shard {}: {} documents, {} time series.".format(shard, spread["docs"][shard],
+                                                                    spread["series"][shard]))
+    display_shard_spread(spread, "Overall")
+
+    print("Spread of the documents with other numbers of shards:")
+    for count in shard_counts:
+        spread = get_shard_spread(hashes, doc_counts, count)
+        report["shard_counts"].append(spread)
+        display_shard_spread(spread, "{} shards".format(count))
+
+    if len(routing_path) > 1:
+        print("Spread of the documents across {} shards without each routing_path field:".format(n_shards))
+        for field in routing_path:
+            subset = [other for other in routing_path if other != field]
+            subset_hashes, subset_routable = get_routing_hashes(columns, subset)
+            subset_hashes = subset_hashes[routable]
+            # Documents left without any routing_path field would be rejected, so they are not counted
+            subset_routable = subset_routable[routable]
+            spread = get_shard_spread(subset_hashes[subset_routable], doc_counts[subset_routable], n_shards,
+                                      n_routing_shards)
+            report["routing_paths"].append(spread | {"routing_path": subset})
+            display_shard_spread(spread, "Without {}".format(field))
+    print()
+    return report
@@ -0,0 +1,127 @@
+"""
+All functions to estimate the overwrite rate of an index from a sample are placed here.
+Documents can only overwrite each other if they have the same @timestamp, so the index is split in time windows
+and only some random windows are fully checked. The overwrite rate of the index is estimated from them.
+"""
+
+from statistics import NormalDist
+
+import math
+import random
+
+from utils.collisions import *
+
+
+def get_timestamp_range(client: Elasticsearch, index_name: str):
+    """
+    Get the first and last @timestamp of an index, and its number of documents.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :return: first and last @timestamp in milliseconds, and number of documents.
+    """
+    res = client.search(index=index_name, size=0, track_total_hits=True,
+                        aggs={"first": {"min": {"field": "@timestamp"}}, "last": {"max": {"field": "@timestamp"}}})
+    n_docs = res["hits"]["total"]["value"]
+    if n_docs == 0:
+        return None, None, 0
+    return int(res["aggregations"]["first"]["value"]), int(res["aggregations"]["last"]["value"]), n_docs
+
+
+def estimate_ratio(windows: [], n_windows: int, confidence: float):
+    """
+    Estimate the overwrite rate from the sampled windows with a ratio estimator, and its confidence interval.
+    :param windows: list of (number of documents, number of overwritten documents) of each sampled window.
+    :param n_windows: number of windows in the index.
+    :param confidence: confidence level of the interval, like 0.95.
+    :return: estimated rate, and the lower and upper bound of the interval.
+    """
+    n = len(windows)
+    total_docs = sum(docs for docs, _ in windows)
+    total_overwritten = sum(overwritten for _, overwritten in windows)
+    if total_docs == 0:
+        return 0.0, 0.0, 0.0
+    rate = total_overwritten / total_docs
+    if n < 2 or n >= n_windows:
+        return rate, rate, rate
+
+    mean_docs = total_docs / n
+    residuals = sum((overwritten - rate * docs) ** 2 for docs, overwritten in windows) / (n - 1)
+    variance = (1 - n / n_windows) * residuals / (n * mean_docs ** 2)
+    margin = NormalDist().inv_cdf((1 + confidence) / 2) * math.sqrt(variance)
+    return rate, max(0.0, rate - margin), min(1.0, rate + margin)
+
+
+@profile_stage("sample_overwritten_docs")
+def sample_overwritten_docs(client: Elasticsearch, index_name: str, dimensions: [], n_samples: int,
+                            window_seconds: int, confidence: float, seed: int = None):
+    """
+    Check random time windows of the index for overwritten documents and estimate the overwrite rate of the
+    whole index. Every document of a sampled window is checked.
+    :param client: ES client.
+    :param index_name: name of the index with the documents.
+    :param dimensions: list of dimension fields.
+    :param n_samples: number of windows to check.
+    :param window_seconds: size of each window, in seconds.
+    :param confidence: confidence level of the interval, like 0.95.
+    :param seed: seed to choose the windows. If not specified, the windows change every run.
+    :return: collision groups found in the sampled windows.
+    """
+    first, last, n_docs = get_timestamp_range(client, index_name)
+    if n_docs == 0:
+        print("Index {} has no documents.\n".format(index_name))
+        return []
+
+    window_millis = window_seconds * 1000
+    n_windows = (last - first) // window_millis + 1
+    chosen = sorted(random.Random(seed).sample(range(n_windows), min(n_samples, n_windows)))
+    print("Checking {} out of {} windows of {} seconds in index {}...".format(len(chosen), n_windows,
+                                                                               window_seconds, index_name))
+
+    windows = []
+    groups = []
+    for window in chosen:
+        start = first + window * window_millis
+        query = {"range": {"@timestamp": {"gte": start, "lt": start + window_millis, "format": "epoch_millis"}}}
+        window_docs, window_overwritten, window_groups = get_overwritten_docs(client, index_name, dimensions, -1,
+                                                                              query)
+        windows.append((window_docs, window_overwritten))
+        groups += window_groups
+
+    sampled_docs = sum(docs for docs, _ in windows)
+    sampled_overwritten = sum(overwritten for _, overwritten in windows)
+    rate, lower, upper = estimate_ratio(windows, n_windows, confidence)
+    print("Out of {} sampled documents ({:.2%} of the index), {} were overwritten.".format(
+        sampled_docs, sampled_docs / n_docs, sampled_overwritten))
+    print("Estimated overwrite rate: {:.4%} ({:.0%} confidence interval: {:.4%} - {:.4%}).".format(
+        rate, confidence, lower, upper))
+    print("Estimated overwritten documents: {:.0f} out of {} ({:.0f} - {:.0f}).\n".format(
+        rate * n_docs, n_docs, lower * n_docs, upper * n_docs))
+    return [group["source"] for group in groups]
+
+
+def sample_data_stream(client: Elasticsearch, data_stream_name: str, docs_index: int, settings_mappings_index: int,
+                       n_samples: int, window_seconds: int, confidence: float):
+    """
+    Given a data stream, estimate how many documents of the given index would be overwritten in a new index with
+    TSDB enabled, checking only some random time windows. No index is created.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index to use to retrieve the documents.
+    :param settings_mappings_index: number of the index to use to get the mappings and settings for the TSDB index.
+    :param n_samples: number of windows to check.
+    :param window_seconds: size of each window, in seconds.
+    :param confidence: confidence level of the interval, like 0.95.
+    :return: _source of the first document of each collision group found, and the time series fields of the TSDB
+    index.
+    """
+    print("Testing data stream {}.".format(data_stream_name))
+
+    if not client.indices.exists(index=data_stream_name):
+        raise MigrationError("Data stream {} does not exist.".format(data_stream_name))
+
+    source_index, mappings, settings, time_series_fields = get_tsdb_config(client, data_stream_name, docs_index,
+                                                                           settings_mappings_index)
+
+    overwritten_docs = sample_overwritten_docs(client, source_index, time_series_fields["dimension"], n_samples,
+                                               window_seconds, confidence)
+    return overwritten_docs, time_series_fields
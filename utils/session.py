@@ -0,0 +1,107 @@
+"""
+All functions to handle the state of a migration test run are placed here.
+A session has the names of the indices and the ingest pipeline that a run creates. The names of a new session have
+a unique suffix, so many runs can test data streams on the same cluster, or in threads of the same process, without
+overwriting each other's indices. The indices and pipeline a session created are deleted when it is closed.
+"""
+
+from contextlib import contextmanager
+
+import threading
+import uuid
+
+from elasticsearch import Elasticsearch
+
+from utils.tsdb import *
+
+
+def new_session(unique: bool = True, keep_indices: bool = False):
+    """
+    Get the state of a new run.
+    :param unique: true to add a unique suffix to the names of the indices and the pipeline. False to use the
+    default names, tsdb_index, overwritten_docs_index and missing_docs_pipeline.
+    :param keep_indices: true to keep the indices and the pipeline when the session is closed.
+    :return: state of the run.
+    """
+    session_id = uuid.uuid4().hex[:12]
+    suffix = "-" + session_id if unique else ""
+    return {
+        "id": session_id,
+        "tsdb_index": tsdb_index + suffix,
+        "overwritten_docs_index": overwritten_docs_index + suffix,
+        "pipeline": missing_docs_pipeline + suffix,
+        "keep_indices": keep_indices,
+        # Indices and pipelines created in the session, deleted when it is closed
+        "indices": [],
+        "pipelines": [],
+        "lock": threading.Lock()
+    }
+
+
+def get_session(session: {} = None):
+    """
+    Get the session of a run.
+    :param session: state of the run, or None.
+    :return: @session, or a session with the default names that keeps its indices if @session is None.
+    """
+    if session is None:
+        return new_session(unique=False, keep_indices=True)
+    return session
+
+
+def track_index(session: {}, index_name: str):
+    """
+    Record an index created in the session, so it is deleted when the session is closed.
+    :param session: state of the run.
+    :param index_name: name of the index.
+    """
+    with session["lock"]:
+        if index_name not in session["indices"]:
+            session["indices"].append(index_name)
+
+
+def track_pipeline(session: {}, pipeline_name: str):
+    """
+    Record an ingest pipeline created in the session, so it is deleted when the session is closed.
+    :param session: state of the run.
+    :param pipeline_name: name of the pipeline.
+    """
+    with session["lock"]:
+        if pipeline_name not in session["pipelines"]:
+            session["pipelines"].append(pipeline_name)
+
+
+def close_session(client: Elasticsearch, session: {}):
+    """
+    Delete the indices and pipelines created in the session, unless it keeps them.
+    :param client: ES client.
+    :param session: state of the run.
+    """
+    if session["keep_indices"]:
+        return
+    with session["lock"]:
+        indices, session["indices"] = session["indices"], []
+        pipelines, session["pipelines"] = session["pipelines"], []
+    for index_name in indices:
+        client.indices.delete(index=index_name, ignore_unavailable=True)
+    for pipeline_name in pipelines:
+        client.options(ignore_status=404).ingest.delete_pipeline(id=pipeline_name)
+
+
+@contextmanager
+def migration_session(client: Elasticsearch, keep_indices: bool = False):
+    """
+    Run a migration test in a new session, closed when the block ends, even on errors.
+    Example:
+        with migration_session(client) as session:
+            all_placed, time_series_fields = copy_from_data_stream(client, "metrics-default", -1, -1, -1,
+                                                                   session=session)
+    :param client: ES client.
+    :param keep_indices: true to keep the indices and the pipeline of the session.
+    :return: state of the run.
+    """
+    session = new_session(keep_indices=keep_indices)
+    try:
+        yield session
+    finally:
+        close_session(client, session)
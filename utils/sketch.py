@@ -0,0 +1,350 @@
+"""
+All functions to count overwritten documents with bounded memory are placed here.
+Each document is a 64 bit hash of its dimensions and @timestamp (see get_doc_key). A Bloom filter flags the hashes
+that were probably seen before, and a HyperLogLog counts the distinct ones, so both estimates take a fixed amount of
+memory. For an exact count, the hashes are spilled to hash partitions on local disk, and each partition is counted
+on its own. A partition that is still too big to be loaded in memory is split again with other bits of the hashes.
+"""
+
+from statistics import NormalDist
+
+import itertools
+import math
+import os
+
+import numpy as np
+
+# Memory of the Bloom filter, in MB.
+sketch_memory_mb = 64
+# Bits of the hash used to choose the HyperLogLog register: 2^14 registers, with a standard error of 0.81%.
+hyperloglog_precision = 14
+# Confidence level of the intervals of the estimates.
+sketch_confidence = 0.95
+# False positive rate above which the Bloom filter is saturated: most keys are flagged, so its estimate is not
+# reliable.
+bloom_saturated_rate = 0.5
+# Maximum size of the hashes of one partition, in bytes. Only one partition is loaded in memory at a time.
+spill_partition_bytes = 64 * 1024 * 1024
+# Maximum number of partitions. Each one keeps two files open while the documents are read.
+spill_max_partitions = 256
+# Bits of the hashes skipped each time a partition is split again, so the new partitions use other bits.
+spill_split_bits = 16
+# Number of hashes of a partition read at a time when it is split.
+spill_split_batch = 1024 * 1024
+# Maximum number of collision groups kept by the exact count. The overwritten documents of the others are counted.
+spill_max_groups = 10000
+
+
+def new_bloom_filter(memory_mb: int, expected_keys: int):
+    """
+    Create an empty Bloom filter, with the number of hashes that gives the fewest false positives for the expected
+    number of keys.
+    :param memory_mb: size of the filter, in MB.
+    :param expected_keys: expected number of distinct keys.
+    :return: Bloom filter.
+    """
+    n_bits = memory_mb * 1024 * 1024 * 8
+    n_hashes = max(1, min(16, round(n_bits / max(expected_keys, 1) * math.log(2))))
+    return {
+        "bits": np.zeros(n_bits // 8, dtype=np.uint8),
+        "n_bits": n_bits,
+        "n_hashes": n_hashes,
+        "set_bits": 0,
+        "expected_false_positives": 0.0
+    }
+
+
+def get_bloom_false_positive_rate(bloom: {}):
+    """
+    Get the probability that a key not in the Bloom filter is flagged as seen, given the bits set so far.
+    :param bloom: Bloom filter.
+    :return: false positive rate.
+    """
+    return (bloom["set_bits"] / bloom["n_bits"]) ** bloom["n_hashes"]
+
+
+def get_bloom_positions(bloom: {}, keys: np.ndarray):
+    """
+    Get the bits of each key, with double hashing on the 64 bit keys.
+    :param bloom: Bloom filter.
+    :param keys: array of uint64 keys.
+    :return: array with one row per hash and one column per key.
+    """
+    h2 = (keys >> np.uint64(32)) | (keys << np.uint64(32)) | np.uint64(1)
+    i = np.arange(bloom["n_hashes"], dtype=np.uint64).reshape(-1, 1)
+    # Overflows wrap around, as they should
+    return (keys + i * h2) % np.uint64(bloom["n_bits"])
+
+
+def sort_unique(values: np.ndarray):
+    """
+    Get the distinct values of an array, sorted. It is faster than np.unique for big arrays of uint64.
+    :param values: array.
+    :return: sorted array of distinct values.
+    """
+    values = np.sort(values, axis=None)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def add_keys_bloom_filter(bloom: {}, keys: np.ndarray):
+    """
+    Add keys to the Bloom filter, and count the ones that were probably seen before: the repeated keys of @keys,
+    and the keys already in the filter. The expected number of false positives of the filter is updated.
+    :param bloom: Bloom filter.
+    :param keys: array of uint64 keys.
+    :return: number of keys flagged as seen.
+    """
+    unique_keys = sort_unique(keys)
+    positions = get_bloom_positions(bloom, unique_keys)
+    masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+    offsets = positions >> np.uint64(3)
+    seen = np.all(bloom["bits"][offsets] & masks, axis=0)
+
+    # Only the keys not seen before can be false positives: with a rate p, p * (keys - flagged + false positives)
+    rate = get_bloom_false_positive_rate(bloom)
+    # A full filter flags every key (rate 1), and the false positives cannot be told apart any more
+    bloom["expected_false_positives"] += rate * (len(unique_keys) - int(seen.sum())) / max(1 - rate, 1e-9)
+
+    new = ~seen
+    positions = sort_unique(positions[:, new])
+    offsets = positions >> np.uint64(3)
+    masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+    bloom["set_bits"] += int(np.count_nonzero((bloom["bits"][offsets] & masks) == 0))
+    np.bitwise_or.at(bloom["bits"], offsets, masks)
+    return len(keys) - len(unique_keys) + int(seen.sum())
+
+
+def bit_length(values: np.ndarray):
+    """
+    Get the number of bits needed to represent each value.
+    :param values: array of uint64 values.
+    :return: array of bit lengths.
+    """
+    lengths = np.zeros(len(values), dtype=np.uint8)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        high = values >= np.uint64(1 << shift)
+        lengths += high.astype(np.uint8) * shift
+        values = np.where(high, values >> np.uint64(shift), values)
+    return lengths + (values > 0).astype(np.uint8)
+
+
+def new_hyperloglog(precision: int = hyperloglog_precision):
+    """
+    Create an empty HyperLogLog.
+    :param precision: bits of the hash used to choose the register.
+    :return: HyperLogLog.
+    """
+    return {"registers": np.zeros(1 << precision, dtype=np.uint8), "precision": precision}
+
+
+def add_keys_hyperloglog(hll: {}, keys: np.ndarray):
+    """
+    Add keys to the HyperLogLog.
+    :param hll: HyperLogLog.
+    :param keys: array of uint64 keys.
+    """
+    rest_bits = 64 - hll["precision"]
+    registers = keys >> np.uint64(rest_bits)
+    rest = keys & np.uint64((1 << rest_bits) - 1)
+    # Position of the first 1 bit of the rest of the hash
+    ranks = (rest_bits + 1 - bit_length(rest).astype(np.int16)).astype(np.uint8)
+    np.maximum.at(hll["registers"], registers, ranks)
+
+
+def estimate_hyperloglog(hll: {}):
+    """
+    Estimate the number of distinct keys added to the HyperLogLog.
+    :param hll: HyperLogLog.
+    :return: estimated number of distinct keys, and its relative standard error.
+    """
+    m = len(hll["registers"])
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -hll["registers"].astype(np.int32)))
+    n_zeros = int(np.count_nonzero(hll["registers"] == 0))
+    if estimate <= 2.5 * m and n_zeros > 0:
+        # Linear counting is more accurate for few keys
+        estimate = m * math.log(m / n_zeros)
+    return estimate, 1.04 / math.sqrt(m)
+
+
+def estimate_overwritten(n_docs: int, n_flagged: int, bloom: {}, hll: {}, confidence: float = sketch_confidence):
+    """
+    Estimate the number of overwritten documents from the Bloom filter and the HyperLogLog.
+    The Bloom filter flags every overwritten document, plus some false positives, so the documents it flags minus
+    the expected false positives is the estimate. The HyperLogLog gives another interval, the documents minus the
+    distinct keys, which narrows the interval of the Bloom filter when they overlap. If the Bloom filter is
+    saturated, only the HyperLogLog is used.
+    :param n_docs: number of documents.
+    :param n_flagged: number of documents flagged as seen by the Bloom filter.
+    :param bloom: Bloom filter.
+    :param hll: HyperLogLog.
+    :param confidence: confidence level of the interval, like 0.95.
+    :return: estimate of the overwritten documents, with its interval, the estimate of each sketch, and whether the
+    Bloom filter is saturated.
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    false_positives = bloom["expected_false_positives"]
+    bloom_estimate = max(0.0, n_flagged - false_positives)
+    bloom_margin = z * math.sqrt(false_positives)
+    bloom_interval = [max(0.0, n_flagged - false_positives - bloom_margin),
+                      min(float(n_flagged), n_flagged - false_positives + bloom_margin)]
+
+    distinct, error = estimate_hyperloglog(hll)
+    distinct = min(distinct, n_docs)
+    hll_interval = [max(0.0, n_docs - distinct * (1 + z * error)), max(0.0, n_docs - distinct * (1 - z * error))]
+
+    saturated = get_bloom_false_positive_rate(bloom) >= bloom_saturated_rate
+    interval = [max(bloom_interval[0], hll_interval[0]), min(bloom_interval[1], hll_interval[1])]
+    if saturated:
+        interval = hll_interval
+        bloom_estimate = n_docs - distinct
+    elif interval[0] > interval[1]:
+        interval = bloom_interval
+    return {
+        "docs": n_docs,
+        "overwritten": min(max(bloom_estimate, interval[0]), interval[1]),
+        "interval": interval,
+        "confidence": confidence,
+        "bloom": {"flagged": n_flagged, "expected_false_positives": false_positives, "interval": bloom_interval,
+                  "saturated": saturated},
+        "hyperloglog": {"distinct": distinct, "relative_error": error, "interval": hll_interval}
+    }
+
+
+def get_number_of_partitions(expected_keys: int, partition_bytes: int = spill_partition_bytes):
+    """
+    Get the number of partitions needed so the hashes of each one fit in @partition_bytes.
+    :param expected_keys: expected number of keys.
+    :param partition_bytes: maximum size of the hashes of one partition, in bytes.
+    :return: number of partitions, at most spill_max_partitions.
+    """
+    return max(1, min(spill_max_partitions, math.ceil(expected_keys * 8 / partition_bytes)))
+
+
+def get_partition_paths(directory: str, name: str):
+    """
+    Get the paths of the files of a partition.
+    :param directory: directory of the files of the partitions.
+    :param name: name of the partition.
+    :return: path of the file with the keys, and path of the file with the _id of each key.
+    """
+    return os.path.join(directory, name + ".keys"), os.path.join(directory, name + ".ids")
+
+
+def open_partitions(directory: str, n_partitions: int, prefix: str = ""):
+    """
+    Create the files of the partitions: one with the keys, and one with the _id of each key, one per line.
+    :param directory: directory of the files.
+    :param n_partitions: number of partitions.
+    :param prefix: prefix of the names of the partitions, like the name of the partition they split.
+    :return: partitions.
+    """
+    partitions = []
+    for n in range(n_partitions):
+        keys_path, ids_path = get_partition_paths(directory, prefix + str(n))
+        partitions.append({"name": prefix + str(n), "keys": open(keys_path, "wb"), "ids": open(ids_path, "w")})
+    return partitions
+
+
+def close_partitions(partitions: []):
+    """
+    Close the files of the partitions.
+    :param partitions: partitions, as returned by open_partitions.
+    """
+    for partition in partitions:
+        partition["keys"].close()
+        partition["ids"].close()
+
+
+def spill_keys(partitions: [], keys: np.ndarray, ids: [], shift: int = 0):
+    """
+    Append keys and the _id of their documents to their partitions.
+    :param partitions: partitions, as returned by open_partitions.
+    :param keys: array of uint64 keys.
+    :param ids: _id of the document of each key.
+    :param shift: number of low bits of the keys not used to choose the partition.
+    """
+    numbers = (keys >> np.uint64(shift)) % np.uint64(len(partitions))
+    # Keep the order of the documents in each partition, so the first document of a group is the first one read
+    order = np.argsort(numbers, kind="stable")
+    bounds = np.searchsorted(numbers[order], np.arange(len(partitions) + 1, dtype=np.uint64))
+    for n in range(len(partitions)):
+        selected = order[bounds[n]:bounds[n + 1]]
+        if len(selected) == 0:
+            continue
+        partitions[n]["keys"].write(keys[selected].tobytes())
+        partitions[n]["ids"].write("".join(ids[i] + "\n" for i in selected))
+
+
+def split_partition(directory: str, name: str, shift: int):
+    """
+    Split a partition in new partitions, reading it in batches of spill_split_batch keys. Its files are deleted.
+    :param directory: directory of the files of the partitions.
+    :param name: name of the partition.
+    :param shift: number of low bits of the keys not used to choose the new partition.
+    :return: names of the new partitions.
+    """
+    keys_path, ids_path = get_partition_paths(directory, name)
+    partitions = open_partitions(directory, get_number_of_partitions(os.path.getsize(keys_path) // 8), name + "-")
+    try:
+        with open(keys_path, "rb") as keys_file, open(ids_path) as ids_file:
+            while True:
+                keys = np.fromfile(keys_file, dtype=np.uint64, count=spill_split_batch)
+                if len(keys) == 0:
+                    break
+                ids = [line.rstrip("\n") for line in itertools.islice(ids_file, len(keys))]
+                spill_keys(partitions, keys, ids, shift)
+    finally:
+        close_partitions(partitions)
+    os.remove(keys_path)
+    os.remove(ids_path)
+    return [partition["name"] for partition in partitions]
+
+
+def count_partition(directory: str, name: str, max_groups: int, shift: int = 0):
+    """
+    Count the overwritten documents of a partition. Only the keys of this partition are loaded in memory.
+    If the partition has more than spill_partition_bytes of keys, it is split first with the next spill_split_bits
+    bits of the keys, and each new partition is counted on its own. Only the documents of a single key that does not
+    fit in spill_partition_bytes are loaded at once.
+    :param directory: directory of the files of the partitions.
+    :param name: name of the partition.
+    :param max_groups: maximum number of collision groups returned.
+    :param shift: number of low bits of the keys used to split the partitions so far.
+    :return: number of overwritten documents, number of collision groups, and the _id of the first document and
+    number of documents of the first @max_groups collision groups.
+    """
+    keys_path, ids_path = get_partition_paths(directory, name)
+    if os.path.getsize(keys_path) > spill_partition_bytes and shift + spill_split_bits < 64:
+        n_overwritten = 0
+        n_groups = 0
+        groups = []
+        for new_name in split_partition(directory, name, shift + spill_split_bits):
+            partition_overwritten, partition_groups, first_docs = count_partition(
+                directory, new_name, max_groups - len(groups), shift + spill_split_bits)
+            n_overwritten += partition_overwritten
+            n_groups += partition_groups
+            groups += first_docs
+        return n_overwritten, n_groups, groups
+
+    keys = np.fromfile(keys_path, dtype=np.uint64)
+    if len(keys) == 0:
+        return 0, 0, []
+    _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    repeated = counts > 1
+    n_overwritten = int((counts[repeated] - 1).sum())
+    n_groups = int(repeated.sum())
+
+    wanted = dict(zip(first[repeated][:max_groups].tolist(), counts[repeated][:max_groups].tolist()))
+    groups = []
+    if len(wanted) == 0:
+        return n_overwritten, n_groups, groups
+    with open(ids_path) as file:
+        for line_number, line in enumerate(file):
+            if line_number in wanted:
+                groups.append({"_id": line.rstrip("\n"), "doc_count": wanted[line_number]})
+                if len(groups) == len(wanted):
+                    break
+    return n_overwritten, n_groups, groups
@@ -0,0 +1,168 @@
+"""
+All functions to compare the storage of the source index and the TSDB index are placed here.
+Both indices can be force merged first, so their sizes are compared with a similar number of segments. Then the
+index stats and the analyze disk usage APIs give the total size and the size of each field of both indices.
+"""
+
+from utils.es import *
+
+# Number of segments of each index after the force merge.
+storage_max_num_segments = 1
+# Number of fields displayed, biggest first.
+storage_fields_displayed = 10
+# Order in which the kinds of fields are displayed.
+storage_field_kinds = ["dimensions", "metrics", "@timestamp", "_source", "_id", "other metadata", "other fields"]
+
+
+def force_merge(client: Elasticsearch, index_name: str, max_num_segments: int):
+    """
+    Force merge an index and wait for it. The force merge runs as a task, polled every task_poll_interval seconds,
+    so no request is left waiting on a long merge.
+    :param client: ES client.
+    :param index_name: name of the index.
+    :param max_num_segments: number of segments to merge to.
+    """
+    print("Force merging index {} to {} segments...".format(index_name, max_num_segments))
+    task_id = client.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                                       wait_for_completion=False)["task"]
+    start = time.time()
+    while True:
+        task = client.tasks.get(task_id=task_id)
+        if task["completed"]:
+            break
+        time.sleep(task_poll_interval)
+    if "error" in task:
+        raise MigrationError("Force merge of index {} failed: {}.".format(index_name, task["error"]["reason"]))
+    client.indices.refresh(index=index_name)
+    print("\tForce merge finished in {:.0f}s.".format(time.time() - start))
+
+
+def get_index_storage(client: Elasticsearch, index_name: str):
+    """
+    Get the storage of the primary shards of an index.
+    :param client: ES client.
+    :param index_name: name of the index, or comma-separated names of several indices, like the TSDB indices of a
+    checkpointed copy. The storage of all of them is added up.
+    :return: number of documents, number of segments, size in bytes, and size in bytes of each field.
+    """
+    stats = client.indices.stats(index=index_name, metric="docs,store,segments")["_all"]["primaries"]
+    usage = client.indices.disk_usage(index=index_name, run_expensive_tasks=True)
+    fields = {}
+    for name in index_name.split(","):
+        for field, field_usage in usage[name]["fields"].items():
+            fields[field] = fields.get(field, 0) + field_usage["total_in_bytes"]
+    return {
+        "docs": stats["docs"]["count"],
+        "segments": stats["segments"]["count"],
+        "size_in_bytes": stats["store"]["size_in_bytes"],
+        "fields": fields
+    }
+
+
+def get_field_kind(field: str, time_series_fields: {}):
+    """
+    Get the kind of a field, to group the storage of the fields.
+    :param field: name of the field, as returned by the analyze disk usage API.
+    :param time_series_fields: time series fields of the TSDB index.
+    :return: one of storage_field_kinds.
+    """
+    if field in time_series_fields["dimension"]:
+        return "dimensions"
+    if field in time_series_fields["counter"] or field in time_series_fields["gauge"]:
+        return "metrics"
+    if field in ["@timestamp", "_source", "_id"]:
+        return field
+    if field.startswith("_"):
+        return "other metadata"
+    return "other fields"
+
+
+def get_kind_sizes(storage: {}, time_series_fields: {}):
+    """
+    Add up the size of the fields of each kind.
+    :param storage: storage of the index, as returned by get_index_storage.
+    :param time_series_fields: time series fields of the TSDB index.
+    :return: size in bytes of each of storage_field_kinds.
+    """
+    sizes = {kind: 0 for kind in storage_field_kinds}
+    for field, size in storage["fields"].items():
+        sizes[get_field_kind(field, time_series_fields)] += size
+    return sizes
+
+
+def display_storage_report(report: {}):
+    """
+    Display the storage of the source index and the TSDB index.
+    :param report: storage report, as returned by report_storage.
+    """
+    print("Storage of the primary shards:")
+    for name in ["source", "tsdb"]:
+        storage = report[name]
+        print("\t- {}: {} documents, {} segments, {} bytes ({:.1f} bytes per document).".format(
+            storage["index"], storage["docs"], storage["segments"], storage["size_in_bytes"],
+            storage["bytes_per_doc"]))
+    if report["compression_ratio"] is not None:
+        print("\tThe TSDB index takes {:.1%} less space per document (compression ratio {:.2f}).".format(
+            1 - 1 / report["compression_ratio"], report["compression_ratio"]))
+
+    print("Share of the storage by kind of field:")
+    for kind in storage_field_kinds:
+        source, tsdb = report["source"]["kinds"][kind], report["tsdb"]["kinds"][kind]
+        if source == 0 and tsdb == 0:
+            continue
+        print("\t- {}: {} bytes ({:.1%}) in the source index, {} bytes ({:.1%}) in the TSDB index.".format(
+            kind, source, source / max(sum(report["source"]["kinds"].values()), 1), tsdb,
+            tsdb / max(sum(report["tsdb"]["kinds"].values()), 1)))
+
+    print("Biggest fields of the TSDB index:")
+    fields = sorted(report["tsdb"]["fields"].items(), key=lambda item: -item[1])
+    for field, size in fields[:storage_fields_displayed]:
+        print("\t- {}: {} bytes in the TSDB index, {} bytes in the source index.".format(
+            field, size, report["source"]["fields"].get(field, 0)))
+    print()
+
+
+@profile_stage("report_storage")
+def report_storage(client: Elasticsearch, data_stream_name: str, docs_index: int, dest_index: str,
+                   time_series_fields: {}, merge: bool = False, max_num_segments: int = storage_max_num_segments):
+    """
+    Display the storage of the source index and the TSDB index: total size, size per document, compression ratio,
+    and the size of each kind of field (dimensions, metrics, _source...) and of the biggest fields.
+    Sizes are compared per document, since the TSDB index might have fewer documents than the source index.
+    :param client: ES client.
+    :param data_stream_name: name of the data stream.
+    :param docs_index: number of the index used to retrieve the documents.
+    :param dest_index: name of the TSDB index, or comma-separated names of the TSDB indices the documents were
+    copied to. Their storage is added up.
+    :param time_series_fields: time series fields of the TSDB index.
+    :param merge: true to force merge both indices to @max_num_segments segments first. The write index of the data
+    stream is never force merged.
+    :param max_num_segments: number of segments to merge to.
+    :return: storage report.
+    """
+    data_stream = client.indices.get_data_stream(name=data_stream_name)["data_streams"][0]
+    # The number of the index was already checked when the documents were copied
+    source_index = data_stream["indices"][max(docs_index, 0)]["index_name"]
+
+    if merge:
+        if source_index == data_stream["indices"][-1]["index_name"]:
+            print("WARNING: Index {} is the write index of the data stream. It will not be force merged, so its "
+                  "size might not be comparable.".format(source_index))
+        else:
+            force_merge(client, source_index, max_num_segments)
+        force_merge(client, dest_index, max_num_segments)
+
+    print("Analyzing the disk usage of indices {} and {}...".format(source_index, dest_index))
+    report = {}
+    for name, index_name in [("source", source_index), ("tsdb", dest_index)]:
+        storage = get_index_storage(client, index_name)
+        storage["index"] = index_name
+        storage["bytes_per_doc"] = storage["size_in_bytes"] / max(storage["docs"], 1)
+        storage["kinds"] = get_kind_sizes(storage, time_series_fields)
+        report[name] = storage
+    report["compression_ratio"] = None
+    if report["tsdb"]["bytes_per_doc"] > 0:
+        report["compression_ratio"] = report["source"]["bytes_per_doc"] / report["tsdb"]["bytes_per_doc"]
+
+    display_storage_report(report)
+    return report
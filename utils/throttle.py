@@ -0,0 +1,113 @@
+"""
+All functions to adapt the speed of a reindex to the load of the cluster are placed here.
+While the reindex task runs, the nodes stats are sampled at every poll. The requests_per_second of the task goes
+down quickly when the write or search thread pools reject requests, goes down slowly when their queues grow or
+indexing gets slower, and goes up otherwise.
+"""
+
+from elasticsearch import ApiError, Elasticsearch
+
+# Requests per second of a new reindex task, and its limits.
+throttle_initial_requests_per_second = 1000
+throttle_min_requests_per_second = 10
+throttle_max_requests_per_second = 100000
+# Documents per batch of a throttled reindex. It cannot be changed on a running task, so it is smaller than the
+# default (1000) to keep each burst of writes short.
+throttle_batch_size = 500
+# Factor applied to requests_per_second when there are rejections, when the cluster is busy, and when it is not.
+throttle_rejections_factor = 0.5
+throttle_busy_factor = 0.8
+throttle_idle_factor = 1.25
+# The cluster is busy if a write or search queue has more tasks than this in any node...
+throttle_max_queue = 50
+# ... or if indexing a document takes this many times longer than the fastest time seen during the reindex.
+throttle_max_latency_factor = 2.0
+# Minimum change of requests_per_second to rethrottle the task.
+throttle_min_change = 0.1
+
+
+def get_cluster_load(client: Elasticsearch):
+    """
+    Get the load of the write and search thread pools, and the indexing time, of all nodes.
+    :param client: ES client.
+    :return: rejections of the write and search thread pools, biggest queue of any node, documents indexed and
+    time spent indexing them, in milliseconds.
+    """
+    res = client.nodes.stats(metric="thread_pool,indices", index_metric="indexing")
+    load = {"rejected": 0, "queue": 0, "index_total": 0, "index_time_in_millis": 0}
+    for node in res["nodes"].values():
+        for thread_pool in ["write", "search"]:
+            stats = node.get("thread_pool", {}).get(thread_pool, {})
+            load["rejected"] += stats.get("rejected", 0)
+            load["queue"] = max(load["queue"], stats.get("queue", 0))
+        indexing = node.get("indices", {}).get("indexing", {})
+        load["index_total"] += indexing.get("index_total", 0)
+        load["index_time_in_millis"] += indexing.get("index_time_in_millis", 0)
+    return load
+
+
+def new_throttle(client: Elasticsearch):
+    """
+    Get the state to throttle a new reindex task.
+    :param client: ES client.
+    :return: state of the throttle.
+    """
+    return {
+        "requests_per_second": throttle_initial_requests_per_second,
+        "load": get_cluster_load(client),
+        "min_latency": None
+    }
+
+
+def get_throttled_requests_per_second(throttle: {}, load: {}):
+    """
+    Get the new requests_per_second, given the load of the cluster since the last sample.
+    :param throttle: state of the throttle. Its load and min_latency are updated.
+    :param load: load of the cluster, as returned by get_cluster_load.
+    :return: new requests_per_second, and the reason for it.
+    """
+    last = throttle["load"]
+    throttle["load"] = load
+    rejected = load["rejected"] - last["rejected"]
+    indexed = load["index_total"] - last["index_total"]
+    latency = None
+    if indexed > 0:
+        latency = (load["index_time_in_millis"] - last["index_time_in_millis"]) / indexed
+        if throttle["min_latency"] is None or latency < throttle["min_latency"]:
+            throttle["min_latency"] = latency
+
+    requests_per_second = throttle["requests_per_second"]
+    if rejected > 0:
+        factor, reason = throttle_rejections_factor, "{} rejected requests".format(rejected)
+    elif load["queue"] > throttle_max_queue:
+        factor, reason = throttle_busy_factor, "{} tasks queued in a node".format(load["queue"])
+    elif latency is not None and throttle["min_latency"] > 0 and \
+            latency > throttle["min_latency"] * throttle_max_latency_factor:
+        factor, reason = throttle_busy_factor, "indexing takes {:.2f}ms per document".format(latency)
+    else:
+        factor, reason = throttle_idle_factor, "no pressure"
+    requests_per_second = min(throttle_max_requests_per_second,
+                              max(throttle_min_requests_per_second, requests_per_second * factor))
+    return requests_per_second, reason
+
+
+def adjust_throttle(client: Elasticsearch, task_id: str, throttle: {}):
+    """
+    Sample the load of the cluster and rethrottle the reindex task if needed. If the task finishes before it is
+    rethrottled, nothing is changed.
+    :param client: ES client.
+    :param task_id: ID of the reindex task.
+    :param throttle: state of the throttle.
+    """
+    requests_per_second, reason = get_throttled_requests_per_second(throttle, get_cluster_load(client))
+    change = abs(requests_per_second - throttle["requests_per_second"]) / throttle["requests_per_second"]
+    if change < throttle_min_change:
+        return
+    try:
+        client.reindex_rethrottle(task_id=task_id, requests_per_second=requests_per_second)
+    except ApiError:
+        # The task finished since the last poll (NotFoundError), or it cannot be rethrottled any more
+        return
+    print("\n\tReindex rethrottled from {:.0f} to {:.0f} requests per second ({}).".format(
+        throttle["requests_per_second"], requests_per_second, reason))
+    throttle["requests_per_second"] = requests_per_second
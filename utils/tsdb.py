@@ -5,14 +5,13 @@ For example: discard_unknown_settings discard settings that are not currently ac
 in the ES Python client. If the situation changes, the function will no longer be accurate.
 """
 
-# This is a dictionary for all the time series fields accepted as of today (29.June.2023).
+import hashlib
+import json
+
+# These are the keys of the time series fields dictionary, for all the time series fields accepted as of
+# today (29.June.2023).
 # routing_path is also part of the dictionary since it is mandatory to have it for a time series index.
-time_series_fields = {
-    "dimension": [],
-    "counter": [],
-    "gauge": [],
-    "routing_path": []
-}
+time_series_field_types = ["dimension", "counter", "gauge", "routing_path"]
 
 # We need to set the routing path to create a TSDB index.
 # As of today (29.June.2023), only keyword fields are accepted.
@@ -23,6 +22,20 @@ tsdb_index = "tsdb-index-enabled"
 # This is the index in which we will store the documents that were overwritten - ie, the ones that caused us
 # to lose data.
 overwritten_docs_index = "tsdb-overwritten-docs"
+# The ingest pipeline that keeps only the overwritten documents.
+missing_docs_pipeline = "get-missing-docs"
+
+# Seconds to wait between two requests to check the progress of a reindex task.
+task_poll_interval = 5
+
+# Directory to keep the results that can be reused between runs.
+cache_dir = ".tsdb-cache"
+
+
+class MigrationError(Exception):
+    """
+    Error that does not let the migration test go on, like a data stream that does not exist.
+    """
 
 
 # Some settings cause an error as they are not known to ElasticSearch Python client.
@@ -36,13 +49,12 @@ def discard_unknown_settings(settings: []):
     return settings
 
 
-def get_time_series_fields(mappings: {}):
+def flatten_mappings(mappings: {}):
     """
-    Place all fields in the time time_series_fields dictionary.
+    Get all fields of the mappings, with the name of each level separated by a dot.
     :param mappings: Mappings dictionary.
+    :return: dictionary with the mapping of each field.
     """
-    fields = mappings["properties"]
-
     # A function to flatten the name of the fields
     def get_all_fields(fields: {}, common: str, result: {}):
         def join_strings(str1: str, str2: str):
@@ -58,7 +70,28 @@ def get_time_series_fields(mappings: {}):
                 result[new_key] = fields[key]
 
     result = {}
-    get_all_fields(fields, "", result)
+    get_all_fields(mappings.get("properties", {}), "", result)
+    return result
+
+
+def get_mappings_hash(mappings: {}):
+    """
+    Get a hash of the mappings. Two mappings with the same fields have the same hash.
+    :param mappings: Mappings dictionary.
+    :return: hexadecimal hash.
+    """
+    return hashlib.sha256(json.dumps(mappings, sort_keys=True).encode()).hexdigest()
+
+
+def cluster_time_series_fields(mappings: {}):
+    """
+    Place all fields in a new time series fields dictionary.
+    :param mappings: Mappings dictionary.
+    :return: dictionary with the fields for each of the time_series_field_types.
+    """
+    time_series_fields = {field_type: [] for field_type in time_series_field_types}
+
+    result = flatten_mappings(mappings)
 
     # Split the time series fields according to metric / dimension
     def cluster_fields_by_type(fields: {}):
@@ -73,9 +106,19 @@ def get_time_series_fields(mappings: {}):
 
     cluster_fields_by_type(result)
 
+    return time_series_fields
+
+
+def get_time_series_fields(mappings: {}):
+    """
+    Place all fields in a new time series fields dictionary.
+    :param mappings: Mappings dictionary.
+    :return: dictionary with the fields for each of the time_series_field_types.
+    """
+    time_series_fields = cluster_time_series_fields(mappings)
+
     if len(time_series_fields["routing_path"]) == 0:
-        print("Routing path is empty. Program will end.")
-        exit(0)
+        raise MigrationError("Routing path is empty.")
 
     print("The time series fields for the TSDB index are: ")
     for key in time_series_fields:
@@ -85,6 +128,8 @@ def get_time_series_fields(mappings: {}):
                 print("\t\t- {}".format(value))
     print()
 
+    return time_series_fields
+
 
 def get_tsdb_settings(mappings: {}, settings: {}):
     """
@@ -92,7 +137,7 @@ def get_tsdb_settings(mappings: {}, settings: {}):
     Get all time series metrics using the mappings.
     :param mappings: mappings.
     :param settings: settings.
-    :return: modified settings for the TSDB index.
+    :return: modified settings for the TSDB index, and the time series fields.
     """
     # Some settings cause an error on the ES client. This function removes them.
     discard_unknown_settings(settings)
@@ -100,7 +145,7 @@ def get_tsdb_settings(mappings: {}, settings: {}):
     settings["index"] |= {"mode": "time_series"}
 
     # Get all time series fields
-    get_time_series_fields(mappings)
+    time_series_fields = get_time_series_fields(mappings)
 
     # Set a new window to avoid time series end / start time errors
     time_series = {
@@ -112,4 +157,4 @@ def get_tsdb_settings(mappings: {}, settings: {}):
     settings["index"] |= time_series
     settings["index"] |= {"routing_path": time_series_fields["routing_path"]}
 
-    return settings
+    return settings, time_series_fields